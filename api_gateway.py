@@ -1,23 +1,40 @@
 import os
 import time
+_MODULE_LOAD_STARTED = time.perf_counter()
+import atexit
 import json
+import csv
+import struct
+import tarfile
+import zlib
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
 import hashlib
+import hmac
 import base64
-from flask import Flask, request, jsonify, redirect
+import random
+import socket
+import sys
+import contextvars
+import queue
+import threading
+import heapq
+import itertools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, InvalidStateError, ThreadPoolExecutor, as_completed, wait
+from flask import Flask, Response, has_request_context, request, jsonify, redirect, send_file
 from flask_cors import CORS
 from functools import wraps
-from openai import OpenAI
-import redis
-from google import genai
-from google.genai import types
+from importlib import import_module
 from io import BytesIO
-import fal_client
-from supabase import create_client, Client
 from dotenv import load_dotenv
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
 import os
 from pathlib import Path
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 # Load environment variables
 env_path = Path('.') / '.env.local'
@@ -32,35 +49,109 @@ load_dotenv(override=True)
 app = Flask(__name__)
 CORS(app, resources={r"/v1/*": {"origins": "*"}})
 
-# --- Initialize Supabase Client ---
-try:
-    supabase_url = os.environ.get("SUPABASE_URL")
-    supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-    supabase: Client = create_client(supabase_url, supabase_key)
+# --- Lazily Initialized Clients ---
+#
+# The provider SDKs and the Supabase/Redis clients are imported and built on
+# first use rather than at import time, so a cold start only pays for the
+# clients its first request actually touches. Each LazyClient stands in for
+# its client: attribute access builds it (once, under a lock) and truth tests
+# report whether it is available, so `if not kv:` checks keep working. Import
+# and construction times are kept for the cold start report
+# (GET /v1/system/cold-start).
+
+_cold_start_timings = {}
+
+class LazyClient:
+    """Proxy that imports `module` and calls build(module) on first use.
+
+    A client that fails to build is remembered as unavailable (falsy) and the
+    failure is logged once, as the eager initialization used to do.
+    """
+
+    _UNSET = object()
+
+    def __init__(self, name, module, build, failure_message):
+        self._name = name
+        self._module = module
+        self._build = build
+        self._failure_message = failure_message
+        self._client = self._UNSET
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        """The underlying client, or None if it could not be initialized.
+
+        Private so it can't shadow a client method (kv.get is Redis GET).
+        """
+        if self._client is self._UNSET:
+            with self._lock:
+                if self._client is self._UNSET:
+                    self._client = self._initialize()
+        return self._client
+
+    def _initialize(self):
+        timing = {"status": "failed", "import_ms": None, "init_ms": None}
+        client = None
+        try:
+            started = time.perf_counter()
+            module = import_module(self._module)
+            imported = time.perf_counter()
+            timing["import_ms"] = round((imported - started) * 1000, 1)
+            client = self._build(module)
+            timing["init_ms"] = round((time.perf_counter() - imported) * 1000, 1)
+            timing["status"] = "ready"
+            print(f"⏱️  {self._name} ready (import {timing['import_ms']} ms, init {timing['init_ms']} ms)")
+        except Exception as e:
+            timing["error"] = str(e)
+            print(f"{self._failure_message} Error: {e}")
+        _cold_start_timings[self._name] = timing
+        return client
+
+    def __bool__(self):
+        return self._get_client() is not None
+
+    def __getattr__(self, attr):
+        client = self._get_client()
+        if client is None:
+            raise ConnectionError(f"{self._name} client not initialized.")
+        return getattr(client, attr)
+
+def _build_supabase(module):
+    client = module.create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY"))
     print("✅ Connected to Supabase")
-except Exception as e:
-    print(f"CRITICAL: Could not connect to Supabase. Error: {e}")
-    supabase = None
-
-# --- Connect to Vercel KV (Redis) for Job Tracking ---
-try:
-    kv = redis.from_url(os.environ.get("KV_URL"))
-except Exception as e:
-    print(f"Warning: Could not connect to Vercel KV. Using Supabase only. Error: {e}")
-    kv = None
-
-# --- Initialize API Clients ---
-try:
-    openai_client = OpenAI()
-except Exception as e:
-    print(f"Warning: OpenAI client failed to initialize. DALL-E will be unavailable. Error: {e}")
-    openai_client = None
-
-try:
-    genai_client = genai.Client(api_key=os.environ.get("GOOGLE_API_KEY"))
-except Exception as e:
-    print(f"Warning: Google GenAI client failed to initialize. Imagen will be unavailable. Error: {e}")
-    genai_client = None
+    return client
+
+supabase = LazyClient(
+    "supabase", "supabase", _build_supabase,
+    "CRITICAL: Could not connect to Supabase."
+)
+
+# Vercel KV (Redis) for job tracking
+kv = LazyClient(
+    "redis", "redis", lambda redis: redis.from_url(os.environ.get("KV_URL")),
+    "Warning: Could not connect to Vercel KV. Using Supabase only."
+)
+
+openai_client = LazyClient(
+    "openai", "openai", lambda openai: openai.OpenAI(),
+    "Warning: OpenAI client failed to initialize. DALL-E will be unavailable."
+)
+
+genai_client = LazyClient(
+    "google-genai", "google.genai", lambda genai: genai.Client(api_key=os.environ.get("GOOGLE_API_KEY")),
+    "Warning: Google GenAI client failed to initialize. Imagen will be unavailable."
+)
+
+def get_cold_start_report():
+    """Module load time and per-client import/initialization cost for this instance."""
+    clients = {
+        client._name: _cold_start_timings.get(client._name, {"status": "not_loaded"})
+        for client in (supabase, kv, openai_client, genai_client)
+    }
+    return {
+        "module_load_ms": _cold_start_timings.get("module_load_ms"),
+        "clients": clients,
+    }
 
 # --- API Keys and Endpoints ---
 BFL_API_KEY = os.environ.get("BFL_API_KEY")
@@ -69,14 +160,426 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 MINIMAX_API_KEY = os.environ.get("MINIMAX_API_KEY")
 FAL_KEY = os.environ.get("FAL_KEY")
 
-# Set FAL_KEY for fal_client
-if FAL_KEY:
-    os.environ["FAL_KEY"] = FAL_KEY
+# Overridable to point at staging or the benchmark stubs (benchmarks/stub_providers.py).
+# OpenAI is redirected with the SDK's own OPENAI_BASE_URL.
+BFL_API_URL_BASE = os.environ.get("BFL_API_URL_BASE", "https://api.bfl.ai/v1/")
+REVE_API_URL = os.environ.get("REVE_API_URL", "https://api.reve.com/v1/image/create")
+GEMINI_API_URL = os.environ.get(
+    "GEMINI_API_URL",
+    "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image-preview:generateContent"
+)
+MINIMAX_API_URL = os.environ.get("MINIMAX_API_URL", "https://api.minimax.io/v1/image_generation")
+FAL_QUEUE_URL = os.environ.get("FAL_QUEUE_URL", "https://queue.fal.run/")
+
+# Maximum images requested per fal.ai call when batching tasks (num_images)
+FAL_MAX_BATCH = {
+    provider: int(os.environ.get("FAL_MAX_BATCH", 4))
+    for provider in ["seedream-4", "qwen-image", "seedream-3", "ideogram-v3", "gpt-image-1"]
+}
+
+# Maximum time to wait for long-running (polled) generations
+BFL_POLL_TIMEOUT = 90
+FAL_POLL_TIMEOUT = int(os.environ.get("FAL_POLL_TIMEOUT", 300))
+
+# ==============================================================================
+# HTTP CONNECTION POOLS
+# ==============================================================================
+#
+# One keep-alive requests.Session per upstream backend, shared by all worker
+# threads, so repeated calls (and BFL polls) reuse TCP+TLS connections instead
+# of paying a fresh handshake every time.
+
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 20))
+HTTP_STATS_WINDOW = 500  # latency samples kept per backend
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+_http_stats = {}
+
+def _http_pool_size(backend):
+    """Pool size for a backend: HTTP_POOL_SIZE_<BACKEND>, else HTTP_POOL_SIZE."""
+    return int(os.environ.get(f"HTTP_POOL_SIZE_{backend.upper()}", HTTP_POOL_SIZE))
+
+def _record_http_response(backend, response):
+    """Response hook: records request count and latency for a backend."""
+    stats = _http_stats[backend]
+    with stats["lock"]:
+        stats["requests"] += 1
+        if response.status_code >= 400:
+            stats["errors"] += 1
+        stats["latencies_ms"].append(response.elapsed.total_seconds() * 1000)
+
+def get_http_session(backend):
+    """Returns the shared pooled session for a backend, creating it on first use."""
+    session = _http_sessions.get(backend)
+    if session:
+        return session
+
+    with _http_sessions_lock:
+        if backend not in _http_sessions:
+            pool_size = _http_pool_size(backend)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.hooks["response"].append(lambda r, *args, **kwargs: _record_http_response(backend, r))
+            _http_stats[backend] = {
+                "lock": threading.Lock(),
+                "pool_size": pool_size,
+                "requests": 0,
+                "errors": 0,
+                "latencies_ms": deque(maxlen=HTTP_STATS_WINDOW)
+            }
+            _http_sessions[backend] = session
+        return _http_sessions[backend]
+
+def get_http_pool_stats():
+    """Returns per-backend pool statistics (requests, connections opened, reuse, latency)."""
+    report = {}
+    for backend, session in list(_http_sessions.items()):
+        stats = _http_stats[backend]
+        with stats["lock"]:
+            request_count = stats["requests"]
+            errors = stats["errors"]
+            latencies = sorted(stats["latencies_ms"])
+
+        # Every new TCP+TLS connection bumps num_connections on its urllib3 pool
+        connections_opened = 0
+        poolmanager = session.get_adapter("https://").poolmanager
+        for key in poolmanager.pools.keys():
+            try:
+                connections_opened += poolmanager.pools[key].num_connections
+            except KeyError:
+                continue
+
+        report[backend] = {
+            "pool_size": stats["pool_size"],
+            "requests": request_count,
+            "errors": errors,
+            "connections_opened": connections_opened,
+            "reused_requests": max(request_count - connections_opened, 0),
+            "reuse_ratio": round(1 - connections_opened / request_count, 3) if request_count else 0.0,
+            "latency_p50_ms": round(latencies[len(latencies) // 2], 1) if latencies else None,
+            "latency_p95_ms": round(latencies[int(len(latencies) * 0.95)], 1) if latencies else None
+        }
+    return report
+
+# ==============================================================================
+# METRICS (Prometheus, served on /metrics)
+# ==============================================================================
+#
+# With several worker processes (gunicorn workers, queue workers), start them
+# all with PROMETHEUS_MULTIPROC_DIR pointing at the same empty directory: each
+# process writes its samples there and /metrics aggregates every process. It
+# must be in the process environment (not .env), since prometheus_client reads
+# it on import. Clear the directory before (re)starting the workers.
+# Without it, /metrics reports this process only. Set METRICS_TOKEN to require
+# "Authorization: Bearer <token>" on /metrics.
+
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROVIDER_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+HTTP_REQUESTS = Counter(
+    "bigapi_http_requests", "HTTP requests handled", ["endpoint", "method", "status"]
+)
+HTTP_LATENCY = Histogram(
+    "bigapi_http_request_duration_seconds", "Time to produce an HTTP response (streamed bodies excluded)",
+    ["endpoint"], buckets=STAGE_BUCKETS + (30, 60, 120)
+)
+STAGE_LATENCY = Histogram(
+    "bigapi_stage_duration_seconds",
+    "Time spent in each request stage (auth, credit_check, credit_commit, usage_write, serialization, <pipeline>_write)",
+    ["stage", "outcome"], buckets=STAGE_BUCKETS
+)
+PROVIDER_LATENCY = Histogram(
+    "bigapi_provider_duration_seconds", "Provider connector time from call to result (polling included)",
+    ["provider", "outcome"], buckets=PROVIDER_BUCKETS
+)
+PROVIDER_BYTES = Counter(
+    "bigapi_provider_response_bytes", "Image payload bytes returned by each provider (URL or data URL)", ["provider"]
+)
+AUTH_CACHE_LOOKUPS = Counter(
+    "bigapi_auth_cache_lookups", "API key lookups by where they were answered", ["result"]  # local, kv, database
+)
+TASKS_IN_FLIGHT = Gauge(
+    "bigapi_tasks_in_flight", "Tasks currently waiting on a provider", ["provider"], multiprocess_mode="livesum"
+)
+
+def observe_stage(stage, started, outcome="success"):
+    """Records a stage duration measured from started (a time.perf_counter() value).
+
+    Stages observed while handling a request are also reported to the client
+    in its Server-Timing header.
+    """
+    elapsed = time.perf_counter() - started
+    STAGE_LATENCY.labels(stage, outcome).observe(elapsed)
+    if has_request_context():
+        if not hasattr(request, "server_timing"):
+            request.server_timing = []
+        request.server_timing.append((stage, elapsed))
+
+def provider_outcome_label(error):
+    """Outcome label for a finished provider call."""
+    if error is None:
+        return "success"
+    if isinstance(error, RateLimitTimeout):
+        return "rate_limited"
+    if isinstance(error, CancelledError):
+        return "cancelled"
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    return "error"
+
+def record_provider_call(provider, seconds, error=None, images=()):
+    """Records a finished provider call: latency by outcome, and bytes of the images it returned."""
+    PROVIDER_LATENCY.labels(provider, provider_outcome_label(error)).observe(seconds)
+    payload_bytes = sum(len(image) for image in images if isinstance(image, str))
+    if payload_bytes:
+        PROVIDER_BYTES.labels(provider).inc(payload_bytes)
+
+def render_metrics():
+    """Prometheus text exposition for this process, or for all processes in multiprocess mode."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+if PROMETHEUS_MULTIPROC_DIR:
+    # Drops this process's live gauge samples (tasks in flight) when it exits
+    atexit.register(lambda: multiprocess.mark_process_dead(os.getpid()))
+
+# ==============================================================================
+# IN-PROCESS CACHE
+# ==============================================================================
 
-BFL_API_URL_BASE = "https://api.bfl.ai/v1/"
-REVE_API_URL = "https://api.reve.com/v1/image/create"
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image-preview:generateContent"
-MINIMAX_API_URL = "https://api.minimax.io/v1/image_generation"
+class TTLCache:
+    """Thread-safe in-process LRU cache with per-entry TTL, bounded by entries and bytes."""
+
+    def __init__(self, max_entries, ttl, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None if missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value, size = entry
+            if expires_at < time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, size=0, ttl=None):
+        """Stores a value; size is its weight against max_bytes."""
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.time() + (ttl or self.ttl), value, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+# ==============================================================================
+# REQUEST PROFILING (admin-only, on demand)
+# ==============================================================================
+#
+# A request sent with "X-Profile: 1" and "X-Admin-Token: <ADMIN_API_TOKEN>" is
+# profiled: a sampler thread records the stacks of every thread working on it
+# every PROFILE_SAMPLE_INTERVAL seconds (wall clock, so waits on Supabase,
+# Redis or a provider show up too), and profile_span() blocks build a span
+# tree across the job's worker and poller threads. The profile is stored for
+# PROFILE_TTL seconds under the request id (returned in X-Profile-Id) and can
+# be downloaded from GET /v1/admin/profiles/<request_id>. Other requests only
+# pay for a context variable lookup per span.
+
+ADMIN_API_TOKEN = os.environ.get("ADMIN_API_TOKEN")
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.005))
+PROFILE_TTL = int(os.environ.get("PROFILE_TTL", 86400))
+PROFILE_MAX_SECONDS = 600  # sampling stops after this; spans are still recorded
+PROFILE_MAX_SPANS = 10000
+
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_local_profiles = TTLCache(100, PROFILE_TTL)
+
+class RequestProfile:
+    """Span tree and sampled stacks for one profiled request."""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._spans = []
+        self._span_ids = itertools.count()
+        self._samples = {}
+        self._active_threads = {}  # thread ident -> open spans on it
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._finished = False
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._sampler.start()
+
+    def open_span(self, name, parent_id, attributes):
+        span = {
+            "id": next(self._span_ids),
+            "parent": parent_id,
+            "name": name,
+            "thread": threading.current_thread().name,
+            "start_ms": round((time.perf_counter() - self._started) * 1000, 3),
+            "duration_ms": None,
+        }
+        if attributes:
+            span["attributes"] = attributes
+        ident = threading.get_ident()
+        with self._lock:
+            if len(self._spans) < PROFILE_MAX_SPANS:
+                self._spans.append(span)
+            self._active_threads[ident] = self._active_threads.get(ident, 0) + 1
+        return span
+
+    def close_span(self, span):
+        span["duration_ms"] = round((time.perf_counter() - self._started) * 1000 - span["start_ms"], 3)
+        ident = threading.get_ident()
+        with self._lock:
+            remaining = self._active_threads.get(ident, 1) - 1
+            if remaining > 0:
+                self._active_threads[ident] = remaining
+            else:
+                self._active_threads.pop(ident, None)
+
+    def _sample(self):
+        deadline = time.perf_counter() + PROFILE_MAX_SECONDS
+        own_ident = threading.get_ident()
+        while not self._stopped.wait(PROFILE_SAMPLE_INTERVAL) and time.perf_counter() < deadline:
+            with self._lock:
+                idents = [ident for ident in self._active_threads if ident != own_ident]
+            frames = sys._current_frames()
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                folded = ";".join(reversed(stack))
+                self._samples[folded] = self._samples.get(folded, 0) + 1
+
+    def finish(self):
+        """Stops sampling and stores the profile. Safe to call more than once."""
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self._stopped.set()
+        self._sampler.join(timeout=1)
+        report = self.report()
+        _local_profiles.set(self.request_id, report)
+        if kv:
+            try:
+                kv.setex(f"profile:{self.request_id}", PROFILE_TTL, json.dumps(report))
+            except Exception as e:
+                print(f"⚠️ Could not store profile {self.request_id}: {e}")
+        print(f"🔬 Profile {self.request_id} stored ({len(self._spans)} spans, {sum(self._samples.values())} samples)")
+
+    def report(self):
+        spans = {span["id"]: dict(span, children=[]) for span in self._spans}
+        roots = []
+        for span in spans.values():
+            parent = spans.get(span["parent"])
+            (parent["children"] if parent else roots).append(span)
+        for span in spans.values():
+            del span["parent"]
+            if not span["children"]:
+                del span["children"]
+        return {
+            "request_id": self.request_id,
+            "started_at": self.started_at,
+            "duration_ms": round((time.perf_counter() - self._started) * 1000, 3),
+            "sample_interval_ms": PROFILE_SAMPLE_INTERVAL * 1000,
+            "sample_count": sum(self._samples.values()),
+            "spans": roots,
+            "samples": [
+                {"stack": stack, "count": count}
+                for stack, count in sorted(self._samples.items(), key=lambda item: -item[1])
+            ],
+        }
+
+@contextmanager
+def profile_span(name, **attributes):
+    """Records a span in the current request's profile, if it is being profiled."""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    span = profile.open_span(name, _current_span.get(), attributes)
+    token = _current_span.set(span["id"])
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+        profile.close_span(span)
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """executor.submit, running fn in a copy of the caller's context so spans nest under the caller's."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def is_admin_request():
+    """True if the request carries the admin token (never true without ADMIN_API_TOKEN)."""
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_API_TOKEN) and hmac.compare_digest(token, ADMIN_API_TOKEN)
+
+def start_request_profile(request_id):
+    """Starts profiling the current request."""
+    profile = RequestProfile(request_id)
+    _current_profile.set(profile)
+    _current_span.set(None)
+    return profile
+
+def finish_request_profile():
+    """Finishes the current request's profile, if any (after a streamed job, from the job thread)."""
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.finish()
+
+def get_stored_profile(request_id):
+    """A stored profile report, or None."""
+    report = _local_profiles.get(request_id)
+    if report is None and kv:
+        stored = kv.get(f"profile:{request_id}")
+        report = json.loads(stored) if stored else None
+    return report
 
 # ==============================================================================
 # CREDIT COSTS PER PROVIDER
@@ -103,6 +606,84 @@ PROVIDER_COSTS = {
 # API KEY AUTHENTICATION
 # ==============================================================================
 
+# Validated keys are cached in-process (short TTL) in front of Redis (1 hour).
+# Deleting a key publishes its hash so every instance drops it immediately.
+AUTH_CACHE_TTL = int(os.environ.get("AUTH_CACHE_TTL", 60))
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get("AUTH_CACHE_MAX_ENTRIES", 10000))
+AUTH_KV_TTL = 3600
+AUTH_INVALIDATION_CHANNEL = "auth:invalidate"
+# last_used_at is written in one batched update per interval
+LAST_USED_FLUSH_INTERVAL = int(os.environ.get("LAST_USED_FLUSH_INTERVAL", 30))
+
+_auth_cache = TTLCache(AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL)
+_auth_listener_started = False
+_auth_listener_lock = threading.Lock()
+_pending_key_usage = set()
+_pending_key_usage_lock = threading.Lock()
+_key_usage_flusher_started = False
+
+def _listen_for_auth_invalidations():
+    """Drops invalidated key hashes from the local cache; runs in a daemon thread."""
+    while True:
+        try:
+            pubsub = kv.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(AUTH_INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                _auth_cache.delete(_decode(message["data"]))
+        except Exception as e:
+            print(f"⚠️ Auth invalidation listener disconnected: {e}")
+        # Messages may have been missed while disconnected
+        _auth_cache.clear()
+        time.sleep(5)
+
+def _ensure_auth_listener():
+    global _auth_listener_started
+    if _auth_listener_started or not kv:
+        return
+    with _auth_listener_lock:
+        if not _auth_listener_started:
+            threading.Thread(target=_listen_for_auth_invalidations, name="auth-invalidation", daemon=True).start()
+            _auth_listener_started = True
+
+def invalidate_api_key(key_hash):
+    """Removes a key from both cache tiers on every instance."""
+    _auth_cache.delete(key_hash)
+    if kv:
+        try:
+            kv.delete(f"api_key:{key_hash}")
+            kv.publish(AUTH_INVALIDATION_CHANNEL, key_hash)
+        except Exception as e:
+            print(f"⚠️ Could not invalidate cached API key: {e}")
+
+def flush_key_usage():
+    """Writes last_used_at for every key used since the previous flush in one update."""
+    global _pending_key_usage
+    with _pending_key_usage_lock:
+        key_ids, _pending_key_usage = _pending_key_usage, set()
+    if not key_ids or not supabase:
+        return
+    try:
+        supabase.table('api_keys').update({'last_used_at': time.strftime('%Y-%m-%d %H:%M:%S')}).in_('id', list(key_ids)).execute()
+    except Exception as e:
+        print(f"⚠️ Could not update last_used_at for {len(key_ids)} API keys: {e}")
+
+def _flush_key_usage_periodically():
+    while True:
+        time.sleep(LAST_USED_FLUSH_INTERVAL)
+        flush_key_usage()
+
+def note_api_key_used(api_key_id):
+    """Queues a last_used_at update for the next background flush."""
+    global _key_usage_flusher_started
+    if not api_key_id:
+        return
+    with _pending_key_usage_lock:
+        _pending_key_usage.add(api_key_id)
+        if not _key_usage_flusher_started:
+            threading.Thread(target=_flush_key_usage_periodically, name="key-usage-flush", daemon=True).start()
+            atexit.register(flush_key_usage)
+            _key_usage_flusher_started = True
+
 def validate_api_key(api_key):
     """Validates API key against Supabase and returns user info"""
     if not api_key or not api_key.startswith("big_"):
@@ -115,14 +696,29 @@ def validate_api_key(api_key):
         # Hash the API key
         key_hash = hashlib.sha256(api_key.encode()).hexdigest()
 
-        # Check cache first
+        # Check the local cache, then Redis
+        _ensure_auth_listener()
+        user_info = _auth_cache.get(key_hash)
+        if user_info:
+            AUTH_CACHE_LOOKUPS.labels("local").inc()
+            note_api_key_used(user_info.get("api_key_id"))
+            return user_info
+
         if kv:
-            cached = kv.get(f"api_key:{key_hash}")
+            with profile_span("redis.api_key"):
+                cached = kv.get(f"api_key:{key_hash}")
             if cached:
-                return json.loads(cached)
+                AUTH_CACHE_LOOKUPS.labels("kv").inc()
+                user_info = json.loads(cached)
+                _auth_cache.set(key_hash, user_info)
+                note_api_key_used(user_info.get("api_key_id"))
+                return user_info
+
+        AUTH_CACHE_LOOKUPS.labels("database").inc()
 
         # Query Supabase for API key
-        response = supabase.table('api_keys').select('*, users(*)').eq('key_hash', key_hash).eq('is_active', True).execute()
+        with profile_span("supabase.api_keys"):
+            response = supabase.table('api_keys').select('*, users(*)').eq('key_hash', key_hash).eq('is_active', True).execute()
 
         if not response.data or len(response.data) == 0:
             return None
@@ -130,19 +726,19 @@ def validate_api_key(api_key):
         api_key_data = response.data[0]
         user_data = api_key_data['users']
 
-        # Update last_used_at
-        supabase.table('api_keys').update({'last_used_at': time.strftime('%Y-%m-%d %H:%M:%S')}).eq('id', api_key_data['id']).execute()
-
         user_info = {
             "user_id": user_data['id'],
             "email": user_data['email'],
             "credits": user_data['credits'],
-            "plan": user_data['plan']
+            "plan": user_data['plan'],
+            "api_key_id": api_key_data['id']
         }
+        note_api_key_used(api_key_data['id'])
 
         # Cache for 1 hour
         if kv:
-            kv.setex(f"api_key:{key_hash}", 3600, json.dumps(user_info))
+            kv.setex(f"api_key:{key_hash}", AUTH_KV_TTL, json.dumps(user_info))
+        _auth_cache.set(key_hash, user_info)
 
         return user_info
 
@@ -162,7 +758,10 @@ def require_api_key(f):
             }), 401
 
         api_key = auth_header.replace('Bearer ', '')
-        user_data = validate_api_key(api_key)
+        started = time.perf_counter()
+        with profile_span("auth"):
+            user_data = validate_api_key(api_key)
+        observe_stage("auth", started, "success" if user_data else "rejected")
 
         if not user_data:
             return jsonify({
@@ -197,6 +796,192 @@ def deduct_credits(user_id, credits_used, task_details):
         print(f"Error deducting credits: {e}")
         return True  # Don't fail the request if credit system is down
 
+# ==============================================================================
+# POLL SCHEDULER (long-running provider jobs)
+# ==============================================================================
+#
+# BFL and fal.ai generate asynchronously: we submit, then poll until the result
+# is ready. Instead of parking one thread per job in a sleep loop, connectors
+# register a poll function here and get a Future back. A single scheduler thread
+# keeps every outstanding job in a heap ordered by next poll time and hands due
+# polls to a small thread pool. Poll intervals adapt to the completion times
+# observed for each kind of job.
+#
+# A poll only shows that a job finished some time since the previous poll, so
+# each completion is recorded as the middle of that window rather than the
+# time it was seen; otherwise the schedule could never learn that jobs finish
+# sooner than it polls. Estimates are a moving average so they follow changes
+# in provider speed within a few jobs.
+#
+# A provider 429 on a poll doesn't fail the job: like a 429 on submit it pauses
+# the backend's shared rate-limit bucket for the Retry-After, and every poll of
+# that backend (job kinds are "backend:model") waits it out before retrying.
+
+POLL_MIN_INTERVAL = float(os.environ.get("POLL_MIN_INTERVAL", 0.5))
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", 5.0))
+POLL_WORKERS = int(os.environ.get("POLL_WORKERS", 4))
+# Until a kind of job has completed once the first poll comes after half of this
+POLL_DEFAULT_EXPECTED_SECONDS = float(os.environ.get("POLL_DEFAULT_EXPECTED_SECONDS", 4.0))
+# Weight of each new completion in the expected duration
+POLL_LEARNING_RATE = 0.2
+
+class PollScheduler:
+    """Multiplexes polling of many outstanding provider jobs onto one thread."""
+
+    def __init__(self, max_workers=POLL_WORKERS):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="poller")
+        self._durations = {}
+        self._durations_lock = threading.Lock()
+        self._paused_until = {}
+        self._thread = threading.Thread(target=self._run, name="poll-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, kind, poll_fn, timeout):
+        """Registers poll_fn() -> (done, value) and returns a Future for the value.
+
+        poll_fn may raise to fail the job. Cancelling the Future stops polling.
+        """
+        future = Future()
+        now = time.time()
+        entry = {
+            "kind": kind,
+            "poll_fn": poll_fn,
+            "future": future,
+            "started_at": now,
+            "last_pending_at": now,
+            "deadline": now + timeout,
+            "timeout": timeout,
+            "late_polls": 0,
+            # Polls (and the callbacks they trigger) run in the submitter's context, for profiling
+            "context": contextvars.copy_context()
+        }
+        self._schedule(entry, now + self._next_interval(entry, now))
+        return future
+
+    def expected_duration(self, kind):
+        """Moving average of the completion times observed for a kind of job."""
+        return self._durations.get(kind, POLL_DEFAULT_EXPECTED_SECONDS)
+
+    def record_duration(self, kind, seconds):
+        with self._durations_lock:
+            previous = self._durations.get(kind)
+            self._durations[kind] = seconds if previous is None else (
+                previous + POLL_LEARNING_RATE * (seconds - previous))
+
+    def pending(self):
+        """Number of jobs currently being polled."""
+        with self._cond:
+            return len(self._heap)
+
+    def _next_interval(self, entry, now):
+        # Converge on the expected completion time, then back off exponentially
+        elapsed = now - entry["started_at"]
+        expected = self.expected_duration(entry["kind"])
+        if elapsed < expected:
+            interval = (expected - elapsed) / 2
+        else:
+            interval = POLL_MIN_INTERVAL * (1.5 ** entry["late_polls"])
+            entry["late_polls"] += 1
+        return min(max(interval, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+
+    def _schedule(self, entry, when):
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._counter), entry))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._cond.wait(timeout)
+                _, _, entry = heapq.heappop(self._heap)
+
+            if entry["future"].cancelled():
+                continue
+            self._executor.submit(entry["context"].run, self._poll, entry)
+
+    def _poll(self, entry):
+        future = entry["future"]
+        backend = entry["kind"].split(":", 1)[0]
+        polled_at = time.time()
+        paused_until = self._paused_until.get(backend, 0)
+        if paused_until > polled_at and polled_at < entry["deadline"]:
+            self._schedule(entry, min(paused_until, entry["deadline"]))
+            return
+
+        try:
+            with profile_span("poll", kind=entry["kind"]):
+                done, value = entry["poll_fn"]()
+        except Exception as e:
+            retry_after = provider_retry_after(e)
+            if retry_after is None or polled_at + retry_after >= entry["deadline"]:
+                _settle_future(future, error=e)
+                return
+            retry_at = polled_at + max(retry_after, POLL_MIN_INTERVAL)
+            pause_provider(backend, retry_after)
+            with self._cond:
+                self._paused_until[backend] = max(self._paused_until.get(backend, 0), retry_at)
+            self._schedule(entry, retry_at)
+            return
+
+        now = time.time()
+        if done:
+            # Finished somewhere between the last pending answer and this poll
+            finished_at = (entry["last_pending_at"] + polled_at) / 2
+            self.record_duration(entry["kind"], finished_at - entry["started_at"])
+            _settle_future(future, value)
+        elif now >= entry["deadline"]:
+            _settle_future(future, error=TimeoutError(
+                f"{entry['kind']} generation timed out after {entry['timeout']} seconds."))
+        else:
+            entry["last_pending_at"] = polled_at
+            self._schedule(entry, min(now + self._next_interval(entry, now), entry["deadline"]))
+
+def _settle_future(future, value=None, error=None):
+    """Resolves a Future unless it has been cancelled meanwhile (cancel() can race with us)."""
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+    except InvalidStateError:
+        pass
+
+def chain_future(future, transform):
+    """Returns a Future resolved with transform(result) of future. Cancelling it cancels future."""
+    chained = Future()
+
+    def on_done(source):
+        if source.cancelled():
+            chained.cancel()
+            return
+        try:
+            value = transform(source.result())
+        except Exception as e:
+            _settle_future(chained, error=e)
+            return
+        _settle_future(chained, value)
+
+    chained.add_done_callback(lambda f: future.cancel() if f.cancelled() else None)
+    future.add_done_callback(on_done)
+    return chained
+
+_poll_scheduler = None
+_poll_scheduler_lock = threading.Lock()
+
+def get_poll_scheduler():
+    """Returns the process-wide poll scheduler, starting it on first use."""
+    global _poll_scheduler
+    if _poll_scheduler is None:
+        with _poll_scheduler_lock:
+            if _poll_scheduler is None:
+                _poll_scheduler = PollScheduler()
+    return _poll_scheduler
+
 # ==============================================================================
 # API PROVIDER FUNCTIONS (The "Connectors")
 # ==============================================================================
@@ -218,32 +1003,42 @@ def generate_with_reve(prompt, aspect_ratio):
         "Authorization": f"Bearer {REVE_API_KEY}", "Accept": "application/json", "Content-Type": "application/json"
     }
     payload = {"prompt": prompt, "aspect_ratio": aspect_ratio, "version": "latest"}
-    response = requests.post(REVE_API_URL, headers=headers, json=payload, timeout=60)
+    response = get_http_session("reve").post(REVE_API_URL, headers=headers, json=payload, timeout=60)
     response.raise_for_status()
     image_base64 = response.json()["image"]
     return f"data:image/png;base64,{image_base64}"
 
-def generate_with_bfl(prompt, model_endpoint, aspect_ratio):
-    """Starts an async BFL.AI job and polls for the result."""
+def submit_bfl_job(prompt, model_endpoint, aspect_ratio):
+    """Submits a BFL.AI job and returns a Future resolved by the poll scheduler."""
     if not BFL_API_KEY:
         raise ConnectionError("BFL_API_KEY not configured.")
     headers = {'accept': 'application/json', 'x-key': BFL_API_KEY, 'Content-Type': 'application/json'}
     payload = {'prompt': prompt, 'aspect_ratio': aspect_ratio}
     submit_url = f"{BFL_API_URL_BASE}{model_endpoint}"
-    submit_response = requests.post(submit_url, headers=headers, json=payload).json()
+    session = get_http_session("bfl")
+    submit_response = session.post(submit_url, headers=headers, json=payload, timeout=60)
+    submit_response.raise_for_status()
+    submit_response = submit_response.json()
     polling_url = submit_response.get("polling_url")
     if not polling_url:
         raise ValueError(f"BFL API did not return a polling URL. Response: {submit_response}")
-    start_time = time.time()
-    while time.time() - start_time < 90:
-        poll_response = requests.get(polling_url, headers={'accept': 'application/json', 'x-key': BFL_API_KEY}).json()
+
+    def poll():
+        poll_response = session.get(polling_url, headers={'accept': 'application/json', 'x-key': BFL_API_KEY}, timeout=30)
+        poll_response.raise_for_status()
+        poll_response = poll_response.json()
         status = poll_response.get("status")
         if status == "Ready":
-            return poll_response.get('result', {}).get('sample')
+            return True, poll_response.get('result', {}).get('sample')
         elif status in ["Error", "Failed"]:
             raise RuntimeError(f"BFL generation failed: {poll_response}")
-        time.sleep(2)
-    raise TimeoutError("BFL generation timed out after 90 seconds.")
+        return False, None
+
+    return get_poll_scheduler().submit(f"bfl:{model_endpoint}", poll, timeout=BFL_POLL_TIMEOUT)
+
+def generate_with_bfl(prompt, model_endpoint, aspect_ratio):
+    """Starts an async BFL.AI job and waits for the result."""
+    return submit_bfl_job(prompt, model_endpoint, aspect_ratio).result()
 
 def generate_with_gemini(prompt):
     """Generates an image with Gemini and returns a base64 data URL."""
@@ -251,7 +1046,7 @@ def generate_with_gemini(prompt):
         raise ConnectionError("GEMINI_API_KEY not configured.")
     api_url_with_key = f"{GEMINI_API_URL}?key={GEMINI_API_KEY}"
     payload = {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": {"responseModalities": ["IMAGE"]}}
-    response = requests.post(api_url_with_key, json=payload, timeout=60)
+    response = get_http_session("gemini").post(api_url_with_key, json=payload, timeout=60)
     response.raise_for_status()
     result = response.json()
     image_part = next((p for p in result['candidates'][0]['content']['parts'] if 'inlineData' in p), None)
@@ -266,7 +1061,7 @@ def generate_with_minimax(prompt, aspect_ratio):
         raise ConnectionError("MINIMAX_API_KEY not configured.")
     headers = {"Authorization": f"Bearer {MINIMAX_API_KEY}", "Content-Type": "application/json"}
     payload = {"model": "image-01", "prompt": prompt, "aspect_ratio": aspect_ratio, "n": 1, "response_format": "url"}
-    response = requests.post(MINIMAX_API_URL, headers=headers, json=payload, timeout=60)
+    response = get_http_session("minimax").post(MINIMAX_API_URL, headers=headers, json=payload, timeout=60)
     response.raise_for_status()
     result = response.json()
     if result.get("base_resp", {}).get("status_code") == 0 and result.get("data", {}).get("image_urls"):
@@ -274,8 +1069,24 @@ def generate_with_minimax(prompt, aspect_ratio):
     else:
         raise RuntimeError(f"Minimax generation failed: {result.get('base_resp')}")
 
-def generate_with_imagen(prompt, provider, aspect_ratio="1:1", image_size="1024", person_generation="allow_adult", number_of_images=1):
-    """Generates an image with Google Imagen (3 or 4) and returns a base64 data URL."""
+IMAGEN_MAX_BATCH = 4
+IMAGE_OUTPUT_FORMATS = {"png": "image/png", "jpeg": "image/jpeg", "jpg": "image/jpeg", "webp": "image/webp"}
+
+def _transcode_image(data, pil_format, quality=None):
+    """Re-encodes image bytes with Pillow (only used when the provider can't emit the requested format)."""
+    from PIL import Image
+    with profile_span("transcode", format=pil_format), Image.open(BytesIO(data)) as image:
+        buffered = BytesIO()
+        image.save(buffered, format=pil_format, quality=int(quality or 90))
+        return buffered.getvalue()
+
+def generate_imagen_images(prompt, provider, aspect_ratio="1:1", image_size="1024", person_generation="allow_adult",
+                           number_of_images=1, output_format="png", output_quality=None):
+    """Generates up to 4 images in one Google Imagen call and returns them as base64 data URLs.
+
+    The provider's encoded bytes are passed through without decoding; only WebP
+    output (which Imagen can't produce) is transcoded.
+    """
     if not genai_client:
         raise ConnectionError("Google GenAI client not initialized.")
 
@@ -291,9 +1102,13 @@ def generate_with_imagen(prompt, provider, aspect_ratio="1:1", image_size="1024"
     if not model:
         raise ValueError(f"Unknown Imagen provider: {provider}")
 
+    mime_type = IMAGE_OUTPUT_FORMATS.get((output_format or "png").lower())
+    if not mime_type:
+        raise ValueError(f"Unsupported output_format: {output_format}. Use png, jpeg or webp.")
+
     # Configure generation parameters
     config_params = {
-        "number_of_images": number_of_images,
+        "number_of_images": min(number_of_images, IMAGEN_MAX_BATCH),
         "aspect_ratio": aspect_ratio,
         "person_generation": person_generation
     }
@@ -306,33 +1121,54 @@ def generate_with_imagen(prompt, provider, aspect_ratio="1:1", image_size="1024"
         else:
             config_params["image_size"] = "1K"
 
+    # Imagen encodes JPEG natively; WebP is transcoded from its lossless PNG
+    if mime_type == "image/jpeg":
+        config_params["output_mime_type"] = "image/jpeg"
+        if output_quality:
+            config_params["output_compression_quality"] = int(output_quality)
+
+    from google.genai import types
+
     try:
         # Generate images
-        response = genai_client.models.generate_images(
-            model=model,
-            prompt=prompt,
-            config=types.GenerateImagesConfig(**config_params)
-        )
+        with profile_span("imagen.generate", model=model):
+            response = genai_client.models.generate_images(
+                model=model,
+                prompt=prompt,
+                config=types.GenerateImagesConfig(**config_params)
+            )
 
-        # Get the first generated image
         if not response.generated_images:
             raise ValueError("No images generated by Imagen API")
 
-        generated_image = response.generated_images[0]
-
-        # Convert PIL Image to base64
-        buffered = BytesIO()
-        generated_image.image.save(buffered, format="PNG")
-        img_bytes = buffered.getvalue()
-        img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-
-        return f"data:image/png;base64,{img_base64}"
+        image_urls = []
+        with profile_span("imagen.encode", images=len(response.generated_images)):
+            for generated_image in response.generated_images:
+                img_bytes = generated_image.image.image_bytes
+                img_mime_type = generated_image.image.mime_type or "image/png"
+                if not img_bytes:
+                    raise ValueError("Imagen API returned an image without inline bytes")
+                if mime_type == "image/webp":
+                    img_bytes = _transcode_image(img_bytes, "WEBP", output_quality)
+                    img_mime_type = "image/webp"
+                img_base64 = base64.b64encode(img_bytes).decode('utf-8')
+                image_urls.append(f"data:{img_mime_type};base64,{img_base64}")
+
+        return image_urls
 
     except Exception as e:
         raise RuntimeError(f"Imagen generation failed: {str(e)}")
 
-def generate_with_fal(prompt, provider, **kwargs):
-    """Generates an image using fal.ai models and returns the image URL."""
+def generate_with_imagen(prompt, provider, aspect_ratio="1:1", image_size="1024", person_generation="allow_adult",
+                         number_of_images=1, output_format="png", output_quality=None):
+    """Generates an image with Google Imagen (3 or 4) and returns a base64 data URL."""
+    return generate_imagen_images(
+        prompt, provider, aspect_ratio, image_size, person_generation,
+        number_of_images, output_format, output_quality
+    )[0]
+
+def submit_fal_images(prompt, provider, **kwargs):
+    """Submits a request to the fal.ai queue and returns a Future for the list of image URLs."""
     if not FAL_KEY:
         raise ConnectionError("FAL_KEY not configured.")
 
@@ -421,92 +1257,2650 @@ def generate_with_fal(prompt, provider, **kwargs):
             if kwargs.get("background"):
                 arguments["background"] = kwargs["background"]
 
-        # Submit request and wait for result
-        result = fal_client.subscribe(
-            model_id,
-            arguments=arguments,
-            with_logs=False
-        )
+        # Submit to the fal.ai queue; the poll scheduler waits for completion
+        session = get_http_session("fal")
+        headers = {"Authorization": f"Key {FAL_KEY}", "Content-Type": "application/json"}
+        submit_response = session.post(f"{FAL_QUEUE_URL}{model_id}", headers=headers, json=arguments, timeout=60)
+        submit_response.raise_for_status()
+        queued = submit_response.json()
+        status_url = queued["status_url"]
+        response_url = queued["response_url"]
+        cancel_url = queued.get("cancel_url")
+
+    except Exception as e:
+        raise RuntimeError(f"fal.ai {provider} generation failed: {str(e)}")
 
-        # Extract image URL from result
+    def poll():
+        try:
+            status_response = session.get(status_url, headers=headers, timeout=30)
+            status_response.raise_for_status()
+            if status_response.json().get("status") != "COMPLETED":
+                return False, None
+
+            result_response = session.get(response_url, headers=headers, timeout=60)
+            result_response.raise_for_status()
+            result = result_response.json()
+        except Exception as e:
+            raise RuntimeError(f"fal.ai {provider} generation failed: {str(e)}")
+
+        # Extract image URLs from result
         if result and "images" in result and len(result["images"]) > 0:
-            return result["images"][0].get("url")
-        else:
-            raise ValueError(f"No images returned from {provider}")
+            return True, [image.get("url") for image in result["images"]]
+        raise RuntimeError(f"fal.ai {provider} generation failed: No images returned from {provider}")
+
+    def cancel(future):
+        # Best effort: fal.ai only cancels requests that are still in the queue
+        if future.cancelled() and cancel_url:
+            try:
+                session.put(cancel_url, headers=headers, timeout=10)
+            except Exception as e:
+                print(f"⚠️ fal.ai cancel failed for {provider}: {e}")
 
+    future = get_poll_scheduler().submit(f"fal:{provider}", poll, timeout=FAL_POLL_TIMEOUT)
+    future.add_done_callback(cancel)
+    return future
+
+def submit_fal_job(prompt, provider, **kwargs):
+    """Submits a request to the fal.ai queue and returns a Future for the first image URL."""
+    return chain_future(submit_fal_images(prompt, provider, **kwargs), lambda image_urls: image_urls[0])
+
+def generate_with_fal(prompt, provider, **kwargs):
+    """Generates an image using fal.ai models and returns the image URL."""
+    return submit_fal_job(prompt, provider, **kwargs).result()
+
+# ==============================================================================
+# PROVIDER RATE LIMITING (shared across gateway instances)
+# ==============================================================================
+#
+# One token bucket per backend lives in KV, so every gateway instance draws from
+# the same requests-per-second budget. An in-flight set (leases with an expiry, so
+# a crashed instance can't leak slots) caps concurrent calls. Tasks wait up to
+# RATE_LIMIT_MAX_WAIT seconds for capacity instead of failing. A provider 429
+# pauses the bucket for its Retry-After and the task is retried once; a 429 on
+# a status poll (BFL, fal.ai) pauses it the same way (see PollScheduler).
+
+def _rate_limit(backend, rps, burst, max_in_flight):
+    prefix = f"RATE_LIMIT_{backend.upper()}"
+    return {
+        "rps": float(os.environ.get(f"{prefix}_RPS", rps)),
+        "burst": float(os.environ.get(f"{prefix}_BURST", burst)),
+        "max_in_flight": int(os.environ.get(f"{prefix}_MAX_IN_FLIGHT", max_in_flight))
+    }
+
+PROVIDER_RATE_LIMITS = {
+    "openai": _rate_limit("openai", 5, 10, 20),
+    "bfl": _rate_limit("bfl", 10, 20, 24),
+    "gemini": _rate_limit("gemini", 10, 20, 40),
+    "reve": _rate_limit("reve", 5, 10, 20),
+    "minimax": _rate_limit("minimax", 5, 10, 20),
+    "google": _rate_limit("google", 5, 10, 20),
+    "fal": _rate_limit("fal", 10, 20, 40)
+}
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", 10))
+RATE_LIMIT_LEASE_SECONDS = 300
+
+class RateLimitTimeout(TimeoutError):
+    """Raised when no rate-limit capacity frees up within RATE_LIMIT_MAX_WAIT."""
+
+# KEYS: bucket hash, in-flight zset
+# ARGV: now, rps, burst, max_in_flight, lease_id, lease_expires_at
+# Returns {1, "0"} when acquired, else {0, seconds_to_wait}
+RATE_LIMIT_ACQUIRE_LUA = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local max_in_flight = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'paused_until')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+local paused_until = tonumber(bucket[3]) or 0
+
+if paused_until > now then
+    return {0, tostring(paused_until - now)}
+end
+
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+
+if max_in_flight > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+    if redis.call('ZCARD', KEYS[2]) >= max_in_flight then
+        return {0, '0.25'}
+    end
+end
+
+if tokens < 1 then
+    return {0, tostring((1 - tokens) / rate)}
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1))
+if max_in_flight > 0 then
+    redis.call('ZADD', KEYS[2], ARGV[6], ARGV[5])
+    redis.call('EXPIRE', KEYS[2], 3600)
+end
+return {1, '0'}
+"""
+
+# KEYS: bucket hash. ARGV: paused_until. Empties the bucket until the provider's Retry-After passes.
+RATE_LIMIT_PAUSE_LUA = """
+local paused_until = tonumber(ARGV[1])
+local current = tonumber(redis.call('HGET', KEYS[1], 'paused_until')) or 0
+if paused_until > current then
+    redis.call('HSET', KEYS[1], 'paused_until', tostring(paused_until), 'tokens', '0', 'ts', tostring(paused_until))
+    redis.call('EXPIRE', KEYS[1], 3600)
+end
+return 1
+"""
+
+def acquire_provider_slot(backend):
+    """Waits for a rate-limit token and in-flight slot. Returns a lease id (None if unlimited)."""
+    limits = PROVIDER_RATE_LIMITS.get(backend)
+    if not kv or not limits:
+        return None
+
+    lease_id = uuid.uuid4().hex
+    deadline = time.time() + RATE_LIMIT_MAX_WAIT
+    acquire = kv.register_script(RATE_LIMIT_ACQUIRE_LUA)
+    while True:
+        now = time.time()
+        try:
+            allowed, wait = acquire(
+                keys=[f"ratelimit:{backend}", f"ratelimit:{backend}:inflight"],
+                args=[now, limits["rps"], limits["burst"], limits["max_in_flight"], lease_id, now + RATE_LIMIT_LEASE_SECONDS]
+            )
+        except Exception as e:
+            # Fail open: a KV outage shouldn't take image generation down with it
+            print(f"Warning: rate limiter unavailable for {backend}: {e}")
+            return None
+
+        if int(allowed) == 1:
+            return lease_id
+
+        wait = float(_decode(wait))
+        if now + wait > deadline:
+            raise RateLimitTimeout(f"Rate limit for {backend}: no capacity within {RATE_LIMIT_MAX_WAIT:g} seconds.")
+        time.sleep(min(wait, 1.0) + random.uniform(0, 0.05))
+
+def release_provider_slot(backend, lease_id):
+    """Frees an in-flight slot taken by acquire_provider_slot."""
+    if not kv or not lease_id:
+        return
+    try:
+        kv.zrem(f"ratelimit:{backend}:inflight", lease_id)
     except Exception as e:
-        raise RuntimeError(f"fal.ai {provider} generation failed: {str(e)}")
+        print(f"Warning: could not release rate limit slot for {backend}: {e}")
+
+def provider_retry_after(error):
+    """Returns the Retry-After seconds if error (or its cause) is a provider 429, else None."""
+    while error is not None:
+        response = getattr(error, "response", None)
+        status_code = getattr(response, "status_code", None) or getattr(error, "status_code", None) or getattr(error, "code", None)
+        if status_code == 429:
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            try:
+                return max(float(retry_after), 0.0)
+            except (TypeError, ValueError):
+                pass
+            try:
+                return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                return 1.0
+        error = error.__cause__ or error.__context__
+    return None
+
+def pause_provider(backend, retry_after):
+    """Empties a backend's bucket for retry_after seconds (on every instance)."""
+    if not kv or backend not in PROVIDER_RATE_LIMITS:
+        return
+    try:
+        kv.register_script(RATE_LIMIT_PAUSE_LUA)(keys=[f"ratelimit:{backend}"], args=[time.time() + retry_after])
+        print(f"⏸️  {backend} rate limited by provider, pausing for {retry_after:g}s")
+    except Exception as e:
+        print(f"Warning: could not pause rate limiter for {backend}: {e}")
+
+def call_with_rate_limit(backend, call):
+    """Runs call() under a rate-limit lease. Returns (lease_id, result); the caller releases the lease.
+
+    A provider 429 pauses the shared bucket and the call is retried once.
+    """
+    for attempt in range(2):
+        lease_id = acquire_provider_slot(backend)
+        try:
+            return lease_id, call()
+        except Exception as e:
+            release_provider_slot(backend, lease_id)
+            retry_after = provider_retry_after(e)
+            if retry_after is None:
+                raise
+            pause_provider(backend, retry_after)
+            if attempt == 1 or retry_after > RATE_LIMIT_MAX_WAIT:
+                raise
 
 # ==============================================================================
-# SYNCHRONOUS JOB PROCESSING (Fixed for Vercel)
+# PROVIDER CIRCUIT BREAKERS (shared across gateway instances)
 # ==============================================================================
+#
+# Each backend has a breaker in KV (circuit:{backend}) fed by rolling 10-second
+# outcome buckets (circuit:{backend}:w:{bucket}). When the share of failed or
+# slow calls in the window crosses CIRCUIT_FAILURE_THRESHOLD the breaker opens
+# and tasks for that backend fail immediately. After CIRCUIT_OPEN_SECONDS it is
+# half-open: a few probe calls go through, and their outcome closes or re-opens it.
+# Every state change bumps the breaker's generation. A call carries the
+# generation it was admitted under, and a result from an earlier generation (a
+# slow call started before the breaker tripped) is ignored, so only a real
+# probe can close or re-open it.
+
+CIRCUIT_WINDOW_SECONDS = int(os.environ.get("CIRCUIT_WINDOW_SECONDS", 60))
+CIRCUIT_BUCKET_SECONDS = 10
+CIRCUIT_MIN_CALLS = int(os.environ.get("CIRCUIT_MIN_CALLS", 10))
+CIRCUIT_FAILURE_THRESHOLD = float(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 0.5))
+CIRCUIT_OPEN_SECONDS = int(os.environ.get("CIRCUIT_OPEN_SECONDS", 30))
+CIRCUIT_HALF_OPEN_PROBES = int(os.environ.get("CIRCUIT_HALF_OPEN_PROBES", 2))
+CIRCUIT_STATE_CACHE_SECONDS = 1.0
+
+# KEYS: breaker hash. ARGV: generation the caller saw, new state, now
+# Returns 0 (and changes nothing) if the breaker has moved on since.
+CIRCUIT_TRANSITION_LUA = """
+if tonumber(redis.call('HGET', KEYS[1], 'generation') or '0') ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'state', ARGV[2], 'opened_at', ARGV[3], 'probes', 0)
+redis.call('HINCRBY', KEYS[1], 'generation', 1)
+redis.call('EXPIRE', KEYS[1], 86400)
+return 1
+"""
+
+# Calls slower than this count as failures (polled backends legitimately take longer)
+CIRCUIT_SLOW_CALL_SECONDS = {
+    "openai": 45, "gemini": 45, "reve": 45, "minimax": 45, "google": 45,
+    "bfl": 75, "fal": 120
+}
 
-def process_job_sync(tasks):
-    """Processes all tasks synchronously and returns results immediately."""
-    results = []
-    total_tasks = len(tasks)
-    
-    for i, task in enumerate(tasks):
-        prompt = task.get("prompt")
-        provider = task.get("provider", "dalle").lower()
-        result_item = {"prompt": prompt, "provider": provider}
+_circuit_state_cache = TTLCache(100, CIRCUIT_STATE_CACHE_SECONDS)
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+def is_provider_fault(error):
+    """True if an error indicates the provider is unhealthy (not a bad request or local config)."""
+    if isinstance(error, (RateLimitTimeout, CircuitOpenError, ValueError)) or type(error) is ConnectionError:
+        return False
+    while error is not None:
+        response = getattr(error, "response", None)
+        status_code = getattr(response, "status_code", None) or getattr(error, "status_code", None) or getattr(error, "code", None)
+        if isinstance(status_code, int) and 400 <= status_code < 500:
+            return False
+        error = error.__cause__ or error.__context__
+    return True
+
+def _circuit_state(backend):
+    """Breaker hash for a backend, cached locally for a second."""
+    circuit = _circuit_state_cache.get(backend)
+    if circuit is None:
+        circuit = _hgetall_decoded(f"circuit:{backend}")
+        circuit = {
+            "state": circuit.get("state", "closed"),
+            "opened_at": float(circuit.get("opened_at", 0)),
+            "generation": int(circuit.get("generation", 0))
+        }
+        _circuit_state_cache.set(backend, circuit)
+    return circuit
+
+def check_circuit(backend):
+    """Raises CircuitOpenError if calls to backend should fail fast right now.
+
+    Otherwise returns the call's ticket for record_provider_outcome: (breaker
+    generation, whether it is a half-open probe), or None without a breaker.
+    """
+    if not kv:
+        return None
+    try:
+        circuit = _circuit_state(backend)
+        if circuit["state"] != "open":
+            return circuit["generation"], False
+
+        retry_in = circuit["opened_at"] + CIRCUIT_OPEN_SECONDS - time.time()
+        if retry_in <= 0:
+            # Half-open: let a limited number of probe calls through
+            if kv.hincrby(f"circuit:{backend}", "probes", 1) <= CIRCUIT_HALF_OPEN_PROBES:
+                return circuit["generation"], True
+            retry_in = 1
+    except Exception as e:
+        print(f"Warning: circuit breaker unavailable for {backend}: {e}")
+        return None
+
+    raise CircuitOpenError(f"{backend} is temporarily unavailable (circuit open after repeated failures). Retry in {int(retry_in) + 1}s.")
+
+def _circuit_bucket_keys(backend, now):
+    current = int(now // CIRCUIT_BUCKET_SECONDS)
+    first = current - CIRCUIT_WINDOW_SECONDS // CIRCUIT_BUCKET_SECONDS + 1
+    return [f"circuit:{backend}:w:{bucket}" for bucket in range(first, current + 1)]
+
+def _set_circuit(backend, state, generation):
+    """Moves the breaker to state unless it has left generation already (another outcome got there first)."""
+    changed = kv.register_script(CIRCUIT_TRANSITION_LUA)(
+        keys=[f"circuit:{backend}"], args=[generation, state, time.time()]
+    )
+    if not int(changed):
+        return
+    if state == "closed":
+        # Start the recovered backend with a clean window
+        kv.delete(*_circuit_bucket_keys(backend, time.time()))
+    _circuit_state_cache.delete(backend)
+    print(f"{'🔴' if state == 'open' else '🟢'} Circuit for {backend} is now {state}")
+
+def _circuit_window(backend, now=None):
+    """Sums the outcome buckets in the rolling window."""
+    pipe = kv.pipeline()
+    for bucket_key in _circuit_bucket_keys(backend, now or time.time()):
+        pipe.hgetall(bucket_key)
+
+    window = {"calls": 0, "failures": 0, "slow": 0, "latency_ms": 0.0}
+    for bucket in pipe.execute():
+        for field, value in bucket.items():
+            window[_decode(field)] += float(value)
+    return window
+
+def record_provider_outcome(backend, latency, error=None, ticket=None):
+    """Feeds a provider call's outcome into its breaker, opening or closing it as needed.
+
+    ticket is what check_circuit returned when the call was admitted.
+    """
+    if not kv or ticket is None:
+        return
+    generation, probe = ticket
+    slow = latency > CIRCUIT_SLOW_CALL_SECONDS.get(backend, 60)
+    failed = (error is not None and is_provider_fault(error)) or slow
+
+    try:
+        circuit = _hgetall_decoded(f"circuit:{backend}")
+        if int(circuit.get("generation", 0)) != generation:
+            # Admitted before the breaker last changed state: says nothing about it now
+            return
+
+        now = time.time()
+        bucket_key = f"circuit:{backend}:w:{int(now // CIRCUIT_BUCKET_SECONDS)}"
+        pipe = kv.pipeline()
+        pipe.hincrby(bucket_key, "calls", 1)
+        pipe.hincrby(bucket_key, "failures", int(failed))
+        pipe.hincrby(bucket_key, "slow", int(slow))
+        pipe.hincrbyfloat(bucket_key, "latency_ms", latency * 1000)
+        pipe.expire(bucket_key, CIRCUIT_WINDOW_SECONDS + CIRCUIT_BUCKET_SECONDS)
+        pipe.execute()
+
+        if circuit.get("state") == "open":
+            # Only half-open probes decide
+            if probe:
+                _set_circuit(backend, "open" if failed else "closed", generation)
+        elif failed:
+            window = _circuit_window(backend, now)
+            if window["calls"] >= CIRCUIT_MIN_CALLS and window["failures"] / window["calls"] >= CIRCUIT_FAILURE_THRESHOLD:
+                _set_circuit(backend, "open", generation)
+    except Exception as e:
+        print(f"Warning: could not record outcome for {backend}: {e}")
+
+def get_provider_health():
+    """Snapshot of every backend's breaker state and rolling-window health."""
+    health = {}
+    for backend in PROVIDER_CONCURRENCY:
+        window = _circuit_window(backend)
+        circuit = _hgetall_decoded(f"circuit:{backend}")
+        state = circuit.get("state", "closed")
+        retry_in = 0
+        if state == "open":
+            retry_in = max(float(circuit.get("opened_at", 0)) + CIRCUIT_OPEN_SECONDS - time.time(), 0)
+            if retry_in == 0:
+                state = "half_open"
+
+        calls = window["calls"]
+        failure_rate = window["failures"] / calls if calls else 0.0
+        slow_rate = window["slow"] / calls if calls else 0.0
+        health[backend] = {
+            "state": state,
+            "retry_in_seconds": round(retry_in, 1),
+            "calls": int(calls),
+            "failures": int(window["failures"]),
+            "slow_calls": int(window["slow"]),
+            "failure_rate": round(failure_rate, 3),
+            "avg_latency_ms": round(window["latency_ms"] / calls, 1) if calls else None,
+            "health_score": 0.0 if state == "open" else round(1 - failure_rate, 3)
+        }
+    return health
+
+# ==============================================================================
+# BLOB STORAGE (offloading inline images)
+# ==============================================================================
+#
+# Reve, Gemini and Imagen return base64 data URLs. When a blob store is
+# configured and a task doesn't ask for "inline": true, the decoded bytes are
+# written once (content-addressed) to the store and the task gets a short URL
+# instead. Backends:
+#   inline - (default) no offloading, keep data URLs
+#   s3     - any S3-compatible bucket (AWS, MinIO, R2...), returned as presigned URLs
+#   local  - files under BLOB_STORE_DIR, served by /v1/blobs/<key> with an HMAC
+#            signature. Only for a single long-running host: every gateway
+#            instance and worker must share the directory and the secret.
+
+BLOB_STORE_BACKEND = os.environ.get("BLOB_STORE_BACKEND", "inline").lower()
+BLOB_STORE_DIR = os.environ.get("BLOB_STORE_DIR", "/tmp/big-blobs")
+BLOB_URL_TTL = int(os.environ.get("BLOB_URL_TTL", 86400))
+BLOB_S3_BUCKET = os.environ.get("BLOB_S3_BUCKET")
+BLOB_S3_ENDPOINT_URL = os.environ.get("BLOB_S3_ENDPOINT_URL")
+BLOB_S3_REGION = os.environ.get("BLOB_S3_REGION", "us-east-1")
+BLOB_S3_PUBLIC_URL = os.environ.get("BLOB_S3_PUBLIC_URL")
+API_URL = os.environ.get("API_URL", "").rstrip("/")
+
+BLOB_SIGNING_SECRET = os.environ.get("BLOB_SIGNING_SECRET")
+# Local blobs would be missing (or fail their signature) on any other instance, so
+# without a shared secret and an absolute URL images stay inline
+if BLOB_STORE_BACKEND == "local" and os.environ.get("VERCEL"):
+    print("Warning: BLOB_STORE_BACKEND=local is not shared between Vercel instances. Returning images inline.")
+    BLOB_STORE_BACKEND = "inline"
+elif BLOB_STORE_BACKEND == "local" and not (BLOB_SIGNING_SECRET and API_URL):
+    print("Warning: BLOB_STORE_BACKEND=local needs BLOB_SIGNING_SECRET and API_URL. Returning images inline.")
+    BLOB_STORE_BACKEND = "inline"
+
+BLOB_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+    "image/gif": "gif"
+}
+BLOB_CONTENT_TYPES = {ext: mime for mime, ext in BLOB_EXTENSIONS.items()}
+
+def sign_blob_path(key, expires):
+    """HMAC signature authorizing a download of key until expires."""
+    message = f"{key}:{expires}".encode()
+    return hmac.new(BLOB_SIGNING_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+class LocalBlobStore:
+    """Stores blobs on the local filesystem and returns signed /v1/blobs paths."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
 
+    def put(self, key, data, content_type):
+        path = self.path_for(key)
+        if not path.exists():
+            # Write to a temp file first so readers never see a partial blob
+            tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+
+        expires = int(time.time()) + BLOB_URL_TTL
+        return f"{API_URL}/v1/blobs/{key}?expires={expires}&signature={sign_blob_path(key, expires)}"
+
+    def path_for(self, key):
+        return self.root / key
+
+class S3BlobStore:
+    """Stores blobs in an S3-compatible bucket and returns presigned (or public) URLs."""
+
+    def __init__(self, bucket, endpoint_url=None, region=None, public_url=None):
         try:
-            print(f"Processing task {i+1}/{total_tasks} with provider {provider}")
-            image_url = None
-            
-            if provider == "dalle":
-                image_url = generate_with_dalle(prompt, task.get("size", "1024x1024"))
-            elif provider == "reve":
-                image_url = generate_with_reve(prompt, task.get("aspect_ratio", "1:1"))
-            elif provider == "gemini":
-                image_url = generate_with_gemini(prompt)
-            elif provider == "minimax":
-                image_url = generate_with_minimax(prompt, task.get("aspect_ratio", "1:1"))
-            elif provider.startswith("flux"):
-                model_map = {"flux-kontext": "flux-kontext-pro", "flux-dev": "flux-dev"}
-                model_endpoint = model_map.get(provider)
-                if not model_endpoint:
-                    raise ValueError(f"Unknown FLUX model: {provider}")
-                image_url = generate_with_bfl(prompt, model_endpoint, task.get("aspect_ratio", "1:1"))
-            elif provider.startswith("imagen"):
-                image_url = generate_with_imagen(
-                    prompt=prompt,
-                    provider=provider,
-                    aspect_ratio=task.get("aspect_ratio", "1:1"),
-                    image_size=task.get("image_size", "1024"),
-                    person_generation=task.get("person_generation", "allow_adult"),
-                    number_of_images=1
-                )
-            elif provider in ["seedream-4", "qwen-image", "seedream-3", "ideogram-v3", "gpt-image-1"]:
-                # fal.ai providers - pass all task parameters as kwargs
-                fal_params = {k: v for k, v in task.items() if k not in ["prompt", "provider"]}
-                image_url = generate_with_fal(prompt, provider, **fal_params)
+            import boto3
+        except ImportError:
+            raise ConnectionError("boto3 is required for BLOB_STORE_BACKEND=s3 (pip install boto3).")
+        if not bucket:
+            raise ConnectionError("BLOB_S3_BUCKET not configured.")
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+
+    def put(self, key, data, content_type):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=content_type)
+        if self.public_url:
+            return f"{self.public_url}/{key}"
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=min(BLOB_URL_TTL, 7 * 86400)
+        )
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+def get_blob_store():
+    """Returns the configured blob store (None when offloading is disabled)."""
+    global _blob_store
+    if BLOB_STORE_BACKEND == "inline":
+        return None
+    if _blob_store is None:
+        with _blob_store_lock:
+            if _blob_store is None:
+                if BLOB_STORE_BACKEND == "s3":
+                    _blob_store = S3BlobStore(BLOB_S3_BUCKET, BLOB_S3_ENDPOINT_URL, BLOB_S3_REGION, BLOB_S3_PUBLIC_URL)
+                else:
+                    _blob_store = LocalBlobStore(BLOB_STORE_DIR)
+    return _blob_store
+
+def offload_image(image_url):
+    """Replaces a base64 data URL with a blob store URL. Other URLs are returned unchanged."""
+    if not image_url or not image_url.startswith("data:"):
+        return image_url
+
+    try:
+        blob_store = get_blob_store()
+        if not blob_store:
+            return image_url
+
+        with profile_span("blob_offload", bytes=len(image_url)):
+            header, encoded = image_url.split(",", 1)
+            content_type = header[len("data:"):].split(";")[0] or "image/png"
+            data = base64.b64decode(encoded)
+            key = f"{hashlib.sha256(data).hexdigest()[:40]}.{BLOB_EXTENSIONS.get(content_type, 'bin')}"
+            return blob_store.put(key, data, content_type)
+    except Exception as e:
+        # The image itself is fine; fall back to returning it inline
+        print(f"Warning: blob offload failed, returning inline image: {e}")
+        return image_url
+
+# ==============================================================================
+# GENERATION CACHE
+# ==============================================================================
+#
+# Identical (provider, normalized params) requests from the same user are served
+# from cache instead of paying the provider again. Two tiers: an in-process LRU
+# and Redis (gencache:{hash}), both with TTL. Tasks opt out with "no_cache": true;
+# "seed" is part of the key, so a new seed always yields a fresh generation.
+# Inline data URLs larger than GEN_CACHE_KV_MAX_BYTES stay in the local tier only,
+# so big images can't push rate-limit, ledger and queue keys out of Redis.
+
+GEN_CACHE_TTL = int(os.environ.get("GEN_CACHE_TTL", 1800))
+GEN_CACHE_MAX_ENTRIES = int(os.environ.get("GEN_CACHE_MAX_ENTRIES", 1000))
+GEN_CACHE_MAX_BYTES = int(os.environ.get("GEN_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+GEN_CACHE_KV_MAX_BYTES = int(os.environ.get("GEN_CACHE_KV_MAX_BYTES", 256 * 1024))
+# Backends whose image URLs expire: BFL result.sample delivery URLs last about 10 minutes
+GEN_CACHE_BACKEND_TTL = {"bfl": 300}
+# Share of the provider cost charged for a cache hit (0 = free)
+CACHE_HIT_CREDIT_RATIO = float(os.environ.get("CACHE_HIT_CREDIT_RATIO", 0))
+
+# Task fields each connector actually uses; anything else doesn't change the image
+PROVIDER_CACHE_PARAMS = {
+    "dalle": {"size": "1024x1024"},
+    "reve": {"aspect_ratio": "1:1"},
+    "gemini": {},
+    "minimax": {"aspect_ratio": "1:1"},
+    "flux-kontext": {"aspect_ratio": "1:1"},
+    "flux-dev": {"aspect_ratio": "1:1"},
+    "imagen-3": {"aspect_ratio": "1:1", "image_size": "1024", "person_generation": "allow_adult", "output_format": "png", "output_quality": None},
+    "imagen-4": {"aspect_ratio": "1:1", "image_size": "1024", "person_generation": "allow_adult", "output_format": "png", "output_quality": None},
+    "imagen-4-ultra": {"aspect_ratio": "1:1", "image_size": "1024", "person_generation": "allow_adult", "output_format": "png", "output_quality": None},
+    "imagen-4-fast": {"aspect_ratio": "1:1", "image_size": "1024", "person_generation": "allow_adult", "output_format": "png", "output_quality": None}
+}
+# Fields that never affect the generated image (fal.ai tasks pass everything else through)
+CACHE_IGNORED_FIELDS = {"prompt", "provider", "no_cache", "openai_api_key"}
+# Fields that are part of the key for every provider
+CACHE_KEY_EXTRA_FIELDS = {"seed", "inline"}
+
+_generation_cache = TTLCache(GEN_CACHE_MAX_ENTRIES, GEN_CACHE_TTL, max_bytes=GEN_CACHE_MAX_BYTES)
+
+def generation_cache_key(task, scope=None):
+    """Canonical hash of a task's provider and normalized parameters, or None if not cacheable."""
+    # Hedged tasks may be served by any provider in their chain, so they are never cached
+    if task.get("no_cache") or task.get("fallback"):
+        return None
+
+    provider = task.get("provider", "dalle").lower()
+    if provider in PROVIDER_CACHE_PARAMS:
+        params = {name: task.get(name) or default for name, default in PROVIDER_CACHE_PARAMS[provider].items()}
+        params.update({name: task[name] for name in CACHE_KEY_EXTRA_FIELDS if task.get(name) is not None})
+    else:
+        params = {k: v for k, v in task.items() if k not in CACHE_IGNORED_FIELDS and v is not None}
+
+    canonical = json.dumps({
+        "scope": scope,
+        "provider": provider,
+        "prompt": (task.get("prompt") or "").strip(),
+        "params": params
+    }, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def generation_cache_get_many(cache_keys):
+    """Looks up cached image URLs in the local tier, then Redis (one MGET). Returns {cache_key: image_url} for hits."""
+    hits = {}
+    for cache_key in cache_keys:
+        image_url = _generation_cache.get(cache_key)
+        if image_url:
+            hits[cache_key] = image_url
+
+    missing = [cache_key for cache_key in cache_keys if cache_key not in hits]
+    if kv and missing:
+        try:
+            for cache_key, cached in zip(missing, kv.mget([f"gencache:{cache_key}" for cache_key in missing])):
+                if cached:
+                    image_url = _decode(cached)
+                    _generation_cache.set(cache_key, image_url, size=len(image_url))
+                    hits[cache_key] = image_url
+        except Exception as e:
+            print(f"Warning: generation cache lookup failed: {e}")
+    return hits
+
+def generation_cache_put(cache_key, image_url, provider=None):
+    """Stores a generated image URL in both cache tiers (large inline images only locally)."""
+    if not image_url:
+        return
+    ttl = min(GEN_CACHE_TTL, GEN_CACHE_BACKEND_TTL.get(get_provider_backend(provider), GEN_CACHE_TTL))
+    _generation_cache.set(cache_key, image_url, size=len(image_url), ttl=ttl)
+    if image_url.startswith("data:") and len(image_url) > GEN_CACHE_KV_MAX_BYTES:
+        return
+    if kv:
+        try:
+            kv.setex(f"gencache:{cache_key}", ttl, image_url)
+        except Exception as e:
+            print(f"Warning: generation cache store failed: {e}")
+
+# ==============================================================================
+# WRITE-BEHIND PIPELINE (batched database writes off the request path)
+# ==============================================================================
+#
+# Rows are appended to a Redis stream (writebehind:{name}) and written by a
+# background flusher in batches of WRITE_BEHIND_BATCH_SIZE, or whatever has
+# arrived after WRITE_BEHIND_FLUSH_INTERVAL seconds. All instances read the
+# stream through one consumer group and acknowledge rows once written, so rows
+# left pending by an instance that died mid-flush are claimed by another after
+# WRITE_BEHIND_CLAIM_IDLE seconds. Without KV, rows wait in a bounded in-memory
+# buffer (the oldest are dropped if the database can't keep up). Failed writes
+# are retried with exponential backoff, and the flusher backs off entirely while
+# the database is down. Pending rows are flushed once more at exit.
+
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 200))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL", 2))
+WRITE_BEHIND_MAX_BUFFER = int(os.environ.get("WRITE_BEHIND_MAX_BUFFER", 10000))
+WRITE_BEHIND_STREAM_MAXLEN = 100000
+WRITE_BEHIND_CLAIM_IDLE = 60
+WRITE_BEHIND_MAX_ATTEMPTS = 4
+WRITE_BEHIND_MAX_BACKOFF = 30
+WRITE_BEHIND_GROUP = "flushers"
+
+class WriteBehindPipeline:
+    """Queues rows and hands them to write_rows(rows) in batches from a background thread.
+
+    write_rows must raise on failure. A batch that keeps failing is retried row
+    by row, so a single bad row is dropped instead of blocking the pipeline.
+    """
+
+    def __init__(self, name, write_rows):
+        self.name = name
+        self.write_rows = write_rows
+        self.stream_key = f"writebehind:{name}"
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.dropped = 0
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._group_ready = False
+
+    def submit(self, row):
+        """Queues a row for writing; never waits on the database."""
+        self._start()
+        if kv:
+            try:
+                kv.xadd(self.stream_key, {"row": json.dumps(row)}, maxlen=WRITE_BEHIND_STREAM_MAXLEN, approximate=True)
+                return
+            except Exception as e:
+                print(f"⚠️ Could not queue {self.name} row in KV, buffering in memory: {e}")
+
+        with self._lock:
+            if len(self._buffer) >= WRITE_BEHIND_MAX_BUFFER:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(row)
+            if len(self._buffer) >= WRITE_BEHIND_BATCH_SIZE:
+                self._wakeup.set()
+
+    def pending(self):
+        """Rows waiting in this process's memory buffer."""
+        return len(self._buffer)
+
+    def drain(self):
+        """Writes everything that can be collected right now, one attempt per batch."""
+        while True:
+            items = self._collect(WRITE_BEHIND_BATCH_SIZE, 0)
+            if not items:
+                return
+            try:
+                self.write_rows([row for row, _ in items])
+                self._ack([entry_id for _, entry_id in items if entry_id])
+            except Exception as e:
+                print(f"⚠️ Could not drain {self.name}: {e}")
+                self._requeue(items)
+                return
+
+    def _start(self):
+        if self._thread:
+            return
+        with self._lock:
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.name}", daemon=True)
+                self._thread.start()
+                atexit.register(self.drain)
+
+    def _run(self):
+        while True:
+            try:
+                items = []
+                deadline = time.time() + WRITE_BEHIND_FLUSH_INTERVAL
+                while len(items) < WRITE_BEHIND_BATCH_SIZE and time.time() < deadline:
+                    items.extend(self._collect(WRITE_BEHIND_BATCH_SIZE - len(items), deadline - time.time()))
+                if items and not self._flush(items):
+                    time.sleep(WRITE_BEHIND_MAX_BACKOFF)
+            except Exception as e:
+                print(f"⚠️ Write-behind {self.name} flusher error: {e}")
+                time.sleep(WRITE_BEHIND_FLUSH_INTERVAL)
+
+    def _collect(self, count, timeout):
+        """Returns up to count (row, stream_entry_id) pairs, waiting up to timeout seconds for the first."""
+        with self._lock:
+            items = [(self._buffer.popleft(), None) for _ in range(min(count, len(self._buffer)))]
+            self._wakeup.clear()
+
+        if not kv:
+            if not items and timeout > 0:
+                self._wakeup.wait(timeout)
+            return items
+
+        try:
+            self._ensure_group()
+            # Rows left pending by flushers that died (or gave up) mid-write
+            claimed = kv.xautoclaim(self.stream_key, WRITE_BEHIND_GROUP, self.consumer,
+                                    WRITE_BEHIND_CLAIM_IDLE * 1000, "0-0", count=count - len(items))
+            entries = list(claimed[1])
+            if len(items) + len(entries) < count:
+                block = max(int(timeout * 1000), 1) if timeout > 0 and not items and not entries else None
+                response = kv.xreadgroup(WRITE_BEHIND_GROUP, self.consumer, {self.stream_key: ">"},
+                                         count=count - len(items) - len(entries), block=block)
+                for _, stream_entries in response or []:
+                    entries.extend(stream_entries)
+        except Exception as e:
+            print(f"⚠️ Could not read {self.name} rows from KV: {e}")
+            if not items and timeout > 0:
+                time.sleep(min(timeout, WRITE_BEHIND_FLUSH_INTERVAL))
+            return items
+
+        for entry_id, fields in entries:
+            if fields and b"row" in fields:
+                items.append((json.loads(fields[b"row"]), entry_id))
             else:
-                raise ValueError(f"Unsupported provider: {provider}")
+                self._ack([entry_id])
+        return items
+
+    def _flush(self, items):
+        """Writes a batch with retries. Returns False if the database looks unavailable."""
+        rows = [row for row, _ in items]
+        for attempt in range(WRITE_BEHIND_MAX_ATTEMPTS):
+            started = time.perf_counter()
+            try:
+                self.write_rows(rows)
+                observe_stage(f"{self.name}_write", started)
+                self._ack([entry_id for _, entry_id in items if entry_id])
+                return True
+            except Exception as e:
+                observe_stage(f"{self.name}_write", started, "error")
+                print(f"⚠️ Writing {len(rows)} {self.name} rows failed (attempt {attempt+1}): {e}")
+                if attempt + 1 < WRITE_BEHIND_MAX_ATTEMPTS:
+                    time.sleep(min(2 ** attempt, WRITE_BEHIND_MAX_BACKOFF))
+
+        # Isolate rows the database rejects; if none get through it is down, so keep them all
+        failed = []
+        for row, entry_id in items:
+            try:
+                self.write_rows([row])
+            except Exception as e:
+                failed.append((row, entry_id, e))
+            else:
+                self._ack([entry_id] if entry_id else [])
+        if len(failed) == len(items):
+            self._requeue(items)
+            return False
+        for row, entry_id, error in failed:
+            print(f"❌ Dropping {self.name} row rejected by the database: {error}")
+            self.dropped += 1
+            self._ack([entry_id] if entry_id else [])
+        return True
+
+    def _requeue(self, items):
+        # Stream rows stay pending and are reclaimed after WRITE_BEHIND_CLAIM_IDLE
+        with self._lock:
+            self._buffer.extendleft(row for row, entry_id in reversed(items) if not entry_id)
+
+    def _ack(self, entry_ids):
+        if not entry_ids:
+            return
+        try:
+            pipe = kv.pipeline()
+            pipe.xack(self.stream_key, WRITE_BEHIND_GROUP, *entry_ids)
+            pipe.xdel(self.stream_key, *entry_ids)
+            pipe.execute()
+        except Exception as e:
+            print(f"⚠️ Could not acknowledge {self.name} rows: {e}")
 
-            result_item["status"] = "Success"
-            result_item["imageUrl"] = image_url
-            print(f"✅ Task {i+1} completed successfully")
-            
+    def _ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            kv.xgroup_create(self.stream_key, WRITE_BEHIND_GROUP, id="0", mkstream=True)
         except Exception as e:
-            print(f"❌ ERROR in task {i+1}: {e}")
-            result_item["status"] = "Failed"
-            result_item["error"] = str(e)
-        
-        results.append(result_item)
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+def _insert_usage_logs(rows):
+    supabase.table('usage_logs').insert(rows).execute()
+
+usage_log_pipeline = WriteBehindPipeline("usage_logs", _insert_usage_logs)
+
+# ==============================================================================
+# CREDIT LEDGER (Redis, synced to Supabase in batches)
+# ==============================================================================
+#
+# Each user's spendable balance lives in KV, seeded from users.credits. A job
+# atomically reserves its worst-case cost before it runs and commits what it
+# actually used when it settles; the rest of the reservation is released, so
+# concurrent jobs can't overspend. Committed charges reach users.credits and
+# credit_transactions through the write-behind pipeline (settle_credits RPC,
+# idempotent per settlement id). "unsynced" counts charges not yet applied
+# there, so the balance can be re-read from the database (to pick up purchases)
+# without double counting; "seq" changes on every charge so a re-read that
+# raced one is discarded. Reservations expire, so a crashed job can't hold
+# credits forever. A reservation is committed at most once: a job chunk that is
+# re-run after it settled (its worker died before recording it) is not charged
+# again. Without KV the cached balance is checked and deduct_credits is called
+# directly, as before.
+#
+#   credits:{user_id}               hash: balance, unsynced, seq, synced_at
+#   credits:{user_id}:reservations  hash: reservation_id -> "amount:expires_at"
+#   credits:{user_id}:committed     sorted set: reservation_id scored by commit time
+
+CREDIT_RESERVATION_TTL = int(os.environ.get("CREDIT_RESERVATION_TTL", 3600))
+# Re-read balances from the database this often (picks up purchases)
+CREDIT_LEDGER_REFRESH = int(os.environ.get("CREDIT_LEDGER_REFRESH", 300))
+# A refused reservation re-reads the balance first if it is older than this
+CREDIT_LEDGER_REFUSAL_REFRESH = 10
+CREDIT_LEDGER_KEY_TTL = 30 * 86400
+
+# KEYS: ledger hash, reservations hash
+# ARGV: reservation_id, amount, now, expires_at, key_ttl
+# Returns {1, available, synced_at} when reserved, {0, available, synced_at}
+# when the balance is insufficient, {-1, 0, 0} when the ledger isn't seeded.
+CREDIT_RESERVE_LUA = """
+if redis.call('HEXISTS', KEYS[1], 'balance') == 0 then
+    return {-1, 0, 0}
+end
+local now = tonumber(ARGV[3])
+local reserved = 0
+local holds = redis.call('HGETALL', KEYS[2])
+for i = 1, #holds, 2 do
+    local amount, expires_at = string.match(holds[i + 1], '^(%d+):(%d+)$')
+    if tonumber(expires_at) <= now then
+        redis.call('HDEL', KEYS[2], holds[i])
+    else
+        reserved = reserved + tonumber(amount)
+    end
+end
+local available = tonumber(redis.call('HGET', KEYS[1], 'balance')) - reserved
+local synced_at = tonumber(redis.call('HGET', KEYS[1], 'synced_at') or '0')
+if tonumber(ARGV[2]) > available then
+    return {0, available, synced_at}
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2] .. ':' .. ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+return {1, available, synced_at}
+"""
+
+# KEYS: ledger hash, reservations hash, committed set. ARGV: reservation_id, charge, key_ttl, now
+# Returns 1, 0 if the ledger has expired (the charge is then only synced), or
+# 2 if the reservation was already committed (nothing is charged).
+CREDIT_COMMIT_LUA = """
+if redis.call('ZSCORE', KEYS[3], ARGV[1]) then
+    return 2
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[4], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', tonumber(ARGV[4]) - tonumber(ARGV[3]))
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+if redis.call('HEXISTS', KEYS[1], 'balance') == 0 then
+    return 0
+end
+local charge = tonumber(ARGV[2])
+if charge > 0 then
+    redis.call('HINCRBY', KEYS[1], 'balance', -charge)
+    redis.call('HINCRBY', KEYS[1], 'unsynced', charge)
+    redis.call('HINCRBY', KEYS[1], 'seq', 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# KEYS: ledger hash. ARGV: credits applied to the database
+CREDIT_SYNCED_LUA = """
+if redis.call('HEXISTS', KEYS[1], 'balance') == 1 then
+    redis.call('HINCRBY', KEYS[1], 'unsynced', -tonumber(ARGV[1]))
+    redis.call('HINCRBY', KEYS[1], 'seq', 1)
+end
+return 1
+"""
+
+# KEYS: ledger hash. ARGV: database credits, seq read before them, now, key_ttl
+# Returns 0 if a charge or sync happened since seq was read.
+CREDIT_REFRESH_LUA = """
+if redis.call('HEXISTS', KEYS[1], 'balance') == 1 then
+    if (redis.call('HGET', KEYS[1], 'seq') or '0') ~= ARGV[2] then
+        return 0
+    end
+    local unsynced = tonumber(redis.call('HGET', KEYS[1], 'unsynced') or '0')
+    redis.call('HSET', KEYS[1], 'balance', tonumber(ARGV[1]) - unsynced)
+else
+    redis.call('HSET', KEYS[1], 'balance', ARGV[1], 'unsynced', 0, 'seq', 0)
+end
+redis.call('HSET', KEYS[1], 'synced_at', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+def refresh_credit_balance(user_id):
+    """Re-reads users.credits into the ledger (seeding it if needed). Returns False if it raced a charge."""
+    ledger_key = f"credits:{user_id}"
+    seq = _decode(kv.hget(ledger_key, "seq")) or "0"
+    response = supabase.table('users').select('credits').eq('id', user_id).execute()
+    db_credits = (response.data[0].get('credits') or 0) if response.data else 0
+    refreshed = kv.register_script(CREDIT_REFRESH_LUA)(
+        keys=[ledger_key], args=[db_credits, seq, int(time.time()), CREDIT_LEDGER_KEY_TTL]
+    )
+    return int(refreshed) == 1
+
+def _refresh_credit_balance_quietly(user_id):
+    try:
+        refresh_credit_balance(user_id)
+    except Exception as e:
+        print(f"Warning: could not refresh credit balance for {user_id}: {e}")
+
+def reserve_credits(user_id, amount, fallback_credits=0, hold_seconds=CREDIT_RESERVATION_TTL):
+    """Atomically holds amount credits for a job.
+
+    Returns (reservation_id, credits_available), where credits_available is the
+    balance before this reservation. reservation_id is None if the balance is
+    insufficient, or if the ledger is unavailable; credits_available is then
+    fallback_credits (the cached balance).
+    """
+    if not kv or not supabase:
+        return None, fallback_credits
+
+    reservation_id = f"res_{uuid.uuid4().hex}"
+    keys = [f"credits:{user_id}", f"credits:{user_id}:reservations"]
+    reserve = kv.register_script(CREDIT_RESERVE_LUA)
+    try:
+        for attempt in range(3):
+            now = int(time.time())
+            status, available, synced_at = (int(v) for v in reserve(
+                keys=keys, args=[reservation_id, amount, now, now + hold_seconds, CREDIT_LEDGER_KEY_TTL]
+            ))
+            if status == -1:
+                refresh_credit_balance(user_id)
+            elif status == 1:
+                if now - synced_at > CREDIT_LEDGER_REFRESH:
+                    threading.Thread(target=_refresh_credit_balance_quietly, args=(user_id,), daemon=True).start()
+                return reservation_id, available
+            elif now - synced_at > CREDIT_LEDGER_REFUSAL_REFRESH and attempt == 0:
+                # The user may have just bought credits
+                refresh_credit_balance(user_id)
+            else:
+                return None, available
+    except Exception as e:
+        print(f"Warning: credit ledger unavailable: {e}")
+    return None, fallback_credits
+
+def credit_balance(user_id, fallback_credits=0):
+    """The ledger balance (committed charges included), or fallback_credits if unknown."""
+    if not kv:
+        return fallback_credits
+    try:
+        balance = kv.hget(f"credits:{user_id}", "balance")
+    except Exception as e:
+        print(f"Warning: credit ledger unavailable: {e}")
+        return fallback_credits
+    return int(_decode(balance)) if balance is not None else fallback_credits
+
+def release_credits(user_id, reservation_id):
+    """Drops a reservation without charging anything."""
+    if not kv or not reservation_id:
+        return
+    try:
+        kv.hdel(f"credits:{user_id}:reservations", reservation_id)
+    except Exception as e:
+        print(f"Warning: could not release credit reservation {reservation_id}: {e}")
+
+def commit_credits(user_id, reservation_id, credits_used, task_details):
+    """Charges credits_used against a reservation and releases the rest.
+
+    The charge is synced to Supabase in the background. Returns False (and
+    charges nothing) if the reservation had already been committed.
+    """
+    in_ledger = False
+    try:
+        status = int(kv.register_script(CREDIT_COMMIT_LUA)(
+            keys=[f"credits:{user_id}", f"credits:{user_id}:reservations", f"credits:{user_id}:committed"],
+            args=[reservation_id, credits_used, CREDIT_LEDGER_KEY_TTL, int(time.time())]
+        ))
+        if status == 2:
+            print(f"Warning: reservation {reservation_id} was already committed, not charging again")
+            return False
+        in_ledger = status == 1
+    except Exception as e:
+        # The database is still charged; the ledger catches up on its next refresh
+        print(f"Error committing credits for {user_id}: {e}")
+
+    if credits_used > 0:
+        credit_settlement_pipeline.submit({
+            "settlement_id": reservation_id,
+            "user_id": user_id,
+            "credits": credits_used,
+            "description": f"Image generation - {task_details.get('task_count', 0)} tasks",
+            "metadata": task_details,
+            "in_ledger": in_ledger
+        })
+    return True
+
+def _sync_credit_settlements(rows):
+    """Applies settled charges to Supabase in one call, then marks them synced in the ledger."""
+    supabase.rpc('settle_credits', {
+        'p_settlements': [{k: v for k, v in row.items() if k != "in_ledger"} for row in rows]
+    }).execute()
+
+    synced = {}
+    for row in rows:
+        if row.get("in_ledger"):
+            synced[row["user_id"]] = synced.get(row["user_id"], 0) + row["credits"]
+    try:
+        mark_synced = kv.register_script(CREDIT_SYNCED_LUA)
+        for user_id, credits in synced.items():
+            mark_synced(keys=[f"credits:{user_id}"], args=[credits])
+    except Exception as e:
+        print(f"Warning: could not mark credit settlements as synced: {e}")
+
+credit_settlement_pipeline = WriteBehindPipeline("credit_settlements", _sync_credit_settlements)
+
+# ==============================================================================
+# USAGE ROLLUPS (dashboard counters)
+# ==============================================================================
+#
+# Settling a job increments counters instead of appending raw log entries, so
+# dashboard reads cost O(providers + days) whatever a user's history:
+#   usage:{user_id}:totals       hash, all time
+#   usage:{user_id}:day:{date}   hash per UTC day (kept USAGE_ROLLUP_DAYS)
+#   usage:{user_id}:days         zset of dates that have a day hash, scored by day start
+#   usage:{user_id}:events       zset of per-job events scored by timestamp
+#   usage:{user_id}:recent       list of the last USAGE_RECENT_ENTRIES jobs
+# The hashes and events hold calls (jobs), tasks, images, failures and credits,
+# plus p:{provider}:{tasks|images|failures|credits} per provider.
+#
+# Range queries read raw events for the last USAGE_EVENT_RETENTION_DAYS (exact
+# bounds, hourly or daily buckets) and day hashes before that. Each write
+# compacts the event set by dropping events older than the retention window;
+# their counts already live in the day hashes.
+
+USAGE_ROLLUP_DAYS = 400
+USAGE_RECENT_ENTRIES = 10
+USAGE_EVENT_RETENTION_DAYS = int(os.environ.get("USAGE_EVENT_RETENTION_DAYS", 7))
+USAGE_COUNTERS = ("calls", "tasks", "images", "failures", "credits")
+USAGE_GRANULARITIES = {"hour": 3600, "day": 86400}
+
+def _usage_event_cutoff(now):
+    """Start of the oldest UTC day still covered by raw events."""
+    return (int(now // 86400) - USAGE_EVENT_RETENTION_DAYS) * 86400
+
+def record_usage_rollup(user_id, provider_counts, credits_used, task_details, event_id=None):
+    """Adds a settled job to the user's rollups and event index.
+
+    provider_counts maps provider -> {"tasks", "images", "failures", "credits"}.
+    """
+    if not kv:
+        return
+
+    now = time.time()
+    increments = {"calls": 1, "tasks": 0, "images": 0, "failures": 0, "credits": credits_used}
+    for provider, counts in provider_counts.items():
+        for name, value in counts.items():
+            if name != "credits":
+                increments[name] += value
+            increments[f"p:{provider}:{name}"] = value
+
+    date = time.strftime('%Y-%m-%d', time.gmtime(now))
+    day_key = f"usage:{user_id}:day:{date}"
+    events_key = f"usage:{user_id}:events"
+    event = {"id": event_id or uuid.uuid4().hex, "ts": now}
+    event.update({field: value for field, value in increments.items() if value})
+    try:
+        pipe = kv.pipeline(transaction=False)
+        for key in (f"usage:{user_id}:totals", day_key):
+            for field, value in increments.items():
+                if value:
+                    pipe.hincrby(key, field, value)
+        pipe.expire(day_key, USAGE_ROLLUP_DAYS * 86400)
+        pipe.zadd(f"usage:{user_id}:days", {date: int(now // 86400) * 86400})
+        pipe.zremrangebyscore(f"usage:{user_id}:days", "-inf", now - USAGE_ROLLUP_DAYS * 86400)
+        pipe.zadd(events_key, {json.dumps(event): now})
+        pipe.zremrangebyscore(events_key, "-inf", f"({_usage_event_cutoff(now)}")
+        pipe.expire(events_key, (USAGE_EVENT_RETENTION_DAYS + 1) * 86400)
+        pipe.lpush(f"usage:{user_id}:recent", json.dumps({
+            "timestamp": int(now),
+            "credits_used": credits_used,
+            "task_details": task_details
+        }))
+        pipe.ltrim(f"usage:{user_id}:recent", 0, USAGE_RECENT_ENTRIES - 1)
+        pipe.execute()
+    except Exception as e:
+        print(f"Warning: could not update usage rollups for {user_id}: {e}")
+
+def _parse_rollup(raw):
+    """Splits a rollup hash into (counters, {provider: counters})."""
+    counters = dict.fromkeys(USAGE_COUNTERS, 0)
+    providers = {}
+    for field, value in raw.items():
+        field, value = _decode(field), int(value)
+        if field.startswith("p:"):
+            provider, name = field[2:].rsplit(":", 1)
+            providers.setdefault(provider, dict.fromkeys(USAGE_COUNTERS[1:], 0))[name] = value
+        else:
+            counters[field] = value
+    return counters, providers
+
+def get_usage_totals(user_id):
+    """All-time (counters, providers) for a user.
+
+    Falls back to the user_usage_summary row (no provider breakdown) when KV
+    has no rollup for the user.
+    """
+    counters, providers = _parse_rollup(kv.hgetall(f"usage:{user_id}:totals") if kv else {})
+    if counters["calls"] == 0 and supabase:
+        response = supabase.table('user_usage_summary').select(
+            'total_requests, total_credits_used, total_images_generated, total_failed'
+        ).eq('user_id', user_id).execute()
+        if response.data:
+            summary = response.data[0]
+            counters = {
+                "calls": summary["total_requests"],
+                "tasks": summary["total_images_generated"] + summary["total_failed"],
+                "images": summary["total_images_generated"],
+                "failures": summary["total_failed"],
+                "credits": summary["total_credits_used"]
+            }
+    return counters, providers
+
+def get_usage_series(user_id, start_time, end_time, granularity="day"):
+    """Returns [(bucket_start, counters, providers)] for buckets in [start_time, end_time] that had usage.
+
+    Recent usage comes from raw events and is exact; days before the event
+    retention window come from day hashes and are counted whole. Hourly
+    buckets are only available inside the retention window.
+    """
+    if not kv:
+        return []
+    bucket_seconds = USAGE_GRANULARITIES[granularity]
+    cutoff = _usage_event_cutoff(time.time())
+    if granularity == "hour" and start_time < cutoff:
+        raise ValueError(f"Hourly usage is only kept for the last {USAGE_EVENT_RETENTION_DAYS} days.")
+
+    buckets = {}
+    def add(bucket_start, fields):
+        bucket = buckets.setdefault(bucket_start, {})
+        for field, value in fields.items():
+            bucket[field] = bucket.get(field, 0) + int(value)
+
+    if start_time < cutoff:
+        dates = kv.zrangebyscore(f"usage:{user_id}:days", int(start_time // 86400) * 86400, f"({cutoff}", withscores=True)
+        pipe = kv.pipeline(transaction=False)
+        for date, _ in dates:
+            pipe.hgetall(f"usage:{user_id}:day:{_decode(date)}")
+        for (_, day_start), raw in zip(dates, pipe.execute()):
+            add(int(day_start), {_decode(field): value for field, value in raw.items()})
+
+    for member in kv.zrangebyscore(f"usage:{user_id}:events", max(start_time, cutoff), end_time):
+        event = json.loads(member)
+        fields = {field: value for field, value in event.items() if field not in ("id", "ts")}
+        add(int(event["ts"] // bucket_seconds) * bucket_seconds, fields)
+
+    return [(bucket_start, *_parse_rollup(fields)) for bucket_start, fields in sorted(buckets.items())]
+
+def get_recent_usage(user_id):
+    """The user's most recent settled jobs, newest first."""
+    if not kv:
+        return []
+    return [json.loads(entry) for entry in kv.lrange(f"usage:{user_id}:recent", 0, USAGE_RECENT_ENTRIES - 1)]
+
+# ==============================================================================
+# SYNCHRONOUS JOB PROCESSING (Fixed for Vercel)
+# ==============================================================================
+
+# Upstream API each provider is served by. Concurrency caps apply per backend so
+# that e.g. flux-dev and flux-kontext share the same BFL allowance.
+PROVIDER_BACKENDS = {
+    "dalle": "openai",
+    "flux-kontext": "bfl",
+    "flux-dev": "bfl",
+    "gemini": "gemini",
+    "reve": "reve",
+    "minimax": "minimax",
+    "imagen-3": "google",
+    "imagen-4": "google",
+    "imagen-4-ultra": "google",
+    "imagen-4-fast": "google",
+    "seedream-4": "fal",
+    "qwen-image": "fal",
+    "seedream-3": "fal",
+    "ideogram-v3": "fal",
+    "gpt-image-1": "fal"
+}
+
+# Maximum simultaneous in-flight calls per backend (per gateway process)
+PROVIDER_CONCURRENCY = {
+    "openai": int(os.environ.get("CONCURRENCY_OPENAI", 5)),
+    "bfl": int(os.environ.get("CONCURRENCY_BFL", 10)),
+    "gemini": int(os.environ.get("CONCURRENCY_GEMINI", 5)),
+    "reve": int(os.environ.get("CONCURRENCY_REVE", 5)),
+    "minimax": int(os.environ.get("CONCURRENCY_MINIMAX", 5)),
+    "google": int(os.environ.get("CONCURRENCY_GOOGLE", 5)),
+    "fal": int(os.environ.get("CONCURRENCY_FAL", 10))
+}
+
+# Upper bound on worker threads used for a single job
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", 32))
+
+_provider_semaphores = {
+    backend: threading.BoundedSemaphore(limit) for backend, limit in PROVIDER_CONCURRENCY.items()
+}
+
+def get_provider_backend(provider):
+    """Returns the upstream backend name for a provider (the provider itself if unknown)."""
+    return PROVIDER_BACKENDS.get(provider, provider)
+
+def generate_image_for_task(task):
+    """Dispatches a single task to its provider connector.
+
+    Returns the image URL, or a Future for it when the provider is polled (BFL, fal.ai).
+    """
+    prompt = task.get("prompt")
+    provider = task.get("provider", "dalle").lower()
+
+    if provider == "dalle":
+        return generate_with_dalle(prompt, task.get("size", "1024x1024"))
+    elif provider == "reve":
+        return generate_with_reve(prompt, task.get("aspect_ratio", "1:1"))
+    elif provider == "gemini":
+        return generate_with_gemini(prompt)
+    elif provider == "minimax":
+        return generate_with_minimax(prompt, task.get("aspect_ratio", "1:1"))
+    elif provider.startswith("flux"):
+        model_map = {"flux-kontext": "flux-kontext-pro", "flux-dev": "flux-dev"}
+        model_endpoint = model_map.get(provider)
+        if not model_endpoint:
+            raise ValueError(f"Unknown FLUX model: {provider}")
+        return submit_bfl_job(prompt, model_endpoint, task.get("aspect_ratio", "1:1"))
+    elif provider.startswith("imagen"):
+        return generate_with_imagen(
+            prompt=prompt,
+            provider=provider,
+            aspect_ratio=task.get("aspect_ratio", "1:1"),
+            image_size=task.get("image_size", "1024"),
+            person_generation=task.get("person_generation", "allow_adult"),
+            number_of_images=1,
+            output_format=task.get("output_format", "png"),
+            output_quality=task.get("output_quality")
+        )
+    elif provider in ["seedream-4", "qwen-image", "seedream-3", "ideogram-v3", "gpt-image-1"]:
+        # fal.ai providers - pass all task parameters as kwargs
+        fal_params = {k: v for k, v in task.items() if k not in ["prompt", "provider"]}
+        return submit_fal_job(prompt, provider, **fal_params)
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+def task_timing(queued_at, started_at=None, provider_done_at=None):
+    """Per-task timing fields in milliseconds, measured up to now.
+
+    queue_wait_ms runs from when the task was handed to a worker until its
+    provider call started (concurrency cap and rate limit waits included),
+    provider_ms until the provider answered (polling included) and
+    post_processing_ms covers blob offload and caching after that.
+    """
+    now = time.time()
+    if started_at is None:
+        return {"queue_wait_ms": round((now - queued_at) * 1000, 1), "provider_ms": None, "post_processing_ms": None}
+    return {
+        "queue_wait_ms": round((started_at - queued_at) * 1000, 1),
+        "provider_ms": round((provider_done_at - started_at) * 1000, 1),
+        "post_processing_ms": round((now - provider_done_at) * 1000, 1)
+    }
+
+def _finish_task(index, task, outcome, image_url=None, error=None, cached=False, timing=None):
+    """Builds the result item for a finished task and resolves its outcome Future."""
+    result_item = {"prompt": task.get("prompt"), "provider": task.get("provider", "dalle").lower()}
+    if timing:
+        result_item["timing"] = timing
+    if error is None:
+        result_item["status"] = "Success"
+        result_item["imageUrl"] = image_url
+        if cached:
+            result_item["cached"] = True
+        print(f"✅ Task {index+1} completed successfully{' (cached)' if cached else ''}")
+    else:
+        print(f"❌ ERROR in task {index+1}: {error}")
+        result_item["status"] = "Failed"
+        result_item["error"] = str(error)
+    _settle_future(outcome, result_item)
+
+def run_task(index, task, total_tasks, outcome, cache_key=None, queued_at=None):
+    """Starts one task under its backend's concurrency cap and resolves outcome with its result item.
+
+    Never raises; failures are recorded on the result. Polled providers return
+    without blocking: the cap is released when the poll scheduler resolves them.
+    The caller has already missed the cache for cache_key; the new image is
+    stored under it. queued_at (default: now) is when the task was handed over,
+    for its timing fields.
+    """
+    provider = task.get("provider", "dalle").lower()
+    queued_at = queued_at or time.time()
+
+    backend = get_provider_backend(provider)
+    semaphore = _provider_semaphores.get(backend)
+    if semaphore:
+        semaphore.acquire()
+    lease_id = None
+    started_at = None
+    in_flight = False
+    circuit_ticket = None
+
+    def call():
+        nonlocal started_at
+        # call_with_rate_limit may call again after a provider 429; time from the first attempt
+        if started_at is None:
+            started_at = time.time()
+        with profile_span("provider_call", task=index, provider=provider):
+            return generate_image_for_task(task)
+
+    def done(image_url=None, error=None):
+        provider_done_at = time.time()
+        try:
+            release_provider_slot(backend, lease_id)
+            if semaphore:
+                semaphore.release()
+            if started_at is not None:
+                record_provider_call(provider, provider_done_at - started_at, error, [image_url])
+            if started_at is not None and not isinstance(error, (RateLimitTimeout, CancelledError)):
+                record_provider_outcome(backend, provider_done_at - started_at, error, circuit_ticket)
+                if error is None:
+                    record_provider_latency(provider, provider_done_at - started_at)
+            with profile_span("post_processing", task=index):
+                if error is None and not task.get("inline"):
+                    image_url = offload_image(image_url)
+                if cache_key and error is None:
+                    generation_cache_put(cache_key, image_url, provider)
+        finally:
+            if in_flight:
+                TASKS_IN_FLIGHT.labels(provider).dec()
+        _finish_task(index, task, outcome, image_url, error, timing=task_timing(queued_at, started_at, provider_done_at))
+
+    try:
+        circuit_ticket = check_circuit(backend)
+        print(f"Processing task {index+1}/{total_tasks} with provider {provider}")
+        TASKS_IN_FLIGHT.labels(provider).inc()
+        in_flight = True
+        lease_id, image_url = call_with_rate_limit(backend, call)
+    except Exception as e:
+        done(error=e)
+        return
+
+    if isinstance(image_url, Future):
+        def on_ready(future):
+            try:
+                done(image_url=future.result())
+            except Exception as e:
+                done(error=e)
+        image_url.add_done_callback(on_ready)
+        # Cancelling the outcome (a losing hedge) stops the provider job where possible
+        outcome.add_done_callback(lambda f: image_url.cancel() if f.cancelled() else None)
+    else:
+        done(image_url=image_url)
+
+# --- Batching ---
+#
+# Tasks that still need a generation after the cache lookup (cache misses and
+# "no_cache" tasks) and share a prompt and parameters are sent to the provider
+# as one multi-image request (Imagen number_of_images, fal.ai num_images), and
+# the returned images are split back out to the original tasks. Identical
+# cacheable tasks never get here: they are collapsed into one task first.
+
+def _imagen_batch_key(task):
+    return (
+        task.get("provider", "dalle").lower(),
+        task.get("prompt"),
+        task.get("aspect_ratio", "1:1"),
+        task.get("image_size", "1024"),
+        task.get("person_generation", "allow_adult"),
+        (task.get("output_format") or "png").lower(),
+        task.get("output_quality"),
+        bool(task.get("inline"))
+    )
+
+def _fal_batch_key(task):
+    # Everything except num_images must match for tasks to share one fal request
+    params = {k: v for k, v in task.items() if k not in ("num_images", "no_cache")}
+    return json.dumps(params, sort_keys=True, default=str)
+
+def batch_plan_for(task):
+    """Returns (batch_key, max_batch_size) for a batchable task, else None."""
+    if task.get("fallback"):
+        return None
+    provider = task.get("provider", "dalle").lower()
+    if provider.startswith("imagen"):
+        return _imagen_batch_key(task), IMAGEN_MAX_BATCH
+    if provider in FAL_MAX_BATCH and int(task.get("num_images") or 1) == 1:
+        return _fal_batch_key(task), FAL_MAX_BATCH[provider]
+    return None
+
+def plan_batches(tasks, indices):
+    """Groups task indices into execution units; compatible tasks share a unit up to the batch limit."""
+    units = []
+    open_batches = {}
+    for i in indices:
+        plan = batch_plan_for(tasks[i])
+        if not plan:
+            units.append([i])
+            continue
+
+        batch_key, max_size = plan
+        unit = open_batches.get(batch_key)
+        if unit is None or len(unit) >= max_size:
+            unit = []
+            open_batches[batch_key] = unit
+            units.append(unit)
+        unit.append(i)
+    return units
+
+def generate_batch_for_tasks(batch_tasks):
+    """Generates one image per task in a single provider request. Returns the list of image URLs (or a Future of it)."""
+    task = batch_tasks[0]
+    provider = task.get("provider", "dalle").lower()
+    if provider.startswith("imagen"):
+        return generate_imagen_images(
+            prompt=task.get("prompt"),
+            provider=provider,
+            aspect_ratio=task.get("aspect_ratio", "1:1"),
+            image_size=task.get("image_size", "1024"),
+            person_generation=task.get("person_generation", "allow_adult"),
+            number_of_images=len(batch_tasks),
+            output_format=task.get("output_format", "png"),
+            output_quality=task.get("output_quality")
+        )
+    if provider in FAL_MAX_BATCH:
+        fal_params = {k: v for k, v in task.items() if k not in ["prompt", "provider"]}
+        fal_params["num_images"] = len(batch_tasks)
+        return submit_fal_images(task.get("prompt"), provider, **fal_params)
+    raise ValueError(f"Provider {provider} does not support batching")
+
+def run_batch(indices, tasks, total_tasks, outcomes, cache_keys, queued_at=None):
+    """Runs a unit of compatible tasks as one provider request and resolves each task's outcome.
+
+    Each image is stored in the generation cache under its task's key in cache_keys, if it has one.
+    """
+    provider = tasks[indices[0]].get("provider", "dalle").lower()
+    queued_at = queued_at or time.time()
+    backend = get_provider_backend(provider)
+    semaphore = _provider_semaphores.get(backend)
+    if semaphore:
+        semaphore.acquire()
+    lease_id = None
+    started_at = None
+    in_flight = False
+    circuit_ticket = None
+
+    def call():
+        nonlocal started_at
+        # call_with_rate_limit may call again after a provider 429; time from the first attempt
+        if started_at is None:
+            started_at = time.time()
+        with profile_span("provider_call", tasks=list(indices), provider=provider):
+            return generate_batch_for_tasks([tasks[i] for i in indices])
+
+    def done(image_urls=None, error=None):
+        provider_done_at = time.time()
+        try:
+            release_provider_slot(backend, lease_id)
+            if semaphore:
+                semaphore.release()
+            if started_at is not None:
+                record_provider_call(provider, provider_done_at - started_at, error, image_urls or ())
+            if started_at is not None and not isinstance(error, (RateLimitTimeout, CancelledError)):
+                record_provider_outcome(backend, provider_done_at - started_at, error, circuit_ticket)
+                if error is None:
+                    record_provider_latency(provider, provider_done_at - started_at)
+        finally:
+            if in_flight:
+                TASKS_IN_FLIGHT.labels(provider).dec(len(indices))
+        for position, index in enumerate(indices):
+            task = tasks[index]
+            if error is not None:
+                _finish_task(index, task, outcomes[index], error=error,
+                             timing=task_timing(queued_at, started_at, provider_done_at))
+            elif position < len(image_urls):
+                with profile_span("post_processing", task=index):
+                    image_url = image_urls[position] if task.get("inline") else offload_image(image_urls[position])
+                    if cache_keys[index]:
+                        generation_cache_put(cache_keys[index], image_url, provider)
+                _finish_task(index, task, outcomes[index], image_url=image_url,
+                             timing=task_timing(queued_at, started_at, provider_done_at))
+            else:
+                _finish_task(index, task, outcomes[index], error=RuntimeError(
+                    f"{provider} returned {len(image_urls)} of {len(indices)} requested images"
+                ), timing=task_timing(queued_at, started_at, provider_done_at))
+
+    try:
+        circuit_ticket = check_circuit(backend)
+        print(f"Processing tasks {', '.join(str(i+1) for i in indices)} of {total_tasks} as one {provider} batch")
+        TASKS_IN_FLIGHT.labels(provider).inc(len(indices))
+        in_flight = True
+        lease_id, image_urls = call_with_rate_limit(backend, call)
+    except Exception as e:
+        done(error=e)
+        return
+
+    if isinstance(image_urls, Future):
+        def on_ready(future):
+            try:
+                done(image_urls=future.result())
+            except Exception as e:
+                done(error=e)
+        image_urls.add_done_callback(on_ready)
+    else:
+        done(image_urls=image_urls)
+
+# --- Hedging and fallback ---
+
+# Tasks may name a fallback chain; if the primary hasn't answered by the hedge
+# delay (its observed p95 by default) the next provider starts, and a failure
+# with nothing else in flight starts the next one immediately. The first
+# success wins.
+HEDGE_FIELDS = {"fallback", "hedge", "hedge_delay_ms"}
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", 20))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+HEDGE_LATENCY_WINDOW = 200
+
+_provider_latencies = {}
+_hedge_executor = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS, thread_name_prefix="job-hedge")
+
+def record_provider_latency(provider, seconds):
+    """Keeps a window of recent successful call latencies per provider."""
+    _provider_latencies.setdefault(provider, deque(maxlen=HEDGE_LATENCY_WINDOW)).append(seconds)
+
+def provider_latency_p95(provider):
+    """Observed p95 latency in seconds, or None until enough calls have been seen."""
+    samples = sorted(_provider_latencies.get(provider, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return samples[int(len(samples) * 0.95) - 1]
+
+def provider_chain(task):
+    """Returns the task's primary provider followed by its fallbacks, without repeats."""
+    chain = [task.get("provider", "dalle").lower()]
+    for provider in task.get("fallback") or []:
+        provider = str(provider).lower()
+        if provider not in chain:
+            chain.append(provider)
+    return chain
+
+def hedge_delay(task, provider):
+    """Seconds to wait on provider before starting the next one, or None to only fall back on failure."""
+    if task.get("hedge") is False:
+        return None
+    if task.get("hedge_delay_ms") is not None:
+        return max(float(task["hedge_delay_ms"]), 0) / 1000
+    p95 = provider_latency_p95(provider)
+    return p95 if p95 is not None else HEDGE_DEFAULT_DELAY
+
+def run_hedged_task(index, task, total_tasks, outcome, queued_at=None):
+    """Runs a task across its provider chain and resolves outcome with the first success.
+
+    Each attempt runs as an ordinary task for its provider; losing attempts are
+    cancelled, which stops polled providers (and dequeues fal.ai requests).
+    Synchronous provider calls can't be interrupted, their results are dropped.
+    """
+    chain = provider_chain(task)
+    base_task = {k: v for k, v in task.items() if k not in HEDGE_FIELDS}
+    queued_at = queued_at or time.time()
+    attempts = {}
+    errors = []
+
+    def start_next():
+        provider = chain[len(attempts) + len(errors)]
+        attempt = Future()
+        attempts[attempt] = provider
+        def run():
+            if not attempt.cancelled():
+                run_task(index, dict(base_task, provider=provider), total_tasks, attempt, queued_at=queued_at)
+        submit_in_context(_hedge_executor, run)
+        if len(attempts) + len(errors) > 1:
+            print(f"🔀 Task {index+1}: starting {provider} ({len(attempts) + len(errors)}/{len(chain)})")
+
+    def remaining():
+        return len(chain) - len(attempts) - len(errors)
+
+    start_next()
+    while attempts:
+        delay = hedge_delay(task, chain[len(attempts) + len(errors) - 1]) if remaining() else None
+        finished, _ = wait(list(attempts), timeout=delay, return_when=FIRST_COMPLETED)
+        if not finished:
+            start_next()
+            continue
+
+        for attempt in finished:
+            provider = attempts.pop(attempt)
+            result_item = attempt.result()
+            if result_item["status"] == "Success":
+                for loser in attempts:
+                    loser.cancel()
+                if provider != chain[0]:
+                    result_item["requested_provider"] = chain[0]
+                outcome.set_result(result_item)
+                return
+            errors.append(f"{provider}: {result_item['error']}")
+
+        if remaining() and not attempts:
+            start_next()
+
+    _finish_task(index, task, outcome, error=RuntimeError("All providers failed. " + "; ".join(errors)),
+                 timing=task_timing(queued_at))
+
+def process_job_sync(tasks, on_result=None, retain_images=True, cache_scope=None):
+    """Processes all tasks concurrently and returns results in task order.
+
+    If given, on_result(index, result_item) is called as each task finishes.
+    With retain_images=False the returned results omit imageUrl, so callers that
+    consume results through on_result don't keep every image in memory.
+    Cacheable duplicates within the job run once; cache_scope (the user id)
+    keeps cache entries private to their owner.
+    """
+    total_tasks = len(tasks)
+    if total_tasks == 0:
+        return []
+
+    results = [None] * total_tasks
+
+    # Collapse duplicate tasks: only the first of each cache key is executed
+    cache_keys = [generation_cache_key(task, cache_scope) for task in tasks]
+    leaders = {}
+    duplicates = {}
+    for i, cache_key in enumerate(cache_keys):
+        if cache_key and cache_key in leaders:
+            duplicates.setdefault(leaders[cache_key], []).append(i)
+        elif cache_key:
+            leaders[cache_key] = i
+    runnable = [i for i in range(total_tasks) if not cache_keys[i] or leaders[cache_keys[i]] == i]
+
+    def record(index, result_item):
+        results[index] = result_item
+        if on_result:
+            on_result(index, result_item)
+        if not retain_images:
+            results[index] = {k: v for k, v in result_item.items() if k != "imageUrl"}
+
+    outcomes = {i: Future() for i in runnable}
+    outcome_indices = {outcome: i for i, outcome in outcomes.items()}
+    queued_at = time.time()
+
+    # Serve cache hits up front so only tasks that need a generation are batched
+    with profile_span("cache_lookup", tasks=len(leaders)):
+        cached_urls = generation_cache_get_many(list(leaders))
+    for cache_key, image_url in cached_urls.items():
+        index = leaders[cache_key]
+        _finish_task(index, tasks[index], outcomes[index], image_url=image_url, cached=True,
+                     timing=task_timing(queued_at))
+    units = plan_batches(tasks, [i for i in runnable if cache_keys[i] not in cached_urls])
+    max_workers = max(min(JOB_MAX_WORKERS, len(units)), 1)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-task") as executor:
+        for unit in units:
+            if len(unit) == 1 and tasks[unit[0]].get("fallback"):
+                submit_in_context(executor, run_hedged_task, unit[0], tasks[unit[0]], total_tasks, outcomes[unit[0]],
+                                  queued_at)
+            elif len(unit) == 1:
+                submit_in_context(executor, run_task, unit[0], tasks[unit[0]], total_tasks, outcomes[unit[0]],
+                                  cache_keys[unit[0]], queued_at)
+            else:
+                submit_in_context(executor, run_batch, unit, tasks, total_tasks, outcomes, cache_keys, queued_at)
+
+        for outcome in as_completed(outcome_indices):
+            index = outcome_indices[outcome]
+            result_item = outcome.result()
+            record(index, result_item)
+
+            for duplicate in duplicates.get(index, []):
+                duplicate_item = dict(result_item, prompt=tasks[duplicate].get("prompt"))
+                if duplicate_item["status"] == "Success":
+                    duplicate_item["cached"] = True
+                print(f"♻️  Task {duplicate+1} served from duplicate task {index+1}")
+                record(duplicate, duplicate_item)
 
     return results
 
+def settle_job(user_id, tasks, results, request_id=None, api_key_id=None, started_at=None, reservation_id=None):
+    """Charges credits for successful tasks and logs usage. Returns the credits used.
+
+    Tasks are billed at the cost of the provider that served them, which for
+    hedged tasks may be a fallback rather than the requested provider. With a
+    reservation_id the charge is committed to the credit ledger (releasing the
+    rest of the reservation), otherwise deducted directly; a reservation that
+    was already committed (a re-run job chunk) is not charged or logged again.
+    The usage log row is written behind (see WriteBehindPipeline); started_at
+    is when the request arrived and gives its response time.
+    """
+    providers_used = [result.get("provider") or task.get("provider") for task, result in zip(tasks, results)]
+    actual_credits_used = 0
+    provider_counts = {}
+    for i, result in enumerate(results):
+        provider = (providers_used[i] or "dalle").lower()
+        counts = provider_counts.setdefault(provider, {"tasks": 0, "images": 0, "failures": 0, "credits": 0})
+        counts["tasks"] += 1
+        if result["status"] == "Success":
+            if result.get("cached"):
+                credits = int(PROVIDER_COSTS.get(provider, 0) * CACHE_HIT_CREDIT_RATIO)
+            else:
+                credits = PROVIDER_COSTS.get(provider, 0)
+            actual_credits_used += credits
+            counts["images"] += 1
+            counts["credits"] += credits
+        else:
+            counts["failures"] += 1
+
+    success_count = sum(1 for r in results if r["status"] == "Success")
+    cached_count = sum(1 for r in results if r.get("cached"))
+    task_details = {
+        "task_count": len(tasks),
+        "providers_used": providers_used,
+        "success_count": success_count,
+        "cached_count": cached_count
+    }
+
+    # Deduct credits from user account
+    started = time.perf_counter()
+    first_settlement = True
+    with profile_span("credit_commit"):
+        if reservation_id:
+            # False when a re-run chunk settles a reservation a second time
+            first_settlement = commit_credits(user_id, reservation_id, actual_credits_used, task_details)
+        elif actual_credits_used > 0:
+            deduct_credits(user_id, actual_credits_used, task_details)
+    observe_stage("credit_commit", started)
+
+    started = time.perf_counter()
+    with profile_span("usage_rollup"):
+        if first_settlement:
+            record_usage_rollup(user_id, provider_counts, actual_credits_used, task_details, event_id=request_id)
+
+    if actual_credits_used > 0 and first_settlement:
+        # Log usage to Supabase
+        if supabase:
+            usage_log_pipeline.submit({
+                'user_id': user_id,
+                'api_key_id': api_key_id,
+                'request_id': request_id,
+                'provider': ', '.join(set(providers_used)),
+                'credits_used': actual_credits_used,
+                'task_count': len(tasks),
+                'success_count': success_count,
+                'failed_count': len(results) - success_count,
+                'response_time_ms': int((time.time() - started_at) * 1000) if started_at else None,
+                'metadata': json.dumps({"providers_used": providers_used, "cached_count": cached_count}),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            })
+    observe_stage("usage_write", started)
+
+    return actual_credits_used
+
+# ==============================================================================
+# ASYNCHRONOUS JOB QUEUE (Redis-backed)
+# ==============================================================================
+#
+# Layout in KV (all keys expire after JOB_TTL_SECONDS):
+#   jobs:queue               list of job ids waiting for a worker
+#   jobs:processing:{worker} job ids claimed by one worker
+#   workers                  set of worker ids that may hold claimed jobs
+#   worker:{worker}:lease    heartbeat key; once it expires the worker is presumed
+#                            dead and its claimed jobs go back on the queue
+#   job:{id}                 hash with owner, status and progress counters
+#   job:{id}:tasks           JSON array of the submitted tasks
+#   job:{id}:chunks          bulk jobs instead: list of JSON chunks with their
+#                            offset, tasks and credit reservation
+#   job:{id}:task_status     hash task index -> Pending/Success/Failed
+#   job:{id}:results         hash task index -> JSON result item
+
+JOB_QUEUE_KEY = "jobs:queue"
+JOB_PROCESSING_PREFIX = "jobs:processing"
+WORKERS_KEY = "workers"
+WORKER_LEASE_SECONDS = int(os.environ.get("WORKER_LEASE_SECONDS", 30))
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 86400))
+# Most tasks listed by one status or results request
+JOB_PAGE_SIZE = int(os.environ.get("JOB_PAGE_SIZE", 1000))
+
+def _decode(value):
+    """Decodes a Redis bytes reply to str (leaves None and str untouched)."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+def _hgetall_decoded(key):
+    """HGETALL with keys and values decoded to str."""
+    return {_decode(k): _decode(v) for k, v in kv.hgetall(key).items()}
+
+def enqueue_job(user_id, tasks, api_key_id=None, reservation_id=None):
+    """Stores a job in KV and pushes it onto the worker queue. Returns the job id."""
+    job_id = f"job_{uuid.uuid4().hex}"
+    job_key = f"job:{job_id}"
+    now = int(time.time())
+
+    pipe = kv.pipeline()
+    pipe.hset(job_key, mapping={
+        "job_id": job_id,
+        "user_id": user_id,
+        "status": "queued",
+        "total_tasks": len(tasks),
+        "completed": 0,
+        "successful": 0,
+        "failed": 0,
+        "created_at": now
+    })
+    if api_key_id:
+        pipe.hset(job_key, "api_key_id", api_key_id)
+    if reservation_id:
+        pipe.hset(job_key, "reservation_id", reservation_id)
+    pipe.set(f"{job_key}:tasks", json.dumps(tasks))
+    pipe.hset(f"{job_key}:task_status", mapping={i: "Pending" for i in range(len(tasks))})
+    for key in (job_key, f"{job_key}:tasks", f"{job_key}:task_status"):
+        pipe.expire(key, JOB_TTL_SECONDS)
+    pipe.lpush(JOB_QUEUE_KEY, job_id)
+    pipe.execute()
+
+    return job_id
+
+def get_job(job_id):
+    """Returns the job metadata hash, or None if the job does not exist."""
+    if not kv:
+        return None
+    meta = _hgetall_decoded(f"job:{job_id}")
+    return meta or None
+
+# KEYS: job hash, task_status hash, results hash
+# ARGV: task index, status, result JSON, ttl
+# Counts a task once however often its result is recorded (a requeued job re-runs tasks)
+RECORD_TASK_RESULT_LUA = """
+local previous = redis.call('HGET', KEYS[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+if not previous or previous == 'Pending' then
+    redis.call('HINCRBY', KEYS[1], 'completed', 1)
+elseif previous == 'Success' then
+    redis.call('HINCRBY', KEYS[1], 'successful', -1)
+else
+    redis.call('HINCRBY', KEYS[1], 'failed', -1)
+end
+redis.call('HINCRBY', KEYS[1], ARGV[2] == 'Success' and 'successful' or 'failed', 1)
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+return 1
+"""
+
+def _job_chunks(job_id, meta):
+    """Yields (chunk number, offset, tasks, reservation_id) for each chunk a job has left to run.
+
+    A plain job is a single chunk. Bulk jobs resume after their last settled chunk.
+    """
+    job_key = f"job:{job_id}"
+    if "chunk_count" not in meta:
+        if not int(meta.get("chunks_done", 0)):
+            yield 0, 0, json.loads(kv.get(f"{job_key}:tasks") or "[]"), meta.get("reservation_id")
+        return
+    # A bulk job starts while its upload is still arriving: wait for further chunks
+    # until the upload ends, is cancelled, or goes quiet for BULK_INGEST_TIMEOUT
+    number = int(meta.get("chunks_done", 0))
+    while True:
+        chunk_count, ingesting, cancelled, ingest_updated_at = kv.hmget(
+            job_key, ["chunk_count", "ingesting", "cancelled", "ingest_updated_at"])
+        if cancelled:
+            return
+        if number < int(chunk_count or 0):
+            chunk = json.loads(kv.lindex(f"{job_key}:chunks", number))
+            yield number, chunk["offset"], chunk["tasks"], chunk.get("reservation_id")
+            number += 1
+        elif not int(ingesting or 0):
+            return
+        elif time.time() - int(ingest_updated_at or 0) < BULK_INGEST_TIMEOUT:
+            time.sleep(BULK_CHUNK_WAIT_SECONDS)
+        else:
+            finish_bulk_ingest(job_id, error=f"Upload stalled for over {BULK_INGEST_TIMEOUT}s.")
+            return
+
+def _release_unsettled_reservations(job_id, user_id):
+    """Releases the credit reservations of every chunk a job has not settled."""
+    meta = get_job(job_id) or {}
+    chunks_done = int(meta.get("chunks_done", 0))
+    if "chunk_count" not in meta:
+        if not chunks_done:
+            release_credits(user_id, meta.get("reservation_id"))
+        return
+    for raw_chunk in kv.lrange(f"job:{job_id}:chunks", chunks_done, -1):
+        release_credits(user_id, json.loads(raw_chunk).get("reservation_id"))
+
+def process_queued_job(job_id):
+    """Runs a queued job, recording each task result in KV as it completes.
+
+    Bulk jobs run one chunk at a time; each chunk is settled against its own
+    reservation as soon as it finishes.
+    """
+    job_key = f"job:{job_id}"
+    meta = get_job(job_id)
+    if not meta:
+        print(f"Warning: job {job_id} not found (expired?), skipping")
+        return
+
+    if meta["status"] in ("completed", "failed", "cancelled"):
+        print(f"Warning: job {job_id} already {meta['status']}, skipping")
+        return
+
+    bulk = "chunk_count" in meta
+    kv.hset(job_key, mapping={"status": "running", "started_at": int(time.time())})
+    print(f"Processing job {job_id} with {meta['total_tasks']} tasks")
+
+    record_task_result = kv.register_script(RECORD_TASK_RESULT_LUA)
+
+    def record_result(index, result_item):
+        record_task_result(
+            keys=[job_key, f"{job_key}:task_status", f"{job_key}:results"],
+            args=[index, result_item["status"], json.dumps(result_item), JOB_TTL_SECONDS]
+        )
+
+    credits_used = int(meta.get("credits_used", 0))
+    try:
+        for number, offset, tasks, reservation_id in _job_chunks(job_id, meta):
+            results = process_job_sync(tasks, on_result=lambda index, item, offset=offset: record_result(offset + index, item),
+                                       retain_images=False, cache_scope=meta["user_id"])
+            credits_used += settle_job(meta["user_id"], tasks, results, request_id=f"{job_id}:{number}" if bulk else job_id,
+                                       api_key_id=meta.get("api_key_id"), started_at=int(meta["created_at"]),
+                                       reservation_id=reservation_id)
+            # A settled chunk is never re-run (or re-billed) if the job is requeued
+            kv.hset(job_key, mapping={"chunks_done": number + 1, "credits_used": credits_used})
+
+        if _decode(kv.hget(job_key, "cancelled")):
+            # The upload was rejected part way; chunks that never started are not billed
+            _release_unsettled_reservations(job_id, meta["user_id"])
+            kv.hset(job_key, mapping={"status": "cancelled", "credits_used": credits_used,
+                                      "finished_at": int(time.time())})
+            print(f"🛑 Job {job_id} cancelled ({credits_used} credits)")
+            return
+        kv.hset(job_key, mapping={
+            "status": "completed",
+            "credits_used": credits_used,
+            "finished_at": int(time.time())
+        })
+        print(f"✅ Job {job_id} completed ({credits_used} credits)")
+    except Exception as e:
+        print(f"❌ ERROR in job {job_id}: {e}")
+        kv.hset(job_key, mapping={"status": "failed", "error": str(e), "finished_at": int(time.time())})
+        _release_unsettled_reservations(job_id, meta["user_id"])
+
+def _processing_key(worker_id):
+    return f"{JOB_PROCESSING_PREFIX}:{worker_id}"
+
+def _renew_worker_lease(worker_id, stopped):
+    """Heartbeat thread: keeps the worker's lease alive until stopped is set."""
+    while not stopped.wait(WORKER_LEASE_SECONDS / 3):
+        try:
+            kv.set(f"worker:{worker_id}:lease", int(time.time()), ex=WORKER_LEASE_SECONDS)
+        except Exception as e:
+            print(f"Warning: could not renew lease for worker {worker_id}: {e}")
+
+def run_worker(burst=False, poll_timeout=5):
+    """Drains the job queue forever (or until it is empty when burst=True).
+
+    Claimed jobs sit in this worker's own processing list, protected by a
+    lease the worker keeps renewing. Whenever the queue is idle, jobs claimed
+    by workers whose lease has expired are requeued.
+    """
+    if not kv:
+        raise ConnectionError("KV_URL not configured. Async workers require Redis.")
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    processing_key = _processing_key(worker_id)
+    kv.set(f"worker:{worker_id}:lease", int(time.time()), ex=WORKER_LEASE_SECONDS)
+    kv.sadd(WORKERS_KEY, worker_id)
+    stopped = threading.Event()
+    threading.Thread(target=_renew_worker_lease, args=(worker_id, stopped), name="worker-lease", daemon=True).start()
+
+    print(f"👷 Worker {worker_id} started, waiting for jobs on {JOB_QUEUE_KEY}")
+    try:
+        while True:
+            job_id = kv.brpoplpush(JOB_QUEUE_KEY, processing_key, timeout=poll_timeout)
+            if not job_id:
+                moved = requeue_stale_jobs()
+                if moved:
+                    print(f"♻️  Requeued {moved} jobs from dead workers")
+                elif burst:
+                    return
+                continue
+
+            job_id = _decode(job_id)
+            try:
+                process_queued_job(job_id)
+            finally:
+                kv.lrem(processing_key, 1, job_id)
+    finally:
+        stopped.set()
+        # Anything still claimed goes back to the queue; the worker's own lease no longer protects it
+        while kv.rpoplpush(processing_key, JOB_QUEUE_KEY):
+            pass
+        kv.srem(WORKERS_KEY, worker_id)
+        kv.delete(f"worker:{worker_id}:lease")
+
+def requeue_stale_jobs():
+    """Moves jobs claimed by workers whose lease has expired back onto the queue."""
+    moved = 0
+    for worker_id in kv.smembers(WORKERS_KEY):
+        worker_id = _decode(worker_id)
+        if kv.exists(f"worker:{worker_id}:lease"):
+            continue
+        while kv.rpoplpush(_processing_key(worker_id), JOB_QUEUE_KEY):
+            moved += 1
+        kv.srem(WORKERS_KEY, worker_id)
+    return moved
+
+# ==============================================================================
+# BULK JOB INGESTION (streamed JSONL/CSV uploads)
+# ==============================================================================
+#
+# A bulk upload is read a block at a time and validated row by row. Every
+# BULK_CHUNK_SIZE valid rows become one chunk of the job: its credits are
+# reserved and it is appended to job:{id}:chunks, so at most one chunk is held
+# in memory. The job is queued with its first chunk, and workers run chunks
+# while the rest of the upload is still arriving (the job hash has
+# ingesting=1 until it ends). If the upload is rejected part way, a job that
+# has not been queued is discarded; a running one is cancelled, so chunks that
+# have not started are dropped and their reservations released.
+
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 500))
+BULK_MAX_TASKS = int(os.environ.get("BULK_MAX_TASKS", 100000))
+# A worker waiting for the next chunk checks this often...
+BULK_CHUNK_WAIT_SECONDS = 0.5
+# ...and gives up on an upload that has added nothing for this long
+BULK_INGEST_TIMEOUT = int(os.environ.get("BULK_INGEST_TIMEOUT", 300))
+BULK_READ_SIZE = 64 * 1024
+BULK_MAX_LINE_BYTES = 256 * 1024
+# Upload mimetype -> format
+BULK_FORMATS = {
+    "application/x-ndjson": "jsonl",
+    "application/jsonl": "jsonl",
+    "application/json-lines": "jsonl",
+    "text/csv": "csv"
+}
+# CSV columns kept as text; other cells are parsed as JSON when they can be ("42", "true", "[...]")
+CSV_TEXT_COLUMNS = {"prompt", "negative_prompt", "provider"}
+
+def iter_upload_lines(stream):
+    """Yields the lines of a UTF-8 byte stream, newlines included, reading it in blocks."""
+    pending = b""
+    block = stream.read(BULK_READ_SIZE)
+    if block.startswith(b"\xef\xbb\xbf"):  # UTF-8 byte order mark (spreadsheet exports)
+        block = block[3:]
+    while block:
+        lines = (pending + block).split(b"\n")
+        pending = lines.pop()
+        if len(pending) > BULK_MAX_LINE_BYTES:
+            raise ValueError(f"Line longer than {BULK_MAX_LINE_BYTES} bytes")
+        for line in lines:
+            yield line.decode("utf-8") + "\n"
+        block = stream.read(BULK_READ_SIZE)
+    if pending:
+        yield pending.decode("utf-8")
+
+def _csv_cell(column, value):
+    if column in CSV_TEXT_COLUMNS:
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def iter_bulk_rows(stream, upload_format):
+    """Yields (line number, task, error) for each row of a JSONL or CSV upload.
+
+    Blank lines are skipped. A row that can't be parsed has task None and an
+    error message; damage that stops the rest of the upload being read raises
+    ValueError instead.
+    """
+    lines = iter_upload_lines(stream)
+    if upload_format == "jsonl":
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line), None
+            except ValueError as e:
+                yield line_number, None, f"Invalid JSON: {e}"
+        return
+
+    reader = csv.reader(lines)
+    try:
+        header = [column.strip() for column in next(reader)]
+    except StopIteration:
+        return
+    if "prompt" not in header:
+        raise ValueError("CSV header must include a 'prompt' column")
+    try:
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                continue
+            if len(row) > len(header):
+                yield reader.line_num, None, f"Expected {len(header)} columns, got {len(row)}"
+                continue
+            yield reader.line_num, {
+                column: _csv_cell(column, value) for column, value in zip(header, row) if value != ""
+            }, None
+    except csv.Error as e:
+        raise ValueError(f"Malformed CSV at line {reader.line_num}: {e}")
+
+def create_bulk_job(user_id, api_key_id=None):
+    """Stores an empty job in the 'ingesting' state. Returns the job id."""
+    job_id = f"job_{uuid.uuid4().hex}"
+    job_key = f"job:{job_id}"
+    now = int(time.time())
+    kv.hset(job_key, mapping={
+        "job_id": job_id,
+        "user_id": user_id,
+        "status": "ingesting",
+        "ingesting": 1,
+        "ingest_updated_at": now,
+        "total_tasks": 0,
+        "chunk_count": 0,
+        "chunks_done": 0,
+        "completed": 0,
+        "successful": 0,
+        "failed": 0,
+        "created_at": now
+    })
+    if api_key_id:
+        kv.hset(job_key, "api_key_id", api_key_id)
+    kv.expire(job_key, JOB_TTL_SECONDS)
+    return job_id
+
+def add_job_chunk(job_id, offset, tasks, reservation_id):
+    """Appends a chunk of validated tasks (with its credit reservation) to a bulk job."""
+    job_key = f"job:{job_id}"
+    pipe = kv.pipeline()
+    pipe.rpush(f"{job_key}:chunks", json.dumps({"offset": offset, "tasks": tasks, "reservation_id": reservation_id}))
+    pipe.hincrby(job_key, "chunk_count", 1)
+    pipe.hincrby(job_key, "total_tasks", len(tasks))
+    pipe.hset(job_key, "ingest_updated_at", int(time.time()))
+    pipe.expire(f"{job_key}:chunks", JOB_TTL_SECONDS)
+    pipe.execute()
+
+def start_bulk_job(job_id):
+    """Queues a bulk job for the workers once its first chunk is stored."""
+    pipe = kv.pipeline()
+    pipe.hset(f"job:{job_id}", "status", "queued")
+    pipe.lpush(JOB_QUEUE_KEY, job_id)
+    pipe.execute()
+
+def finish_bulk_ingest(job_id, error=None):
+    """Marks a bulk upload as fully read, or (with an error) cancels the chunks not yet started."""
+    mapping = {"ingesting": 0}
+    if error:
+        mapping.update({"cancelled": 1, "error": error})
+    kv.hset(f"job:{job_id}", mapping=mapping)
+
+def discard_bulk_job(job_id, user_id):
+    """Releases the reservations of a rejected upload and deletes its job."""
+    job_key = f"job:{job_id}"
+    for raw_chunk in kv.lrange(f"{job_key}:chunks", 0, -1):
+        release_credits(user_id, json.loads(raw_chunk).get("reservation_id"))
+    kv.delete(job_key, f"{job_key}:chunks")
+
+# ==============================================================================
+# JOB EXPORT (streamed ZIP/TAR archives)
+# ==============================================================================
+#
+# An export is the job's successful images (images/{index}.{ext}) followed by
+# manifest.json, written straight to the response as the images arrive. Images
+# are stored uncompressed, so the archive layout only depends on each image's
+# size: sizes, extensions and CRC-32s learned while exporting are cached in
+# job:{id}:export (task index -> JSON), and a later Range request rebuilds the
+# same bytes, fetching only the images it overlaps.
+
+EXPORT_FORMATS = {"zip": "application/zip", "tar": "application/x-tar"}
+EXPORT_FETCH_CONCURRENCY = int(os.environ.get("EXPORT_FETCH_CONCURRENCY", 8))
+EXPORT_FETCH_TIMEOUT = int(os.environ.get("EXPORT_FETCH_TIMEOUT", 60))
+# Results read from KV at a time (inline results hold whole images)
+EXPORT_RESULTS_PAGE = 100
+ZIP32_LIMIT = 0xFFFFFFFF
+
+class ZipStreamWriter:
+    """Writes a ZIP of stored (uncompressed) entries front to back.
+
+    Each entry's CRC and sizes follow its data in a data descriptor, so nothing
+    has to be seeked back to. Zip64 records are added when the archive passes
+    4 GiB or 65535 entries.
+    """
+
+    def __init__(self, mtime):
+        moment = time.gmtime(mtime)
+        self.dos_time = moment.tm_hour << 11 | moment.tm_min << 5 | moment.tm_sec // 2
+        self.dos_date = (moment.tm_year - 1980) << 9 | moment.tm_mon << 5 | moment.tm_mday
+        self.offset = 0
+        self.entries = []  # (name, crc, size, local header offset)
+
+    def begin_entry(self, name, size):
+        if size >= ZIP32_LIMIT:
+            raise ValueError(f"{name} is too large for a streamed ZIP entry")
+        name = name.encode("utf-8")
+        # Flags: sizes in the data descriptor (0x08), UTF-8 names (0x800)
+        header = struct.pack("<IHHHHHIIIHH", 0x04034b50, 20, 0x0808, 0, self.dos_time, self.dos_date,
+                             0, 0, 0, len(name), 0) + name
+        self.entries.append([name, 0, size, self.offset])
+        self.offset += len(header) + size
+        return header
+
+    def end_entry(self, crc):
+        self.entries[-1][1] = crc
+        size = self.entries[-1][2]
+        descriptor = struct.pack("<IIII", 0x08074b50, crc, size, size)
+        self.offset += len(descriptor)
+        return descriptor
+
+    def finish(self):
+        directory_offset = self.offset
+        parts = []
+        for name, crc, size, header_offset in self.entries:
+            extra = b""
+            if header_offset >= ZIP32_LIMIT:
+                extra = struct.pack("<HHQ", 0x0001, 8, header_offset)
+                header_offset = ZIP32_LIMIT
+            version = 45 if extra else 20
+            parts.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, version, version, 0x0808, 0,
+                                     self.dos_time, self.dos_date, crc, size, size, len(name), len(extra),
+                                     0, 0, 0, 0o644 << 16, header_offset) + name + extra)
+        directory_size = sum(len(part) for part in parts)
+        count = len(self.entries)
+
+        if count >= 0xFFFF or directory_offset >= ZIP32_LIMIT or directory_size >= ZIP32_LIMIT:
+            zip64_offset = directory_offset + directory_size
+            parts.append(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0,
+                                     count, count, directory_size, directory_offset))
+            parts.append(struct.pack("<IIQI", 0x07064b50, 0, zip64_offset, 1))
+        parts.append(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                 min(directory_size, ZIP32_LIMIT), min(directory_offset, ZIP32_LIMIT), 0))
+        trailer = b"".join(parts)
+        self.offset += len(trailer)
+        return trailer
+
+class TarStreamWriter:
+    """Writes a ustar archive front to back (same interface as ZipStreamWriter)."""
+
+    def __init__(self, mtime):
+        self.mtime = mtime
+        self.offset = 0
+        self.padding = 0
+
+    def begin_entry(self, name, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = self.mtime
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.USTAR_FORMAT, encoding="utf-8")
+        self.padding = -size % tarfile.BLOCKSIZE
+        self.offset += len(header) + size
+        return header
+
+    def end_entry(self, crc):
+        self.offset += self.padding
+        return b"\0" * self.padding
+
+    def finish(self):
+        self.offset += 2 * tarfile.BLOCKSIZE
+        return b"\0" * (2 * tarfile.BLOCKSIZE)
+
+def _export_extension(content_type, url=None):
+    """File extension for an image, from its URL if that has a known one, else its content type."""
+    suffix = (url or "").split("?")[0].rsplit("/", 1)[-1].rpartition(".")[2].lower()
+    suffix = "jpg" if suffix == "jpeg" else suffix
+    if suffix in BLOB_CONTENT_TYPES:
+        return suffix
+    return BLOB_EXTENSIONS.get((content_type or "").split(";")[0].strip(), "png")
+
+def _local_blob_path(url):
+    """The file behind one of this gateway's /v1/blobs URLs, if the local blob store has it."""
+    prefix = f"{API_URL}/v1/blobs/"
+    if BLOB_STORE_BACKEND != "local" or not url.startswith(prefix):
+        return None
+    key = url[len(prefix):].split("?")[0]
+    path = get_blob_store().path_for(key)
+    return path if "/" not in key and path.is_file() else None
+
+def _fetch_export_image(result):
+    """Returns (image bytes, extension) for a successful result, decoding data URLs."""
+    url = result["imageUrl"]
+    if url.startswith("data:"):
+        header, encoded = url.split(",", 1)
+        return base64.b64decode(encoded), _export_extension(header[len("data:"):].split(";")[0])
+
+    path = _local_blob_path(url)
+    if path:
+        return path.read_bytes(), _export_extension(None, path.name)
+
+    response = get_http_session("export").get(url, timeout=EXPORT_FETCH_TIMEOUT)
+    response.raise_for_status()
+    return response.content, _export_extension(response.headers.get("Content-Type"), url)
+
+def _measure_export_image(result):
+    """Export cache entry for an image, from a HEAD request where the server gives its length."""
+    url = result["imageUrl"]
+    if not url.startswith("data:") and not _local_blob_path(url):
+        response = get_http_session("export").head(url, timeout=EXPORT_FETCH_TIMEOUT, allow_redirects=True)
+        length = response.headers.get("Content-Length")
+        if response.ok and length and not response.headers.get("Content-Encoding"):
+            return {"size": int(length), "ext": _export_extension(response.headers.get("Content-Type"), url)}
+
+    data, extension = _fetch_export_image(result)
+    return {"size": len(data), "ext": extension, "crc": zlib.crc32(data)}
+
+def _ordered_prefetch(items, work):
+    """Yields (index, result, outcome) in order, running work(index, result) ahead on a thread pool.
+
+    outcome is what work returned, or the exception it raised. At most
+    EXPORT_FETCH_CONCURRENCY items are worked on at once and twice that many
+    are held, whatever the size of the job.
+    """
+    def attempt(index, result):
+        try:
+            return work(index, result)
+        except Exception as e:
+            return e
+
+    executor = ThreadPoolExecutor(max_workers=EXPORT_FETCH_CONCURRENCY, thread_name_prefix="export-fetch")
+    pending = deque()
+    try:
+        for index, result in items:
+            pending.append((index, result, executor.submit(attempt, index, result)))
+            if len(pending) > EXPORT_FETCH_CONCURRENCY * 2:
+                index, result, future = pending.popleft()
+                yield index, result, future.result()
+        while pending:
+            index, result, future = pending.popleft()
+            yield index, result, future.result()
+    finally:
+        # A client that disconnects mid-download shouldn't leave fetches queued
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _iter_job_results(job_id, total_tasks):
+    """Yields (task index, result item) for every task of a job, reading KV a page at a time."""
+    for page_start in range(0, total_tasks, EXPORT_RESULTS_PAGE):
+        indices = list(range(page_start, min(page_start + EXPORT_RESULTS_PAGE, total_tasks)))
+        for index, raw_result in zip(indices, kv.hmget(f"job:{job_id}:results", indices)):
+            yield index, json.loads(raw_result) if raw_result else {"status": "Pending"}
+
+def load_export_plan(job_id):
+    """The cached export entries of a job: task index -> {size, ext, crc} or {error}."""
+    return {int(index): json.loads(entry) for index, entry in _hgetall_decoded(f"job:{job_id}:export").items()}
+
+def _save_export_plan(job_id, entries):
+    if not entries:
+        return
+    pipe = kv.pipeline()
+    pipe.hset(f"job:{job_id}:export", mapping={index: json.dumps(entry) for index, entry in entries.items()})
+    pipe.expire(f"job:{job_id}:export", JOB_TTL_SECONDS)
+    pipe.execute()
+
+def plan_export(job_id, job, plan):
+    """Completes an export plan by measuring every successful image it doesn't cover yet."""
+    def measure(index, result):
+        if result.get("status") != "Success" or index in plan:
+            return None
+        return _measure_export_image(result)
+
+    measured = {}
+    for index, result, outcome in _ordered_prefetch(_iter_job_results(job_id, int(job["total_tasks"])), measure):
+        if isinstance(outcome, Exception):
+            measured[index] = {"error": str(outcome)}
+        elif outcome is not None:
+            measured[index] = outcome
+    _save_export_plan(job_id, measured)
+    return {**plan, **measured}
+
+def _export_entry(index, planned, fetched):
+    """The export cache entry for an image given its planned entry (if any) and what fetching it gave."""
+    if fetched is None:
+        if not planned:
+            raise LookupError(f"Image {index} has not been measured")
+        return planned
+    if isinstance(fetched, Exception):
+        if planned and "size" in planned:
+            raise RuntimeError(f"Image {index} could not be fetched again: {fetched}")
+        return {"error": str(fetched)}
+    data, extension = fetched
+    if planned and "size" in planned and len(data) != planned["size"]:
+        raise RuntimeError(f"Image {index} has changed since the export started")
+    return {"size": len(data), "ext": (planned or {}).get("ext", extension), "crc": zlib.crc32(data)}
+
+def _export_parts(job_id, job, archive_format, plan, should_fetch, learned):
+    """Yields the archive as (task index or None, bytes or None, length) in order.
+
+    Image data is None when should_fetch(index) declined to fetch it. New or
+    changed cache entries are added to plan and to learned.
+    """
+    mtime = int(job.get("finished_at") or job["created_at"])
+    writer = ZipStreamWriter(mtime) if archive_format == "zip" else TarStreamWriter(mtime)
+    images = []
+
+    def fetch(index, result):
+        if result.get("status") != "Success" or not should_fetch(index):
+            return None
+        return _fetch_export_image(result)
+
+    def piece(data):
+        return None, data, len(data)
+
+    for index, result, fetched in _ordered_prefetch(_iter_job_results(job_id, int(job["total_tasks"])), fetch):
+        row = {"index": index, "status": result.get("status"), "prompt": result.get("prompt"),
+               "provider": result.get("provider")}
+        images.append(row)
+        if result.get("status") != "Success":
+            if result.get("error"):
+                row["error"] = result["error"]
+            continue
+
+        entry = _export_entry(index, plan.get(index), fetched)
+        if entry != plan.get(index):
+            plan[index] = learned[index] = entry
+        if "error" in entry:
+            row["error"] = f"Image could not be fetched: {entry['error']}"
+            continue
+
+        row["file"] = f"images/{index:06d}.{entry['ext']}"
+        row["bytes"] = entry["size"]
+        yield piece(writer.begin_entry(row["file"], entry["size"]))
+        yield index, fetched[0] if isinstance(fetched, tuple) else None, entry["size"]
+        yield piece(writer.end_entry(entry.get("crc", 0)))
+
+    manifest = json.dumps({
+        "job_id": job_id,
+        "status": job["status"],
+        "total_tasks": int(job["total_tasks"]),
+        "successful": int(job.get("successful", 0)),
+        "failed": int(job.get("failed", 0)),
+        "created_at": int(job["created_at"]),
+        "finished_at": int(job["finished_at"]) if "finished_at" in job else None,
+        "images": images
+    }, indent=2).encode("utf-8")
+    yield piece(writer.begin_entry("manifest.json", len(manifest)))
+    yield piece(manifest)
+    yield piece(writer.end_entry(zlib.crc32(manifest)))
+    yield piece(writer.finish())
+
+def export_layout(job_id, job, archive_format, plan):
+    """Returns (archive length, {task index: (data start, data end)}) without fetching anything.
+
+    Returns None if the plan is missing an image's size.
+    """
+    position = 0
+    data_offsets = {}
+    try:
+        for index, _, length in _export_parts(job_id, job, archive_format, dict(plan), lambda index: False, {}):
+            if index is not None:
+                data_offsets[index] = (position, position + length)
+            position += length
+    except LookupError:
+        return None
+    return position, data_offsets
+
+def iter_export_archive(job_id, job, archive_format, plan, byte_range=None, data_offsets=None):
+    """Streams a job's archive, or only bytes [start, stop) of it when byte_range is given.
+
+    Ranged exports need data_offsets from export_layout; they fetch the images
+    overlapping the range, plus any whose ZIP checksum isn't cached yet.
+    """
+    start, stop = byte_range or (0, None)
+    plan = dict(plan)
+    learned = {}
+
+    def should_fetch(index):
+        entry = plan.get(index)
+        if not entry:
+            return True
+        if "error" in entry:
+            return False
+        if byte_range is None or (archive_format == "zip" and "crc" not in entry):
+            return True
+        data_start, data_end = data_offsets[index]
+        return data_start < stop and data_end > start
+
+    position = 0
+    try:
+        for index, data, length in _export_parts(job_id, job, archive_format, plan, should_fetch, learned):
+            piece_start, position = position, position + length
+            if position <= start:
+                continue
+            if stop is not None and piece_start >= stop:
+                break
+            yield data[max(start - piece_start, 0):None if stop is None else stop - piece_start]
+            if len(learned) >= EXPORT_RESULTS_PAGE:
+                _save_export_plan(job_id, learned)
+                learned.clear()
+    finally:
+        _save_export_plan(job_id, learned)
 
 # ==============================================================================
 # FLASK API ENDPOINTS
 # ==============================================================================
 
+STREAM_FORMATS = ("application/x-ndjson", "text/event-stream")
+
+def _requested_stream_format():
+    """Returns the streaming mimetype explicitly asked for in Accept, if any."""
+    accepted = [mimetype for mimetype, _ in request.accept_mimetypes]
+    for stream_format in STREAM_FORMATS:
+        if stream_format in accepted:
+            return stream_format
+    return None
+
+def _format_stream_record(stream_format, record_type, record):
+    """Serializes one record as an NDJSON line or an SSE event."""
+    started = time.perf_counter()
+    data = json.dumps(record)
+    observe_stage("serialization", started)
+    if stream_format == "text/event-stream":
+        return f"event: {record_type}\ndata: {data}\n\n"
+    return data + "\n"
+
+def _stream_job(user_id, tasks, user_credits, stream_format, **settlement):
+    """Runs a job in the background and streams each result as soon as it completes.
+
+    The job runs and is billed in its own thread, so a client disconnecting
+    mid-stream does not stop generation or skip credit settlement. settlement
+    holds the keyword arguments for settle_job.
+    """
+    records = queue.Queue()
+    # A profile of this request covers the whole job, so it is finished by the job thread
+    request.profile_deferred = True
+
+    def run():
+        try:
+            with profile_span("generate", tasks=len(tasks)):
+                results = process_job_sync(
+                    tasks,
+                    on_result=lambda index, item: records.put(("result", {"type": "result", "index": index, **item})),
+                    retain_images=False,
+                    cache_scope=user_id
+                )
+            with profile_span("settle"):
+                credits_used = settle_job(user_id, tasks, results, **settlement)
+            success_count = sum(1 for r in results if r["status"] == "Success")
+            records.put(("summary", {
+                "type": "summary",
+                "message": "Job completed successfully",
+                "request_id": settlement.get("request_id"),
+                "total_tasks": len(tasks),
+                "successful": success_count,
+                "failed": len(results) - success_count,
+                "credits_used": credits_used,
+                "credits_remaining": user_credits - credits_used
+            }))
+        except Exception as e:
+            release_credits(user_id, settlement.get("reservation_id"))
+            records.put(("error", {"type": "error", "error": f"Job processing failed: {str(e)}"}))
+        finally:
+            finish_request_profile()
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), name="job-stream", daemon=True).start()
+
+    def generate():
+        while True:
+            record_type, record = records.get()
+            yield _format_stream_record(stream_format, record_type, record)
+            if record_type != "result":
+                return
+
+    return Response(generate(), mimetype=stream_format, headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+def _validate_task(task):
+    """Checks a task's provider options. Returns (credits to reserve, None) or (None, error body)."""
+    if not isinstance(task, dict):
+        return None, {"error": "Each task must be a JSON object."}
+    if not isinstance(task.get("provider", "dalle"), str):
+        return None, {"error": "'provider' must be a string."}
+    if task.get("fallback") is not None and not isinstance(task["fallback"], list):
+        return None, {"error": "'fallback' must be an array of providers."}
+    if task.get("hedge_delay_ms") is not None and (
+            not isinstance(task["hedge_delay_ms"], (int, float)) or task["hedge_delay_ms"] < 0):
+        return None, {"error": "'hedge_delay_ms' must be a non-negative number."}
+    # A hedged task is reserved at its most expensive provider
+    chain = provider_chain(task)
+    for provider in chain:
+        if provider not in PROVIDER_COSTS:
+            return None, {
+                "error": f"Unknown provider: {provider}",
+                "supported_providers": list(PROVIDER_COSTS.keys())
+            }
+    return max(PROVIDER_COSTS[provider] for provider in chain), None
+
 @app.route('/v1/jobs/create', methods=['POST'])
 @require_api_key
 def create_job():
-    """Create and process job synchronously with API key authentication and credit deduction"""
+    """Create and process job (synchronously, or queued with 'async') with API key authentication and credit deduction"""
+    started_at = time.time()
+    request_id = request.request_id
+
     if not request.json or 'tasks' not in request.json:
         return jsonify({
             "error": "Request must be JSON with 'tasks' array.",
@@ -528,22 +3922,38 @@ def create_job():
     if len(tasks) > 100:
         return jsonify({"error": "Maximum 100 tasks per request."}), 400
 
+    # Images are returned as short URLs unless inline base64 is requested
+    if request.json.get("inline_images"):
+        tasks = [dict(task, inline=task.get("inline", True)) for task in tasks]
+
+    user_id = request.user['user_id']
+    reservation_id = None
     try:
         # Calculate total credits needed
         total_credits_needed = 0
         for task in tasks:
-            provider = task.get("provider", "dalle").lower()
-            if provider in PROVIDER_COSTS:
-                total_credits_needed += PROVIDER_COSTS[provider]
-            else:
-                return jsonify({
-                    "error": f"Unknown provider: {provider}",
-                    "supported_providers": list(PROVIDER_COSTS.keys())
-                }), 400
-
-        # Check if user has enough credits
-        user_credits = request.user.get("credits", 0)
-        if user_credits < total_credits_needed:
+            credits, error = _validate_task(task)
+            if error:
+                return jsonify(error), 400
+            total_credits_needed += credits
+
+        async_mode = request.json.get("async") or request.args.get("mode") == "async"
+        if async_mode and not kv:
+            return jsonify({
+                "error": "Async jobs are unavailable",
+                "message": "Job queue is not configured. Retry without 'async'."
+            }), 503
+
+        # Reserve the worst-case cost so concurrent jobs can't overspend
+        started = time.perf_counter()
+        with profile_span("credit_check"):
+            reservation_id, user_credits = reserve_credits(
+                user_id, total_credits_needed, request.user.get("credits", 0),
+                hold_seconds=JOB_TTL_SECONDS if async_mode else CREDIT_RESERVATION_TTL
+            )
+        insufficient = reservation_id is None and user_credits < total_credits_needed
+        observe_stage("credit_check", started, "insufficient" if insufficient else "success")
+        if insufficient:
             return jsonify({
                 "error": "Insufficient credits",
                 "credits_needed": total_credits_needed,
@@ -551,74 +3961,331 @@ def create_job():
                 "message": "Purchase more credits at https://bigapi.io/dashboard/billing"
             }), 402  # Payment Required
 
-        # Process all tasks synchronously
-        results = process_job_sync(tasks)
-
-        # Calculate actual credits used (only for successful generations)
-        actual_credits_used = 0
-        for i, result in enumerate(results):
-            if result["status"] == "Success":
-                provider = tasks[i].get("provider", "dalle").lower()
-                actual_credits_used += PROVIDER_COSTS.get(provider, 0)
-
-        # Deduct credits from user account
-        if actual_credits_used > 0:
-            deduct_credits(request.user['user_id'], actual_credits_used, {
-                "task_count": len(tasks),
-                "providers_used": [task.get("provider") for task in tasks],
-                "success_count": sum(1 for r in results if r["status"] == "Success")
-            })
+        settlement = {
+            "request_id": request_id,
+            "api_key_id": request.user.get('api_key_id'),
+            "started_at": started_at,
+            "reservation_id": reservation_id
+        }
 
-            # Log usage to Supabase
-            if supabase:
-                try:
-                    supabase.table('usage_logs').insert({
-                        'user_id': request.user['user_id'],
-                        'provider': ', '.join(set([task.get("provider") for task in tasks])),
-                        'credits_used': actual_credits_used,
-                        'task_count': len(tasks),
-                        'success_count': sum(1 for r in results if r["status"] == "Success"),
-                        'failed_count': len(results) - sum(1 for r in results if r["status"] == "Success"),
-                        'metadata': json.dumps({"providers_used": [task.get("provider") for task in tasks]})
-                    }).execute()
-                except Exception as e:
-                    print(f"Error logging usage: {e}")
+        # Async mode: enqueue and return immediately, workers do the rest
+        if async_mode:
+            job_id = enqueue_job(user_id, tasks, api_key_id=settlement["api_key_id"], reservation_id=reservation_id)
+            return jsonify({
+                "message": "Job queued",
+                "job_id": job_id,
+                "status": "queued",
+                "total_tasks": len(tasks),
+                "status_url": f"/v1/jobs/status/{job_id}",
+                "results_url": f"/v1/jobs/results/{job_id}"
+            }), 202
+
+        # Streaming mode: emit each result as it completes
+        stream_format = _requested_stream_format()
+        if stream_format:
+            return _stream_job(user_id, tasks, user_credits, stream_format, **settlement)
+
+        # Process all tasks concurrently (bounded by per-provider caps)
+        started = time.perf_counter()
+        with profile_span("generate", tasks=len(tasks)):
+            results = process_job_sync(tasks, cache_scope=user_id)
+        observe_stage("generate", started)
+
+        # Deduct credits for successful generations and log usage
+        with profile_span("settle"):
+            actual_credits_used = settle_job(user_id, tasks, results, **settlement)
 
         # Count successes and failures
         success_count = sum(1 for r in results if r["status"] == "Success")
         failure_count = len(results) - success_count
 
-        return jsonify({
-            "message": "Job completed successfully",
-            "total_tasks": len(tasks),
-            "successful": success_count,
-            "failed": failure_count,
-            "credits_used": actual_credits_used,
-            "credits_remaining": user_credits - actual_credits_used,
-            "results": results
-        }), 200
+        started = time.perf_counter()
+        with profile_span("serialization"):
+            response = jsonify({
+                "message": "Job completed successfully",
+                "request_id": request_id,
+                "total_tasks": len(tasks),
+                "successful": success_count,
+                "failed": failure_count,
+                "credits_used": actual_credits_used,
+                "credits_remaining": user_credits - actual_credits_used,
+                "results": results
+            })
+        observe_stage("serialization", started)
+        return response, 200
 
     except Exception as e:
+        release_credits(user_id, reservation_id)
         return jsonify({
             "error": f"Job processing failed: {str(e)}",
             "message": "Check your request format and try again"
         }), 500
 
+@app.route('/v1/jobs/bulk', methods=['POST'])
+@require_api_key
+def create_bulk_job_upload():
+    """Queue a job from a streamed JSONL or CSV upload of up to BULK_MAX_TASKS tasks"""
+    if not kv:
+        return jsonify({
+            "error": "Bulk jobs are unavailable",
+            "message": "Job queue is not configured."
+        }), 503
+
+    upload_format = request.args.get("format") or BULK_FORMATS.get(request.mimetype)
+    if upload_format not in ("jsonl", "csv"):
+        return jsonify({
+            "error": "Upload must be JSONL or CSV.",
+            "message": "Send Content-Type: application/x-ndjson or text/csv, or add ?format=jsonl|csv."
+        }), 415
+
+    skip_invalid = request.args.get("on_error") == "skip"
+    inline_images = request.args.get("inline_images") in ("1", "true")
+    user_id = request.user['user_id']
+    fallback_credits = request.user.get("credits", 0)
+    job_id = create_bulk_job(user_id, api_key_id=request.user.get('api_key_id'))
+
+    total_tasks = 0
+    credits_reserved = 0
+    skipped = 0
+    row_errors = []
+    chunk = []
+    chunk_credits = 0
+    queued = False
+
+    def reject(status, body):
+        if not queued:
+            discard_bulk_job(job_id, user_id)
+            return jsonify(body), status
+        # Earlier chunks may already be running; stop the job after them
+        finish_bulk_ingest(job_id, error=body["error"])
+        return jsonify(dict(body, job_id=job_id, status_url=f"/v1/jobs/status/{job_id}",
+                            message="The upload was rejected. Chunks that had already started still finish "
+                                    "and are charged; the rest of the job is cancelled.")), status
+
+    def flush_chunk():
+        """Reserves credits for the buffered chunk and stores it. Returns an error response or None."""
+        nonlocal credits_reserved, chunk, chunk_credits, queued
+        started = time.perf_counter()
+        with profile_span("credit_check"):
+            reservation_id, user_credits = reserve_credits(user_id, chunk_credits, fallback_credits,
+                                                           hold_seconds=JOB_TTL_SECONDS)
+        # Without a ledger the cached balance has to cover every chunk so far
+        insufficient = reservation_id is None and user_credits < credits_reserved + chunk_credits
+        observe_stage("credit_check", started, "insufficient" if insufficient else "success")
+        if insufficient:
+            return reject(402, {
+                "error": "Insufficient credits",
+                "credits_needed": credits_reserved + chunk_credits,
+                "credits_available": user_credits,
+                "tasks_read": total_tasks,
+                "message": "Purchase more credits at https://bigapi.io/dashboard/billing"
+            })
+        if queued:
+            status, cancelled = kv.hmget(f"job:{job_id}", ["status", "cancelled"])
+            if cancelled or _decode(status) == "failed":
+                release_credits(user_id, reservation_id)
+                return reject(409, {"error": "Bulk job stopped while the upload was being read."})
+        add_job_chunk(job_id, total_tasks - len(chunk), chunk, reservation_id)
+        credits_reserved += chunk_credits
+        chunk, chunk_credits = [], 0
+        if not queued:
+            # Workers start on the first chunk while the rest is still uploading
+            start_bulk_job(job_id)
+            queued = True
+        return None
+
+    try:
+        with profile_span("ingest"):
+            for line_number, task, error in iter_bulk_rows(request.stream, upload_format):
+                if error is None and not (isinstance(task, dict) and isinstance(task.get("prompt"), str)
+                                          and task["prompt"].strip()):
+                    error = "Each row needs a non-empty 'prompt'."
+                credits = None
+                if error is None:
+                    credits, invalid = _validate_task(task)
+                    error = invalid and invalid["error"]
+                if error:
+                    if not skip_invalid:
+                        return reject(400, {"error": f"Line {line_number}: {error}", "line": line_number})
+                    skipped += 1
+                    if len(row_errors) < 20:
+                        row_errors.append({"line": line_number, "error": error})
+                    continue
+
+                if total_tasks >= BULK_MAX_TASKS:
+                    return reject(413, {"error": f"Maximum {BULK_MAX_TASKS} tasks per bulk job."})
+                if inline_images:
+                    task = dict(task, inline=task.get("inline", True))
+                chunk.append(task)
+                chunk_credits += credits
+                total_tasks += 1
+                if len(chunk) >= BULK_CHUNK_SIZE:
+                    error_response = flush_chunk()
+                    if error_response:
+                        return error_response
+
+            if chunk:
+                error_response = flush_chunk()
+                if error_response:
+                    return error_response
+    except ValueError as e:
+        return reject(400, {"error": f"Could not read upload: {str(e)}"})
+    except Exception as e:
+        return reject(500, {"error": f"Bulk ingestion failed: {str(e)}"})
+
+    if not total_tasks:
+        return reject(400, {"error": "Upload contains no valid tasks.", "skipped": skipped, "errors": row_errors})
+
+    finish_bulk_ingest(job_id)
+    return jsonify({
+        "message": "Job queued",
+        "job_id": job_id,
+        "status": _decode(kv.hget(f"job:{job_id}", "status")),
+        "total_tasks": total_tasks,
+        "credits_reserved": credits_reserved,
+        "skipped": skipped,
+        "errors": row_errors,
+        "status_url": f"/v1/jobs/status/{job_id}",
+        "results_url": f"/v1/jobs/results/{job_id}"
+    }), 202
+
+def _get_owned_job(job_id):
+    """Returns (job, None) for a job owned by the caller, else (None, error_response)."""
+    if not kv:
+        return None, (jsonify({"error": "Async jobs are unavailable"}), 503)
+
+    job = get_job(job_id)
+    if not job or job.get("user_id") != request.user.get("user_id"):
+        return None, (jsonify({"error": f"Job not found: {job_id}"}), 404)
+
+    return job, None
+
+def _job_summary(job):
+    """Formats the job metadata hash for API responses."""
+    total_tasks = int(job.get("total_tasks", 0))
+    completed = int(job.get("completed", 0))
+    summary = {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "total_tasks": total_tasks,
+        "completed": completed,
+        "successful": int(job.get("successful", 0)),
+        "failed": int(job.get("failed", 0)),
+        "progress": round(completed / total_tasks * 100, 1) if total_tasks else 100.0,
+        "created_at": int(job["created_at"])
+    }
+    if "started_at" in job:
+        summary["started_at"] = int(job["started_at"])
+    if "finished_at" in job:
+        summary["finished_at"] = int(job["finished_at"])
+    if "credits_used" in job:
+        summary["credits_used"] = int(job["credits_used"])
+    if "error" in job:
+        summary["error"] = job["error"]
+    if "ingesting" in job:
+        summary["ingesting"] = bool(int(job["ingesting"]))
+    return summary
+
+def _task_page(summary):
+    """Task indices requested with ?offset= and ?limit= (at most JOB_PAGE_SIZE), noting the next page in summary."""
+    try:
+        offset = max(int(request.args.get("offset", 0)), 0)
+        limit = min(max(int(request.args.get("limit", JOB_PAGE_SIZE)), 1), JOB_PAGE_SIZE)
+    except ValueError:
+        offset, limit = 0, JOB_PAGE_SIZE
+    indices = range(offset, min(offset + limit, summary["total_tasks"]))
+    if indices.stop < summary["total_tasks"]:
+        summary["next_offset"] = indices.stop
+    return indices
+
 @app.route('/v1/jobs/status/<job_id>', methods=['GET'])
+@require_api_key
 def get_job_status(job_id):
-    """Legacy endpoint - jobs are now processed synchronously"""
-    return jsonify({
-        "message": "Jobs are now processed synchronously. Use /v1/jobs/create to get immediate results.",
-        "status": "deprecated"
-    }), 200
+    """Get progress of an async job, including the state of every task (paged for bulk jobs)"""
+    job, error = _get_owned_job(job_id)
+    if error:
+        return error
+
+    summary = _job_summary(job)
+    indices = _task_page(summary)
+    task_status = kv.hmget(f"job:{job_id}:task_status", list(indices)) if indices else []
+    summary["tasks"] = [
+        {"index": i, "status": _decode(status) or "Pending"}
+        for i, status in zip(indices, task_status)
+    ]
+    return jsonify(summary), 200
 
 @app.route('/v1/jobs/results/<job_id>', methods=['GET'])
+@require_api_key
 def get_job_results(job_id):
-    """Legacy endpoint - jobs are now processed synchronously"""
-    return jsonify({
-        "message": "Jobs are now processed synchronously. Use /v1/jobs/create to get immediate results.",
-        "status": "deprecated"
-    }), 200
+    """Get results of an async job. Unfinished tasks are reported as Pending."""
+    job, error = _get_owned_job(job_id)
+    if error:
+        return error
+
+    summary = _job_summary(job)
+    indices = _task_page(summary)
+    raw_results = kv.hmget(f"job:{job_id}:results", list(indices)) if indices else []
+    summary["results"] = [
+        json.loads(raw_result) if raw_result else {"status": "Pending"}
+        for raw_result in raw_results
+    ]
+    return jsonify(summary), 200
+
+@app.route('/v1/jobs/export/<job_id>', methods=['GET'])
+@require_api_key
+def export_job(job_id):
+    """Download every image of a finished async job as one ZIP (default) or TAR archive with a manifest"""
+    job, error = _get_owned_job(job_id)
+    if error:
+        return error
+
+    archive_format = request.args.get("format", "zip").lower()
+    if archive_format not in EXPORT_FORMATS:
+        return jsonify({"error": "'format' must be 'zip' or 'tar'."}), 400
+    if job["status"] not in ("completed", "failed"):
+        return jsonify({
+            "error": "Job has not finished yet",
+            "status": job["status"],
+            "message": "Export the job once its status is 'completed' or 'failed'."
+        }), 409
+
+    etag = '"' + hashlib.sha256(f"{job_id}:{job.get('finished_at')}:{archive_format}".encode()).hexdigest()[:32] + '"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{job_id}.{archive_format}"',
+        "X-Accel-Buffering": "no"
+    }
+    byte_range = request.range
+    if byte_range and request.headers.get("If-Range", etag) != etag:
+        byte_range = None
+
+    plan = load_export_plan(job_id)
+    if byte_range:
+        # A range needs the final archive length up front, so measure every image first
+        plan = plan_export(job_id, job, plan)
+    layout = export_layout(job_id, job, archive_format, plan)
+    if layout is None:
+        # First export of this job: sizes are learned as it streams
+        archive = iter_export_archive(job_id, job, archive_format, plan)
+        return Response(archive, mimetype=EXPORT_FORMATS[archive_format], headers=headers)
+
+    total_length, data_offsets = layout
+    span = byte_range.range_for_length(total_length) if byte_range else None
+    if byte_range and span is None and len(byte_range.ranges) == 1:
+        return Response(status=416, headers=dict(headers, **{"Content-Range": f"bytes */{total_length}"}))
+    if span is None:
+        # No range (or several, which are answered with the whole archive)
+        archive = iter_export_archive(job_id, job, archive_format, plan)
+        return Response(archive, mimetype=EXPORT_FORMATS[archive_format],
+                        headers=dict(headers, **{"Content-Length": str(total_length)}))
+
+    archive = iter_export_archive(job_id, job, archive_format, plan, byte_range=span, data_offsets=data_offsets)
+    return Response(archive, status=206, mimetype=EXPORT_FORMATS[archive_format], headers=dict(headers, **{
+        "Content-Length": str(span[1] - span[0]),
+        "Content-Range": f"bytes {span[0]}-{span[1] - 1}/{total_length}"
+    }))
 
 # ==============================================================================
 # DASHBOARD API ENDPOINTS
@@ -632,51 +4299,22 @@ def get_dashboard_stats():
         user_id = request.user.get("user_id")
 
         # Get user's current credits
-        current_credits = request.user.get("credits", 0)
+        current_credits = credit_balance(user_id, request.user.get("credits", 0))
 
-        # Get usage logs from Redis
-        usage_logs = []
-        if kv:
-            usage_key = f"usage:{user_id}"
-            raw_logs = kv.lrange(usage_key, 0, 999)  # Get last 1000 entries
-            for log in raw_logs:
-                try:
-                    usage_logs.append(json.loads(log))
-                except:
-                    continue
-
-        # Calculate statistics
-        total_api_calls = len(usage_logs)
-        total_credits_used = sum(log.get("credits_used", 0) for log in usage_logs)
-
-        # Count images generated (successful tasks)
-        total_images = 0
-        provider_usage = {}
-        for log in usage_logs:
-            task_details = log.get("task_details", {})
-            success_count = task_details.get("success_count", 0)
-            total_images += success_count
-
-            # Count provider usage
-            providers = task_details.get("providers_used", [])
-            for provider in providers:
-                provider_usage[provider] = provider_usage.get(provider, 0) + 1
+        # Read the incrementally maintained rollups
+        totals, providers = get_usage_totals(user_id)
+        total_api_calls = totals["calls"]
+        total_credits_used = totals["credits"]
+        total_images = totals["images"]
+        provider_usage = {provider: counts["tasks"] for provider, counts in providers.items()}
 
         # Calculate success rate
         success_rate = 95.5  # Default fallback
-        if usage_logs:
-            total_tasks = sum(log.get("task_details", {}).get("task_count", 0) for log in usage_logs)
-            if total_tasks > 0:
-                success_rate = (total_images / total_tasks) * 100
+        if totals["tasks"] > 0:
+            success_rate = (total_images / totals["tasks"]) * 100
 
         # Get recent activity (last 10 calls)
-        recent_activity = []
-        for log in usage_logs[:10]:
-            recent_activity.append({
-                "timestamp": log.get("timestamp"),
-                "credits_used": log.get("credits_used"),
-                "task_details": log.get("task_details")
-            })
+        recent_activity = get_recent_usage(user_id)
 
         return jsonify({
             "credits_remaining": current_credits,
@@ -693,61 +4331,80 @@ def get_dashboard_stats():
             "error": f"Failed to fetch dashboard stats: {str(e)}"
         }), 500
 
+def _parse_time_param(value, default=None):
+    """Parses unix seconds or an ISO 8601 date/time (UTC unless an offset is given)."""
+    if not value:
+        if default is None:
+            raise ValueError("missing time")
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
 @app.route('/v1/dashboard/usage', methods=['GET'])
 @require_api_key
 def get_usage_analytics():
-    """Get detailed usage analytics for the authenticated user"""
+    """Get detailed usage analytics for the authenticated user
+
+    Either a period (24h, 7d, 30d, 90d) or an explicit from/to range (unix
+    seconds or ISO 8601), bucketed by day or hour.
+    """
     try:
         user_id = request.user.get("user_id")
         period = request.args.get("period", "7d")  # 24h, 7d, 30d, 90d
+        granularity = request.args.get("granularity", "day")
+        if granularity not in USAGE_GRANULARITIES:
+            return jsonify({"error": "granularity must be 'hour' or 'day'"}), 400
 
         # Calculate time range
         now = time.time()
-        if period == "24h":
-            start_time = now - (24 * 3600)
-        elif period == "7d":
-            start_time = now - (7 * 24 * 3600)
-        elif period == "30d":
-            start_time = now - (30 * 24 * 3600)
-        elif period == "90d":
-            start_time = now - (90 * 24 * 3600)
-        else:
-            start_time = now - (7 * 24 * 3600)  # Default to 7 days
+        try:
+            end_time = _parse_time_param(request.args.get("to"), now)
+            if request.args.get("from"):
+                start_time = _parse_time_param(request.args["from"])
+                period = "custom"
+            elif period == "24h":
+                start_time = end_time - (24 * 3600)
+            elif period == "7d":
+                start_time = end_time - (7 * 24 * 3600)
+            elif period == "30d":
+                start_time = end_time - (30 * 24 * 3600)
+            elif period == "90d":
+                start_time = end_time - (90 * 24 * 3600)
+            else:
+                start_time = end_time - (7 * 24 * 3600)  # Default to 7 days
+        except ValueError as e:
+            return jsonify({"error": f"Invalid time range: {e}"}), 400
+        if start_time > end_time:
+            return jsonify({"error": "'from' must be before 'to'"}), 400
 
-        # Get usage logs from Redis
-        usage_logs = []
-        if kv:
-            usage_key = f"usage:{user_id}"
-            raw_logs = kv.lrange(usage_key, 0, 999)
-            for log in raw_logs:
-                try:
-                    log_data = json.loads(log)
-                    if log_data.get("timestamp", 0) >= start_time:
-                        usage_logs.append(log_data)
-                except:
-                    continue
+        try:
+            series = get_usage_series(user_id, start_time, end_time, granularity)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        # Process analytics
+        # Aggregate the buckets of the range
         daily_usage = {}
         provider_stats = {}
-        total_calls = len(usage_logs)
-        total_credits = sum(log.get("credits_used", 0) for log in usage_logs)
-
-        for log in usage_logs:
-            # Daily usage
-            date_key = time.strftime("%Y-%m-%d", time.localtime(log.get("timestamp", 0)))
-            if date_key not in daily_usage:
-                daily_usage[date_key] = {"calls": 0, "credits": 0}
-            daily_usage[date_key]["calls"] += 1
-            daily_usage[date_key]["credits"] += log.get("credits_used", 0)
-
-            # Provider stats
-            providers = log.get("task_details", {}).get("providers_used", [])
-            for provider in providers:
+        label_format = "%Y-%m-%dT%H:00:00Z" if granularity == "hour" else "%Y-%m-%d"
+        for bucket_start, counters, providers in series:
+            daily_usage[time.strftime(label_format, time.gmtime(bucket_start))] = {
+                "calls": counters["calls"],
+                "credits": counters["credits"]
+            }
+            for provider, counts in providers.items():
                 if provider not in provider_stats:
                     provider_stats[provider] = {"calls": 0, "credits": 0}
-                provider_stats[provider]["calls"] += 1
-                provider_stats[provider]["credits"] += PROVIDER_COSTS.get(provider, 0)
+                provider_stats[provider]["calls"] += counts["tasks"]
+                provider_stats[provider]["credits"] += counts["credits"]
+
+        total_calls = sum(data["calls"] for data in daily_usage.values())
+        total_credits = sum(data["credits"] for data in daily_usage.values())
 
         # Convert to arrays for frontend
         daily_data = [
@@ -762,6 +4419,9 @@ def get_usage_analytics():
 
         return jsonify({
             "period": period,
+            "from": int(start_time),
+            "to": int(end_time),
+            "granularity": granularity,
             "total_calls": total_calls,
             "total_credits": total_credits,
             "daily_usage": daily_data,
@@ -905,13 +4565,15 @@ def delete_api_key(key_id):
 
         user_id = user_response.user.id
 
+        # Look up the hash first so the cached key can be invalidated
+        key_response = supabase.table('api_keys').select('key_hash').eq('id', key_id).eq('user_id', user_id).execute()
+
         # Delete API key
         supabase.table('api_keys').delete().eq('id', key_id).eq('user_id', user_id).execute()
 
-        # Clear cache
-        if kv:
-            # We don't have the key_hash here, so just clear all caches
-            pass
+        # Clear cache on every instance
+        for row in key_response.data or []:
+            invalidate_api_key(row['key_hash'])
 
         return jsonify({"message": "API key deleted successfully"}), 200
 
@@ -920,6 +4582,111 @@ def delete_api_key(key_id):
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/v1/blobs/<path:key>', methods=['GET'])
+def get_blob(key):
+    """Serve an offloaded image from the local blob store (signed, expiring URL)"""
+    if BLOB_STORE_BACKEND != "local":
+        return jsonify({"error": "Blob not found"}), 404
+
+    try:
+        expires = int(request.args.get("expires", 0))
+    except ValueError:
+        expires = 0
+    signature = request.args.get("signature", "")
+    if expires < time.time() or not hmac.compare_digest(signature, sign_blob_path(key, expires)):
+        return jsonify({"error": "Invalid or expired blob URL"}), 403
+
+    path = get_blob_store().path_for(key)
+    if "/" in key or not path.is_file():
+        return jsonify({"error": "Blob not found"}), 404
+
+    content_type = BLOB_CONTENT_TYPES.get(key.rsplit(".", 1)[-1], "application/octet-stream")
+    return send_file(path, mimetype=content_type, conditional=True, max_age=BLOB_URL_TTL)
+
+@app.route('/v1/system/health', methods=['GET'])
+def get_system_health():
+    """Circuit breaker state and rolling health score for every provider backend"""
+    if not kv:
+        return jsonify({"circuit_breakers": "disabled", "message": "KV_URL not configured"}), 200
+    try:
+        providers = get_provider_health()
+    except Exception as e:
+        return jsonify({"error": f"Failed to fetch provider health: {str(e)}"}), 500
+
+    degraded = [backend for backend, health in providers.items() if health["state"] != "closed"]
+    return jsonify({
+        "status": "degraded" if degraded else "operational",
+        "degraded_providers": degraded,
+        "providers": providers
+    }), 200
+
+@app.route('/v1/system/http-pools', methods=['GET'])
+def get_http_pools():
+    """Connection pool statistics for the provider HTTP sessions of this instance"""
+    return jsonify({"pools": get_http_pool_stats()}), 200
+
+@app.before_request
+def _start_request_timer():
+    request.metrics_started = time.perf_counter()
+    request.request_id = f"req_{uuid.uuid4().hex}"
+    if request.headers.get("X-Profile") == "1" and is_admin_request():
+        start_request_profile(request.request_id)
+
+@app.after_request
+def _record_request_metrics(response):
+    started = getattr(request, "metrics_started", None)
+    # The route pattern, not the path, keeps job ids out of the labels
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+    if started is not None:
+        HTTP_LATENCY.labels(endpoint).observe(time.perf_counter() - started)
+
+    server_timing = getattr(request, "server_timing", None)
+    if server_timing and started is not None:
+        # A streamed response only has the stages that ran before its first byte
+        entries = [f"{stage};dur={elapsed * 1000:.2f}" for stage, elapsed in server_timing]
+        entries.append(f"total;dur={(time.perf_counter() - started) * 1000:.2f}")
+        response.headers["Server-Timing"] = ", ".join(entries)
+
+    if _current_profile.get() is not None:
+        response.headers["X-Profile-Id"] = request.request_id
+        if not getattr(request, "profile_deferred", False):
+            finish_request_profile()
+    return response
+
+@app.teardown_request
+def _clear_request_profile(error=None):
+    # Worker threads are reused across requests
+    _current_profile.set(None)
+    _current_span.set(None)
+
+@app.route('/v1/admin/profiles/<request_id>', methods=['GET'])
+def get_request_profile(request_id):
+    """Download a stored request profile (admin only). ?format=folded returns flame graph input."""
+    if not is_admin_request():
+        return jsonify({"error": "Admin token required"}), 403
+    report = get_stored_profile(request_id)
+    if report is None:
+        return jsonify({"error": "Profile not found or expired"}), 404
+    if request.args.get("format") == "folded":
+        folded = "\n".join(f"{sample['stack']} {sample['count']}" for sample in report["samples"])
+        return Response(folded + "\n", mimetype="text/plain")
+    return jsonify(report), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics for this instance (all worker processes in multiprocess mode)"""
+    if METRICS_TOKEN:
+        auth_header = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(auth_header, f"Bearer {METRICS_TOKEN}"):
+            return jsonify({"error": "Invalid metrics token"}), 401
+    return Response(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
+@app.route('/v1/system/cold-start', methods=['GET'])
+def get_cold_start():
+    """Import and initialization cost of this instance's lazily built clients"""
+    return jsonify(get_cold_start_report()), 200
+
 @app.route('/')
 def index():
     return jsonify({
@@ -930,5 +4697,7 @@ def index():
         "dashboard": "https://bigapi.io/dashboard"
     })
 
+_cold_start_timings["module_load_ms"] = round((time.perf_counter() - _MODULE_LOAD_STARTED) * 1000, 1)
+
 if __name__ == '__main__':
     app.run(debug=True)
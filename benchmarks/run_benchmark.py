@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Offline Benchmark for BIG API
+Drives POST /v1/jobs/create through the Flask test client against the stub
+provider servers (benchmarks/stub_providers.py, run in a child process) for
+every combination of job size and provider mix, and reports jobs/sec,
+per-task p50/p95/p99 and peak RSS.
+
+Authentication is bypassed and database writes are discarded, so the numbers
+cover the gateway itself: request handling, dispatch, concurrency caps,
+polling, blob offload and serialization. Pass --redis-url to include Redis
+(rate limits, circuit breakers, ledger, rollups) in the measurement.
+
+    python benchmarks/run_benchmark.py --save-baseline benchmarks/baseline.json
+    python benchmarks/run_benchmark.py --compare benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from stub_providers import gateway_environment, load_profiles, serve
+
+# Providers cycled through the tasks of each job
+PROVIDER_MIXES = {
+    "inline": ["reve", "gemini"],               # base64 responses, offloaded to blob storage
+    "direct": ["minimax", "dalle"],             # URL responses
+    "polled": ["flux-dev", "seedream-4", "qwen-image"],
+    "mixed": ["reve", "gemini", "minimax", "dalle", "flux-dev", "seedream-4"],
+}
+
+BENCHMARK_USER = {
+    "user_id": "00000000-0000-0000-0000-00000000bench",
+    "email": "benchmark@bigapi.local",
+    "credits": 10**9,
+    "plan": "enterprise",
+    "api_key_id": None,
+}
+
+# Metrics compared against a baseline, and whether higher is better
+COMPARED_METRICS = {"jobs_per_sec": True, "task_p95_ms": False, "task_p99_ms": False}
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list (None if empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (the stubs run in another process)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def start_stub_providers(profiles):
+    """Starts the stub server in a child process and returns (process, base_url)."""
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(profiles, "127.0.0.1", 0, ready), daemon=True)
+    process.start()
+    return process, ready.get(timeout=10)
+
+def load_gateway(base_url, redis_url=None):
+    """Imports api_gateway wired to the stubs, with auth bypassed and DB writes discarded."""
+    stub_env = gateway_environment(base_url)
+    os.environ.update(stub_env)
+    os.environ.setdefault("BLOB_STORE_DIR", tempfile.mkdtemp(prefix="big-bench-blobs-"))
+    os.environ.setdefault("BLOB_STORE_BACKEND", "local")
+    os.environ.setdefault("BLOB_SIGNING_SECRET", "benchmark")
+    os.environ.setdefault("API_URL", "http://127.0.0.1:5000")
+
+    import api_gateway as gateway
+
+    # .env files are loaded with override=True, so re-apply the stub endpoints
+    gateway.REVE_API_URL = stub_env["REVE_API_URL"]
+    gateway.GEMINI_API_URL = stub_env["GEMINI_API_URL"]
+    gateway.MINIMAX_API_URL = stub_env["MINIMAX_API_URL"]
+    gateway.BFL_API_URL_BASE = stub_env["BFL_API_URL_BASE"]
+    gateway.FAL_QUEUE_URL = stub_env["FAL_QUEUE_URL"]
+    for name in ("REVE_API_KEY", "GEMINI_API_KEY", "MINIMAX_API_KEY", "BFL_API_KEY", "FAL_KEY"):
+        setattr(gateway, name, stub_env[name])
+    gateway.openai_client = gateway.LazyClient(
+        "openai", "openai",
+        lambda openai: openai.OpenAI(api_key="stub", base_url=stub_env["OPENAI_BASE_URL"]),
+        "Warning: OpenAI client failed to initialize."
+    )
+
+    gateway.validate_api_key = lambda api_key: dict(BENCHMARK_USER)
+    gateway.supabase = None
+    gateway.kv = None
+    if redis_url:
+        import redis
+        gateway.kv = redis.from_url(redis_url)
+    for pipeline in (gateway.usage_log_pipeline, gateway.credit_settlement_pipeline):
+        pipeline.write_rows = lambda rows: None
+
+    return gateway
+
+def run_job(client, mix, size, job_number, stream):
+    """Runs one job; returns (job latency, [per-task latencies], failed task count)."""
+    providers = PROVIDER_MIXES[mix]
+    tasks = [
+        {"prompt": f"benchmark {mix} job {job_number} task {i}", "provider": providers[i % len(providers)]}
+        for i in range(size)
+    ]
+    headers = {"Authorization": "Bearer big_benchmark"}
+    if stream:
+        headers["Accept"] = "application/x-ndjson"
+
+    started = time.perf_counter()
+    response = client.post("/v1/jobs/create", json={"tasks": tasks}, headers=headers, buffered=not stream)
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+    task_latencies = []
+    failed = 0
+    if stream:
+        # Each task's latency is when its result line reached the client
+        buffer = b""
+        for chunk in response.response:
+            buffer += chunk if isinstance(chunk, bytes) else chunk.encode()
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                record = json.loads(line)
+                if record["type"] == "result":
+                    task_latencies.append(time.perf_counter() - started)
+                    failed += record["status"] != "Success"
+                elif record["type"] == "error":
+                    raise RuntimeError(record["error"])
+        response.close()
+        job_latency = time.perf_counter() - started
+    else:
+        body = response.get_json()
+        job_latency = time.perf_counter() - started
+        # Without streaming every task reaches the client with the whole job
+        task_latencies = [job_latency] * len(body["results"])
+        failed = body["failed"]
+
+    return job_latency, task_latencies, failed
+
+def run_scenario(client, mix, size, jobs, concurrency, stream, warmup=1):
+    """Runs `jobs` jobs of `size` tasks, `concurrency` at a time, and summarizes them.
+
+    `warmup` unmeasured jobs run first, so the poll scheduler has learned the
+    stub providers' completion times before measurement starts.
+    """
+    job_latencies, task_latencies = [], []
+    failed_tasks = errors = 0
+
+    for n in range(warmup):
+        try:
+            run_job(client, mix, size, f"warmup-{n}", stream)
+        except Exception as e:
+            print(f"   ⚠️ warmup job failed: {e}")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_job, client, mix, size, n, stream) for n in range(jobs)]
+        for future in futures:
+            try:
+                job_latency, latencies, failed = future.result()
+            except Exception as e:
+                errors += 1
+                print(f"   ⚠️ job failed: {e}")
+                continue
+            job_latencies.append(job_latency)
+            task_latencies.extend(latencies)
+            failed_tasks += failed
+    elapsed = time.perf_counter() - started
+
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        "mix": mix,
+        "job_size": size,
+        "jobs": jobs,
+        "job_errors": errors,
+        "failed_tasks": failed_tasks,
+        "elapsed_s": round(elapsed, 2),
+        "jobs_per_sec": round(len(job_latencies) / elapsed, 3),
+        "tasks_per_sec": round(len(task_latencies) / elapsed, 2),
+        "job_p50_ms": ms(percentile(job_latencies, 50)),
+        "job_p95_ms": ms(percentile(job_latencies, 95)),
+        "task_p50_ms": ms(percentile(task_latencies, 50)),
+        "task_p95_ms": ms(percentile(task_latencies, 95)),
+        "task_p99_ms": ms(percentile(task_latencies, 99)),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns a list of regression messages for scenarios present in both runs."""
+    previous = {(s["mix"], s["job_size"]): s for s in baseline["scenarios"]}
+    regressions = []
+    for scenario in results["scenarios"]:
+        before = previous.get((scenario["mix"], scenario["job_size"]))
+        if not before:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = before.get(metric), scenario.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(
+                    f"{scenario['mix']}/{scenario['job_size']} {metric}: {old} -> {new} ({change:+.0%})"
+                )
+    old_rss, new_rss = baseline.get("peak_rss_mb"), results["peak_rss_mb"]
+    if old_rss and (new_rss - old_rss) / old_rss > tolerance:
+        regressions.append(f"peak_rss_mb: {old_rss} -> {new_rss}")
+    return regressions
+
+def print_table(scenarios):
+    columns = ["mix", "job_size", "jobs_per_sec", "tasks_per_sec", "task_p50_ms", "task_p95_ms",
+               "task_p99_ms", "failed_tasks", "peak_rss_mb"]
+    print(" | ".join(f"{c:>13}" for c in columns))
+    for scenario in scenarios:
+        print(" | ".join(f"{str(scenario[c]):>13}" for c in columns))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BIG API gateway against stub providers")
+    parser.add_argument("--sizes", default="1,10,50,100", help="Comma-separated tasks per job")
+    parser.add_argument("--mixes", default=",".join(PROVIDER_MIXES), help="Comma-separated provider mixes")
+    parser.add_argument("--jobs", type=int, default=8, help="Jobs per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="Jobs in flight at once")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured jobs run before each scenario")
+    parser.add_argument("--sync", action="store_true",
+                        help="Use plain JSON responses (per-task latency = job latency) instead of NDJSON streaming")
+    parser.add_argument("--profile", help="JSON file overriding stub provider latency/error/payload settings")
+    parser.add_argument("--latency-scale", type=float, default=0.1, help="Multiply every stub latency by this")
+    parser.add_argument("--error-rate", type=float, help="Override the stub error rate of every provider")
+    parser.add_argument("--redis-url", help="Use this Redis for KV (never point it at production)")
+    parser.add_argument("--output", help="Write the results JSON here")
+    parser.add_argument("--save-baseline", help="Write the results JSON here as the new baseline")
+    parser.add_argument("--compare", help="Baseline JSON to compare against; exits 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    mixes = args.mixes.split(",")
+    unknown = [mix for mix in mixes if mix not in PROVIDER_MIXES]
+    if unknown:
+        parser.error(f"unknown mixes {unknown}; choose from {list(PROVIDER_MIXES)}")
+
+    profiles = load_profiles(args.profile, args.latency_scale, args.error_rate)
+    stub_process, base_url = start_stub_providers(profiles)
+    print(f"🧪 Stub providers on {base_url}")
+
+    try:
+        gateway = load_gateway(base_url, args.redis_url)
+        client = gateway.app.test_client()
+        scenarios = []
+        for mix in mixes:
+            for size in sizes:
+                print(f"▶️  {mix} x {size} tasks ({args.jobs} jobs, {args.concurrency} concurrent)")
+                scenarios.append(run_scenario(
+                    client, mix, size, args.jobs, args.concurrency, not args.sync, args.warmup
+                ))
+    finally:
+        stub_process.terminate()
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "jobs": args.jobs, "concurrency": args.concurrency, "warmup": args.warmup, "stream": not args.sync,
+            "latency_scale": args.latency_scale, "redis": bool(args.redis_url), "profiles": profiles,
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "scenarios": scenarios,
+    }
+
+    print()
+    print_table(scenarios)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"💾 Results written to {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("settings", {}).get("latency_scale") != args.latency_scale:
+            print("⚠️ Baseline was recorded with a different --latency-scale; comparison is not like for like")
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ {len(regressions)} regressions beyond {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"   - {regression}")
+            sys.exit(1)
+        print(f"✅ No regressions beyond {args.tolerance:.0%} against {args.compare}")
+
+if __name__ == "__main__":
+    main()
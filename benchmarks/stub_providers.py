@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Stub Provider Servers for BIG API Benchmarks
+Local HTTP servers that answer like the Reve, Gemini, Minimax, BFL, OpenAI
+images and fal.ai queue APIs, with configurable latency, error rate and
+payload size. No real images are generated and nothing leaves the machine.
+
+Run standalone to point a local gateway at it:
+    python benchmarks/stub_providers.py --port 8900
+then export the printed URLs before starting api_gateway.py.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Per-provider behaviour. latency_ms is the median of a lognormal distribution
+# with the given sigma (0 = fixed latency). Polled providers (bfl, fal) answer
+# the submit call after submit_ms and report the job ready latency_ms later.
+DEFAULT_PROFILES = {
+    "reve": {"latency_ms": 400, "sigma": 0.3, "error_rate": 0.0, "payload_bytes": 150_000},
+    "gemini": {"latency_ms": 500, "sigma": 0.3, "error_rate": 0.0, "payload_bytes": 200_000},
+    "minimax": {"latency_ms": 300, "sigma": 0.3, "error_rate": 0.0, "payload_bytes": 0},
+    "openai": {"latency_ms": 600, "sigma": 0.3, "error_rate": 0.0, "payload_bytes": 0},
+    "bfl": {"latency_ms": 1500, "sigma": 0.3, "error_rate": 0.0, "payload_bytes": 0, "submit_ms": 80},
+    "fal": {"latency_ms": 1200, "sigma": 0.3, "error_rate": 0.0, "payload_bytes": 0, "submit_ms": 80},
+}
+
+def load_profiles(path=None, latency_scale=1.0, error_rate=None):
+    """DEFAULT_PROFILES, overridden per provider from a JSON file, with latencies scaled."""
+    profiles = {name: dict(profile) for name, profile in DEFAULT_PROFILES.items()}
+    if path:
+        with open(path) as f:
+            for name, overrides in json.load(f).items():
+                profiles.setdefault(name, dict(DEFAULT_PROFILES["reve"])).update(overrides)
+    for profile in profiles.values():
+        profile["latency_ms"] *= latency_scale
+        profile["submit_ms"] = profile.get("submit_ms", 0) * latency_scale
+        if error_rate is not None:
+            profile["error_rate"] = error_rate
+    return profiles
+
+class StubState:
+    """Profiles plus the in-flight polled jobs and a cache of base64 payloads."""
+
+    def __init__(self, profiles, base_url):
+        self.profiles = profiles
+        self.base_url = base_url
+        self.jobs = {}  # job id -> (ready_at, failed, image count)
+        self.requests = {}
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def count(self, provider):
+        with self._lock:
+            self.requests[provider] = self.requests.get(provider, 0) + 1
+
+    def payload(self, size):
+        """Random base64 of roughly `size` decoded bytes (built once per size)."""
+        if size not in self._payloads:
+            self._payloads[size] = base64.b64encode(os.urandom(max(size, 1))).decode()
+        return self._payloads[size]
+
+    def latency(self, provider):
+        profile = self.profiles[provider]
+        median = profile["latency_ms"] / 1000
+        if profile.get("sigma"):
+            return median * math.exp(random.gauss(0, profile["sigma"]))
+        return median
+
+    def fails(self, provider):
+        return random.random() < self.profiles[provider].get("error_rate", 0)
+
+    def image_url(self):
+        return f"{self.base_url}/images/{uuid.uuid4().hex}.png"
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def _respond_after(self, provider, delay, body):
+        self.state.count(provider)
+        time.sleep(delay)
+        if self.state.fails(provider):
+            return self._send(500, {"error": f"simulated {provider} failure"})
+        self._send(200, body)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._read_body()
+        state = self.state
+
+        if path.startswith("/reve/"):
+            image = state.payload(state.profiles["reve"]["payload_bytes"])
+            return self._respond_after("reve", state.latency("reve"), {"image": image})
+
+        if path.startswith("/gemini/"):
+            image = state.payload(state.profiles["gemini"]["payload_bytes"])
+            return self._respond_after("gemini", state.latency("gemini"), {
+                "candidates": [{"content": {"parts": [{"inlineData": {"mimeType": "image/png", "data": image}}]}}]
+            })
+
+        if path.startswith("/minimax/"):
+            return self._respond_after("minimax", state.latency("minimax"), {
+                "base_resp": {"status_code": 0, "status_msg": "success"},
+                "data": {"image_urls": [state.image_url()]}
+            })
+
+        if path.startswith("/openai/"):
+            return self._respond_after("openai", state.latency("openai"), {
+                "created": int(time.time()),
+                "data": [{"url": state.image_url()} for _ in range(body.get("n", 1))]
+            })
+
+        if path.startswith("/bfl/"):
+            return self._submit_polled("bfl", 1, lambda job_id: {
+                "id": job_id,
+                "polling_url": f"{state.base_url}/bfl/v1/get_result?id={job_id}"
+            })
+
+        if path.startswith("/fal/"):
+            return self._submit_polled("fal", body.get("num_images") or 1, lambda job_id: {
+                "request_id": job_id,
+                "status_url": f"{state.base_url}/fal/requests/{job_id}/status",
+                "response_url": f"{state.base_url}/fal/requests/{job_id}",
+                "cancel_url": f"{state.base_url}/fal/requests/{job_id}/cancel"
+            })
+
+        self._send(404, {"error": f"no stub for POST {path}"})
+
+    def _submit_polled(self, provider, image_count, build_response):
+        state = self.state
+        state.count(provider)
+        time.sleep(state.profiles[provider].get("submit_ms", 0) / 1000)
+        job_id = uuid.uuid4().hex
+        state.jobs[job_id] = (time.time() + state.latency(provider), state.fails(provider), image_count)
+        self._send(200, build_response(job_id))
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        path = parsed.path
+        state = self.state
+
+        if path == "/bfl/v1/get_result":
+            job_id = parse_qs(parsed.query).get("id", [""])[0]
+            if job_id not in state.jobs:
+                return self._send(404, {"status": "Task not found"})
+            ready_at, failed, _ = state.jobs[job_id]
+            if time.time() < ready_at:
+                return self._send(200, {"id": job_id, "status": "Pending"})
+            state.jobs.pop(job_id, None)
+            if failed:
+                return self._send(200, {"id": job_id, "status": "Error"})
+            return self._send(200, {"id": job_id, "status": "Ready", "result": {"sample": state.image_url()}})
+
+        if path.startswith("/fal/requests/"):
+            parts = path.split("/")
+            job_id = parts[3]
+            if job_id not in state.jobs:
+                return self._send(404, {"detail": "Request not found"})
+            ready_at, failed, image_count = state.jobs[job_id]
+            if path.endswith("/status"):
+                return self._send(200, {"status": "COMPLETED" if time.time() >= ready_at else "IN_PROGRESS"})
+            state.jobs.pop(job_id, None)
+            if failed:
+                return self._send(500, {"detail": "simulated fal failure"})
+            return self._send(200, {"images": [{"url": state.image_url()} for _ in range(image_count)]})
+
+        if path.startswith("/images/"):
+            # Same bytes every time a URL is fetched, like a real CDN
+            data = b"\x89PNG\r\n\x1a\n" + hashlib.sha256(path.encode()).digest() * 32
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            return self.wfile.write(data)
+
+        if path == "/stats":
+            return self._send(200, {"requests": state.requests, "pending_jobs": len(state.jobs)})
+
+        self._send(404, {"error": f"no stub for GET {path}"})
+
+    def do_PUT(self):
+        path = urlparse(self.path).path
+        if path.startswith("/fal/requests/") and path.endswith("/cancel"):
+            self.state.jobs.pop(path.split("/")[3], None)
+            return self._send(202, {"status": "CANCELLATION_REQUESTED"})
+        self._send(404, {"error": f"no stub for PUT {path}"})
+
+def make_server(profiles, host="127.0.0.1", port=0):
+    """Builds (not starts) a threaded stub server; port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    base_url = f"http://{host}:{server.server_address[1]}"
+    StubHandler.state = StubState(profiles, base_url)
+    return server, base_url
+
+def gateway_environment(base_url):
+    """Environment variables that point the gateway's connectors at the stubs."""
+    return {
+        "REVE_API_URL": f"{base_url}/reve/v1/image/create",
+        "GEMINI_API_URL": f"{base_url}/gemini/v1beta/models/stub:generateContent",
+        "MINIMAX_API_URL": f"{base_url}/minimax/v1/image_generation",
+        "BFL_API_URL_BASE": f"{base_url}/bfl/v1/",
+        "FAL_QUEUE_URL": f"{base_url}/fal/",
+        "OPENAI_BASE_URL": f"{base_url}/openai/v1",
+        "REVE_API_KEY": "stub",
+        "GEMINI_API_KEY": "stub",
+        "MINIMAX_API_KEY": "stub",
+        "BFL_API_KEY": "stub",
+        "FAL_KEY": "stub",
+        "OPENAI_API_KEY": "stub",
+    }
+
+def serve(profiles, host, port, ready=None):
+    """Runs the stub server until interrupted; puts base_url on `ready` once listening."""
+    server, base_url = make_server(profiles, host, port)
+    if ready is not None:
+        ready.put(base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Run stub image provider APIs for benchmarking")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--profile", help="JSON file overriding per-provider latency/error/payload settings")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiply every latency by this")
+    parser.add_argument("--error-rate", type=float, help="Override the error rate of every provider")
+    args = parser.parse_args()
+
+    profiles = load_profiles(args.profile, args.latency_scale, args.error_rate)
+    server, base_url = make_server(profiles, args.host, args.port)
+    print(f"🧪 Stub providers listening on {base_url}")
+    for name, value in gateway_environment(base_url).items():
+        print(f"export {name}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n👋 Stub providers stopped")
+
+if __name__ == "__main__":
+    main()
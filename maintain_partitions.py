@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Partition Maintenance for BIG API
+Creates upcoming monthly partitions of usage_logs and credit_transactions and
+detaches partitions past their retention (see supabase/migrations/004).
+Run once a day from cron or any scheduler.
+"""
+
+import argparse
+import json
+from api_gateway import supabase
+
+def main():
+    parser = argparse.ArgumentParser(description="Run BIG API partition maintenance")
+    parser.add_argument("--json", action="store_true", help="Print the raw maintenance summary")
+    args = parser.parse_args()
+
+    if not supabase:
+        print("❌ SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY are not configured.")
+        return
+
+    summary = supabase.rpc('maintain_partitions').execute().data or {}
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    for table, result in summary.items():
+        detached = result.get('detached') or []
+        print(f"🗂️  {table}: {result.get('created', 0)} partitions created, {len(detached)} detached")
+        for partition in detached:
+            print(f"   - {partition}")
+
+if __name__ == "__main__":
+    main()
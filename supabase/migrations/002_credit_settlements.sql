@@ -0,0 +1,62 @@
+-- BIG API Database Schema
+-- Batched credit settlement for the gateway's Redis credit ledger
+
+-- The gateway reserves and commits credits in Redis, then syncs each settled job
+-- here in batches. settlement_id makes a retried batch safe to apply twice.
+ALTER TABLE public.credit_transactions ADD COLUMN settlement_id VARCHAR(100);
+
+CREATE UNIQUE INDEX idx_credit_transactions_settlement_id
+    ON public.credit_transactions(settlement_id)
+    WHERE settlement_id IS NOT NULL;
+
+-- Function to apply a batch of settlements in one transaction
+-- p_settlements: [{"settlement_id", "user_id", "credits", "description", "metadata"}, ...]
+-- The ledger already enforced the balance, so no sufficiency check is made here.
+CREATE OR REPLACE FUNCTION public.settle_credits(p_settlements JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    v_settlement JSONB;
+    v_new_balance INTEGER;
+    v_applied INTEGER := 0;
+BEGIN
+    FOR v_settlement IN SELECT * FROM jsonb_array_elements(p_settlements)
+    LOOP
+        -- Skip settlements applied by an earlier attempt of this batch
+        IF EXISTS (
+            SELECT 1 FROM public.credit_transactions
+            WHERE settlement_id = v_settlement->>'settlement_id'
+        ) THEN
+            CONTINUE;
+        END IF;
+
+        -- Update user credits
+        UPDATE public.users
+        SET credits = credits - (v_settlement->>'credits')::INTEGER
+        WHERE id = (v_settlement->>'user_id')::UUID
+        RETURNING credits INTO v_new_balance;
+
+        -- The user was deleted since the job ran
+        IF NOT FOUND THEN
+            CONTINUE;
+        END IF;
+
+        -- Log transaction
+        INSERT INTO public.credit_transactions (
+            user_id, type, amount, balance_after, description, metadata, settlement_id
+        )
+        VALUES (
+            (v_settlement->>'user_id')::UUID,
+            'usage',
+            -(v_settlement->>'credits')::INTEGER,
+            v_new_balance,
+            v_settlement->>'description',
+            COALESCE(v_settlement->'metadata', '{}'::jsonb),
+            v_settlement->>'settlement_id'
+        );
+
+        v_applied := v_applied + 1;
+    END LOOP;
+
+    RETURN v_applied;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,130 @@
+-- BIG API Database Schema
+-- Per-user usage summary maintained on insert, replacing the user_stats aggregation
+
+-- One row per user, kept current by statement-level triggers on usage_logs and
+-- credit_transactions. Dashboard reads are a single-row lookup instead of a
+-- scan over the user's whole history.
+CREATE TABLE public.user_usage_summary (
+    user_id UUID PRIMARY KEY REFERENCES public.users(id) ON DELETE CASCADE,
+    total_requests BIGINT NOT NULL DEFAULT 0,
+    total_credits_used BIGINT NOT NULL DEFAULT 0,
+    total_images_generated BIGINT NOT NULL DEFAULT 0,
+    total_failed BIGINT NOT NULL DEFAULT 0,
+    total_credits_purchased BIGINT NOT NULL DEFAULT 0,
+    last_request_at TIMESTAMP WITH TIME ZONE,
+    last_transaction_at TIMESTAMP WITH TIME ZONE,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+ALTER TABLE public.user_usage_summary ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Users can view their own usage summary" ON public.user_usage_summary
+    FOR SELECT USING (auth.uid() = user_id);
+
+-- Composite indexes for per-user time range queries (they cover the user_id indexes)
+CREATE INDEX idx_usage_logs_user_created ON public.usage_logs(user_id, created_at);
+CREATE INDEX idx_credit_transactions_user_created ON public.credit_transactions(user_id, created_at);
+DROP INDEX IF EXISTS public.idx_usage_logs_user_id;
+DROP INDEX IF EXISTS public.idx_credit_transactions_user_id;
+
+-- Trigger function: folds a batch of new usage_logs rows into the summary
+-- (the gateway inserts usage_logs in multi-row batches, so this runs once per batch)
+CREATE OR REPLACE FUNCTION public.summarize_usage_logs()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO public.user_usage_summary AS s (
+        user_id, total_requests, total_credits_used, total_images_generated,
+        total_failed, last_request_at
+    )
+    SELECT
+        user_id,
+        COUNT(*),
+        COALESCE(SUM(credits_used), 0),
+        COALESCE(SUM(success_count), 0),
+        COALESCE(SUM(failed_count), 0),
+        MAX(created_at)
+    FROM new_rows
+    GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        total_requests = s.total_requests + EXCLUDED.total_requests,
+        total_credits_used = s.total_credits_used + EXCLUDED.total_credits_used,
+        total_images_generated = s.total_images_generated + EXCLUDED.total_images_generated,
+        total_failed = s.total_failed + EXCLUDED.total_failed,
+        last_request_at = GREATEST(s.last_request_at, EXCLUDED.last_request_at),
+        updated_at = NOW();
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Trigger function: folds a batch of new credit_transactions rows into the summary
+CREATE OR REPLACE FUNCTION public.summarize_credit_transactions()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO public.user_usage_summary AS s (
+        user_id, total_credits_purchased, last_transaction_at
+    )
+    SELECT
+        user_id,
+        COALESCE(SUM(amount) FILTER (WHERE type = 'purchase'), 0),
+        MAX(created_at)
+    FROM new_rows
+    GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        total_credits_purchased = s.total_credits_purchased + EXCLUDED.total_credits_purchased,
+        last_transaction_at = GREATEST(s.last_transaction_at, EXCLUDED.last_transaction_at),
+        updated_at = NOW();
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER usage_logs_summary
+    AFTER INSERT ON public.usage_logs
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.summarize_usage_logs();
+
+CREATE TRIGGER credit_transactions_summary
+    AFTER INSERT ON public.credit_transactions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.summarize_credit_transactions();
+
+-- Backfill from existing history (each table aggregated on its own)
+INSERT INTO public.user_usage_summary (
+    user_id, total_requests, total_credits_used, total_images_generated,
+    total_failed, last_request_at
+)
+SELECT user_id, COUNT(*), SUM(credits_used), SUM(success_count), SUM(failed_count), MAX(created_at)
+FROM public.usage_logs
+GROUP BY user_id;
+
+INSERT INTO public.user_usage_summary AS s (user_id, total_credits_purchased, last_transaction_at)
+SELECT user_id, COALESCE(SUM(amount) FILTER (WHERE type = 'purchase'), 0), MAX(created_at)
+FROM public.credit_transactions
+GROUP BY user_id
+ON CONFLICT (user_id) DO UPDATE SET
+    total_credits_purchased = EXCLUDED.total_credits_purchased,
+    last_transaction_at = EXCLUDED.last_transaction_at;
+
+-- View for user statistics, now without the usage_logs x api_keys fan-out
+DROP VIEW IF EXISTS public.user_stats;
+
+CREATE VIEW public.user_stats AS
+SELECT
+    u.id,
+    u.email,
+    u.plan,
+    u.credits,
+    COALESCE(s.total_requests, 0) as total_requests,
+    COALESCE(s.total_credits_used, 0) as total_credits_used,
+    COALESCE(s.total_images_generated, 0) as total_images_generated,
+    (
+        SELECT COUNT(*) FROM public.api_keys ak
+        WHERE ak.user_id = u.id AND ak.is_active = TRUE
+    ) as api_key_count,
+    s.last_request_at
+FROM public.users u
+LEFT JOIN public.user_usage_summary s ON s.user_id = u.id;
+
+GRANT SELECT ON public.user_usage_summary TO authenticated;
+GRANT SELECT ON public.user_stats TO authenticated;
@@ -0,0 +1,351 @@
+-- BIG API Database Schema
+-- Monthly range partitioning and retention for usage_logs and credit_transactions
+
+-- Both tables are rebuilt as tables partitioned by month on created_at, with
+-- one partition per month (usage_logs_p2025_01, ...). maintain_partitions()
+-- keeps PARTITION_MONTHS_AHEAD months of future partitions and detaches
+-- partitions older than each table's retention, moving them to the archive
+-- schema (or dropping them). Run it daily: via pg_cron, or with
+-- maintain_partitions.py from any scheduler. Totals in user_usage_summary are
+-- unaffected by retention.
+--
+-- Each table also has a DEFAULT partition (usage_logs_default, ...), so inserts
+-- keep working if maintenance stops running for longer than months_ahead.
+-- The next maintenance run moves those rows into their monthly partitions.
+--
+-- Run the whole migration in one transaction: the copy below must not race
+-- concurrent inserts.
+
+CREATE SCHEMA IF NOT EXISTS archive;
+
+-- Retention policy per partitioned table
+CREATE TABLE public.partition_retention (
+    table_name VARCHAR(63) PRIMARY KEY,
+    retention_months INTEGER NOT NULL CHECK (retention_months > 0),
+    archive BOOLEAN NOT NULL DEFAULT TRUE, -- move detached partitions to the archive schema, else drop them
+    months_ahead INTEGER NOT NULL DEFAULT 3
+);
+
+INSERT INTO public.partition_retention (table_name, retention_months, archive, months_ahead) VALUES
+    ('usage_logs', 13, TRUE, 3),
+    ('credit_transactions', 84, TRUE, 3);
+
+-- Maintenance-only table: RLS with no policies keeps it away from API clients
+ALTER TABLE public.partition_retention ENABLE ROW LEVEL SECURITY;
+
+-- Function to create the monthly partitions of p_table from p_from's month
+-- through p_months_ahead months after the current one. Rows of a new month that
+-- were stored in the DEFAULT partition are moved into it. Returns how many
+-- partitions were created.
+CREATE OR REPLACE FUNCTION public.create_monthly_partitions(
+    p_table TEXT,
+    p_from DATE DEFAULT CURRENT_DATE,
+    p_months_ahead INTEGER DEFAULT 3
+)
+RETURNS INTEGER AS $$
+DECLARE
+    v_month DATE := date_trunc('month', p_from)::DATE;
+    v_last DATE := (date_trunc('month', NOW()) + make_interval(months => p_months_ahead))::DATE;
+    v_next DATE;
+    v_partition TEXT;
+    v_default TEXT := p_table || '_default';
+    v_created INTEGER := 0;
+BEGIN
+    WHILE v_month <= v_last LOOP
+        v_next := (v_month + INTERVAL '1 month')::DATE;
+        v_partition := format('%s_p%s', p_table, to_char(v_month, 'YYYY_MM'));
+        IF to_regclass(format('public.%I', v_partition)) IS NOT NULL THEN
+            NULL;
+        ELSIF to_regclass(format('public.%I', v_default)) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE public.%I PARTITION OF public.%I FOR VALUES FROM (%L) TO (%L)',
+                v_partition, p_table, v_month, v_next
+            );
+            v_created := v_created + 1;
+        ELSE
+            -- A range can't be added while the DEFAULT partition holds rows in it:
+            -- build the partition on its own, move those rows over, then attach it.
+            -- The lock holds back inserts into the DEFAULT partition until commit.
+            -- Rows are moved directly, so the summary triggers don't count them again.
+            EXECUTE format('LOCK TABLE public.%I IN SHARE ROW EXCLUSIVE MODE', v_default);
+            EXECUTE format(
+                'CREATE TABLE public.%I (LIKE public.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                v_partition, p_table
+            );
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM public.%I WHERE created_at >= %L AND created_at < %L RETURNING *) '
+                'INSERT INTO public.%I SELECT * FROM moved',
+                v_default, v_month, v_next, v_partition
+            );
+            EXECUTE format(
+                'ALTER TABLE public.%I ATTACH PARTITION public.%I FOR VALUES FROM (%L) TO (%L)',
+                p_table, v_partition, v_month, v_next
+            );
+            v_created := v_created + 1;
+        END IF;
+        v_month := v_next;
+    END LOOP;
+
+    RETURN v_created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Function to detach the partitions of p_table that ended more than
+-- p_retention_months ago, archiving or dropping them. Returns their names.
+CREATE OR REPLACE FUNCTION public.apply_partition_retention(
+    p_table TEXT,
+    p_retention_months INTEGER,
+    p_archive BOOLEAN DEFAULT TRUE
+)
+RETURNS TEXT[] AS $$
+DECLARE
+    v_cutoff DATE := (date_trunc('month', NOW()) - make_interval(months => p_retention_months))::DATE;
+    v_partition TEXT;
+    v_detached TEXT[] := '{}';
+BEGIN
+    FOR v_partition IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        JOIN pg_namespace n ON n.oid = p.relnamespace
+        WHERE n.nspname = 'public'
+          AND p.relname = p_table
+          AND c.relname ~ '_p[0-9]{4}_[0-9]{2}$'
+          AND to_date(right(c.relname, 7), 'YYYY_MM') < v_cutoff
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('ALTER TABLE public.%I DETACH PARTITION public.%I', p_table, v_partition);
+        IF p_archive THEN
+            EXECUTE format('ALTER TABLE public.%I SET SCHEMA archive', v_partition);
+        ELSE
+            EXECUTE format('DROP TABLE public.%I', v_partition);
+        END IF;
+        v_detached := array_append(v_detached, v_partition);
+    END LOOP;
+
+    RETURN v_detached;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Function to run partition maintenance for every table in partition_retention
+CREATE OR REPLACE FUNCTION public.maintain_partitions()
+RETURNS JSONB AS $$
+DECLARE
+    v_policy RECORD;
+    v_result JSONB := '{}'::jsonb;
+    v_from DATE;
+    v_created INTEGER;
+    v_detached TEXT[];
+BEGIN
+    FOR v_policy IN SELECT * FROM public.partition_retention ORDER BY table_name LOOP
+        -- Start at the oldest row left in the DEFAULT partition (maintenance lapsed)
+        v_from := NULL;
+        IF to_regclass(format('public.%I', v_policy.table_name || '_default')) IS NOT NULL THEN
+            EXECUTE format('SELECT MIN(created_at)::DATE FROM public.%I', v_policy.table_name || '_default')
+                INTO v_from;
+        END IF;
+        v_created := public.create_monthly_partitions(
+            v_policy.table_name, LEAST(CURRENT_DATE, COALESCE(v_from, CURRENT_DATE)), v_policy.months_ahead
+        );
+        v_detached := public.apply_partition_retention(v_policy.table_name, v_policy.retention_months, v_policy.archive);
+        v_result := v_result || jsonb_build_object(
+            v_policy.table_name,
+            jsonb_build_object('created', v_created, 'detached', to_jsonb(v_detached))
+        );
+    END LOOP;
+
+    -- Settlement ids only need to outlive retries of their batch
+    DELETE FROM public.credit_settlements WHERE created_at < NOW() - INTERVAL '30 days';
+
+    RETURN v_result;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ------------------------------------------------------------------------------
+-- usage_logs
+-- ------------------------------------------------------------------------------
+ALTER TABLE public.usage_logs RENAME TO usage_logs_unpartitioned;
+ALTER INDEX public.usage_logs_pkey RENAME TO usage_logs_unpartitioned_pkey;
+DROP TRIGGER IF EXISTS usage_logs_summary ON public.usage_logs_unpartitioned;
+
+CREATE TABLE public.usage_logs (
+    id UUID NOT NULL DEFAULT uuid_generate_v4(),
+    user_id UUID NOT NULL REFERENCES public.users(id) ON DELETE CASCADE,
+    api_key_id UUID REFERENCES public.api_keys(id) ON DELETE SET NULL,
+    request_id VARCHAR(100),
+    provider VARCHAR(50) NOT NULL,
+    credits_used INTEGER NOT NULL,
+    task_count INTEGER NOT NULL,
+    success_count INTEGER NOT NULL,
+    failed_count INTEGER NOT NULL,
+    prompt_tokens INTEGER,
+    response_time_ms INTEGER,
+    error_message TEXT,
+    metadata JSONB,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+SELECT public.create_monthly_partitions(
+    'usage_logs',
+    COALESCE((SELECT MIN(created_at) FROM public.usage_logs_unpartitioned)::DATE, CURRENT_DATE),
+    3
+);
+
+CREATE TABLE public.usage_logs_default PARTITION OF public.usage_logs DEFAULT;
+
+INSERT INTO public.usage_logs (
+    id, user_id, api_key_id, request_id, provider, credits_used, task_count,
+    success_count, failed_count, prompt_tokens, response_time_ms, error_message,
+    metadata, created_at
+)
+SELECT
+    id, user_id, api_key_id, request_id, provider, credits_used, task_count,
+    success_count, failed_count, prompt_tokens, response_time_ms, error_message,
+    metadata, COALESCE(created_at, NOW())
+FROM public.usage_logs_unpartitioned;
+
+DROP TABLE public.usage_logs_unpartitioned;
+
+CREATE INDEX idx_usage_logs_user_created ON public.usage_logs(user_id, created_at);
+CREATE INDEX idx_usage_logs_created_at ON public.usage_logs(created_at);
+CREATE INDEX idx_usage_logs_provider ON public.usage_logs(provider);
+
+ALTER TABLE public.usage_logs ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Users can view their own usage logs"
+    ON public.usage_logs FOR SELECT
+    USING (auth.uid() = user_id);
+
+-- Created after the copy so existing rows aren't counted twice
+CREATE TRIGGER usage_logs_summary
+    AFTER INSERT ON public.usage_logs
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.summarize_usage_logs();
+
+-- ------------------------------------------------------------------------------
+-- credit_transactions
+-- ------------------------------------------------------------------------------
+ALTER TABLE public.credit_transactions RENAME TO credit_transactions_unpartitioned;
+ALTER INDEX public.credit_transactions_pkey RENAME TO credit_transactions_unpartitioned_pkey;
+DROP TRIGGER IF EXISTS credit_transactions_summary ON public.credit_transactions_unpartitioned;
+DROP INDEX IF EXISTS public.idx_credit_transactions_settlement_id;
+
+CREATE TABLE public.credit_transactions (
+    id UUID NOT NULL DEFAULT uuid_generate_v4(),
+    user_id UUID NOT NULL REFERENCES public.users(id) ON DELETE CASCADE,
+    type VARCHAR(50) NOT NULL, -- 'purchase', 'usage', 'refund', 'bonus', 'subscription'
+    amount INTEGER NOT NULL,
+    balance_after INTEGER NOT NULL,
+    description TEXT,
+    stripe_payment_id VARCHAR(255),
+    metadata JSONB,
+    settlement_id VARCHAR(100),
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+SELECT public.create_monthly_partitions(
+    'credit_transactions',
+    COALESCE((SELECT MIN(created_at) FROM public.credit_transactions_unpartitioned)::DATE, CURRENT_DATE),
+    3
+);
+
+CREATE TABLE public.credit_transactions_default PARTITION OF public.credit_transactions DEFAULT;
+
+INSERT INTO public.credit_transactions (
+    id, user_id, type, amount, balance_after, description, stripe_payment_id,
+    metadata, settlement_id, created_at
+)
+SELECT
+    id, user_id, type, amount, balance_after, description, stripe_payment_id,
+    metadata, settlement_id, COALESCE(created_at, NOW())
+FROM public.credit_transactions_unpartitioned;
+
+-- A unique index on a partitioned table must include created_at, so settlement
+-- idempotency moves to its own small table
+CREATE TABLE public.credit_settlements (
+    settlement_id VARCHAR(100) PRIMARY KEY,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+ALTER TABLE public.credit_settlements ENABLE ROW LEVEL SECURITY;
+
+INSERT INTO public.credit_settlements (settlement_id, created_at)
+SELECT settlement_id, COALESCE(created_at, NOW())
+FROM public.credit_transactions_unpartitioned
+WHERE settlement_id IS NOT NULL
+ON CONFLICT (settlement_id) DO NOTHING;
+
+DROP TABLE public.credit_transactions_unpartitioned;
+
+CREATE INDEX idx_credit_transactions_user_created ON public.credit_transactions(user_id, created_at);
+CREATE INDEX idx_credit_transactions_type ON public.credit_transactions(type);
+
+ALTER TABLE public.credit_transactions ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Users can view their own credit transactions"
+    ON public.credit_transactions FOR SELECT
+    USING (auth.uid() = user_id);
+
+CREATE TRIGGER credit_transactions_summary
+    AFTER INSERT ON public.credit_transactions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.summarize_credit_transactions();
+
+-- Function to apply a batch of settlements in one transaction (see 002), now
+-- deduplicated through credit_settlements
+CREATE OR REPLACE FUNCTION public.settle_credits(p_settlements JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    v_settlement JSONB;
+    v_new_balance INTEGER;
+    v_applied INTEGER := 0;
+BEGIN
+    FOR v_settlement IN SELECT * FROM jsonb_array_elements(p_settlements)
+    LOOP
+        -- Skip settlements applied by an earlier attempt of this batch
+        INSERT INTO public.credit_settlements (settlement_id)
+        VALUES (v_settlement->>'settlement_id')
+        ON CONFLICT (settlement_id) DO NOTHING;
+
+        IF NOT FOUND THEN
+            CONTINUE;
+        END IF;
+
+        -- Update user credits
+        UPDATE public.users
+        SET credits = credits - (v_settlement->>'credits')::INTEGER
+        WHERE id = (v_settlement->>'user_id')::UUID
+        RETURNING credits INTO v_new_balance;
+
+        -- The user was deleted since the job ran
+        IF NOT FOUND THEN
+            CONTINUE;
+        END IF;
+
+        -- Log transaction
+        INSERT INTO public.credit_transactions (
+            user_id, type, amount, balance_after, description, metadata, settlement_id
+        )
+        VALUES (
+            (v_settlement->>'user_id')::UUID,
+            'usage',
+            -(v_settlement->>'credits')::INTEGER,
+            v_new_balance,
+            v_settlement->>'description',
+            COALESCE(v_settlement->'metadata', '{}'::jsonb),
+            v_settlement->>'settlement_id'
+        );
+
+        v_applied := v_applied + 1;
+    END LOOP;
+
+    RETURN v_applied;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Grant necessary permissions
+GRANT ALL ON public.usage_logs TO authenticated;
+GRANT ALL ON public.credit_transactions TO authenticated;
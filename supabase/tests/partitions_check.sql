@@ -0,0 +1,73 @@
+-- Checks for migration 004, run by check_partitions.sh after 001-004 are applied.
+-- Each block fails the run with its ASSERT message.
+
+-- handle_new_user creates the profile with 100 credits
+INSERT INTO auth.users (id, email) VALUES ('00000000-0000-0000-0000-0000000000c1', 'partitions@example.com');
+
+-- Rows either side of month boundaries, plus months that have no partition yet
+INSERT INTO public.usage_logs (user_id, request_id, provider, credits_used, task_count, success_count, failed_count, created_at)
+SELECT '00000000-0000-0000-0000-0000000000c1', label, 'reve', 5, 1, 1, 0, created_at
+FROM (VALUES
+    ('previous_month_end', date_trunc('month', NOW()) - INTERVAL '1 microsecond'),
+    ('month_start', date_trunc('month', NOW())),
+    ('month_end', date_trunc('month', NOW()) + INTERVAL '1 month' - INTERVAL '1 microsecond'),
+    ('next_month_start', date_trunc('month', NOW()) + INTERVAL '1 month'),
+    ('beyond_months_ahead', date_trunc('month', NOW()) + INTERVAL '6 months'),
+    ('past_retention', TIMESTAMPTZ '2020-01-15 12:00:00+00')
+) AS boundary_rows (label, created_at);
+
+DO $$
+DECLARE
+    v_this_month TEXT := to_char(NOW(), 'YYYY_MM');
+    v_next_month TEXT := to_char(date_trunc('month', NOW()) + INTERVAL '1 month', 'YYYY_MM');
+BEGIN
+    ASSERT (SELECT tableoid::regclass::TEXT FROM public.usage_logs WHERE request_id = 'month_start')
+        = 'usage_logs_p' || v_this_month, 'month_start should be in the current month''s partition';
+    ASSERT (SELECT tableoid::regclass::TEXT FROM public.usage_logs WHERE request_id = 'month_end')
+        = 'usage_logs_p' || v_this_month, 'month_end should be in the current month''s partition';
+    ASSERT (SELECT tableoid::regclass::TEXT FROM public.usage_logs WHERE request_id = 'next_month_start')
+        = 'usage_logs_p' || v_next_month, 'next_month_start should be in next month''s partition';
+    ASSERT (SELECT COUNT(*) FROM public.usage_logs_default) = 3,
+        'rows without a monthly partition should land in usage_logs_default';
+    ASSERT (SELECT total_requests FROM public.user_usage_summary WHERE user_id = '00000000-0000-0000-0000-0000000000c1') = 6,
+        'user_usage_summary should count every inserted row once';
+END $$;
+
+-- A retried settlement batch is applied once
+DO $$
+DECLARE
+    v_batch JSONB := '[{"settlement_id": "res_partitions_check", "user_id": "00000000-0000-0000-0000-0000000000c1",
+                        "credits": 7, "description": "Image generation - 1 tasks", "metadata": {"task_count": 1}}]';
+BEGIN
+    ASSERT public.settle_credits(v_batch) = 1, 'the first settle_credits call should apply the settlement';
+    ASSERT public.settle_credits(v_batch) = 0, 'a repeated settlement_id should be skipped';
+    ASSERT (SELECT credits FROM public.users WHERE id = '00000000-0000-0000-0000-0000000000c1') = 93,
+        'the user should be charged once';
+    ASSERT (SELECT COUNT(*) FROM public.credit_transactions WHERE settlement_id = 'res_partitions_check') = 1,
+        'the settlement should be logged once';
+    ASSERT (SELECT tableoid::regclass::TEXT FROM public.credit_transactions WHERE settlement_id = 'res_partitions_check')
+        = 'credit_transactions_p' || to_char(NOW(), 'YYYY_MM'), 'the transaction should be in the current month''s partition';
+END $$;
+
+-- Maintenance moves rows out of DEFAULT into new partitions, then applies retention
+DO $$
+DECLARE
+    v_summary JSONB := public.maintain_partitions();
+BEGIN
+    RAISE NOTICE 'maintain_partitions() = %', v_summary;
+    ASSERT (SELECT COUNT(*) FROM public.usage_logs_default) = 0, 'maintenance should empty usage_logs_default';
+    ASSERT (SELECT tableoid::regclass::TEXT FROM public.usage_logs WHERE request_id = 'previous_month_end')
+        = 'usage_logs_p' || to_char(date_trunc('month', NOW()) - INTERVAL '1 month', 'YYYY_MM'),
+        'previous_month_end should move to the previous month''s partition';
+    ASSERT (SELECT tableoid::regclass::TEXT FROM public.usage_logs WHERE request_id = 'beyond_months_ahead')
+        = 'usage_logs_p' || to_char(date_trunc('month', NOW()) + INTERVAL '6 months', 'YYYY_MM'),
+        'beyond_months_ahead should move to its own partition';
+    ASSERT NOT EXISTS (SELECT 1 FROM public.usage_logs WHERE request_id = 'past_retention'),
+        'a row older than the retention should be detached';
+    ASSERT (SELECT COUNT(*) FROM archive.usage_logs_p2020_01) = 1,
+        'the detached partition should be kept in the archive schema';
+    ASSERT (SELECT total_requests FROM public.user_usage_summary WHERE user_id = '00000000-0000-0000-0000-0000000000c1') = 6,
+        'moving rows between partitions must not count them again';
+    ASSERT (public.maintain_partitions()->'usage_logs'->>'created')::INTEGER = 0,
+        'a second maintenance run should have nothing to create';
+END $$;
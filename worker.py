@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Async Job Worker for BIG API
+Drains the Redis job queue filled by POST /v1/jobs/create with "async": true
+and by bulk uploads to POST /v1/jobs/bulk.
+Run as many worker processes as needed; each claims one job at a time.
+"""
+
+import argparse
+from api_gateway import run_worker, requeue_stale_jobs, kv
+
+def main():
+    parser = argparse.ArgumentParser(description="Process queued BIG API jobs")
+    parser.add_argument("--burst", action="store_true", help="Exit once the queue is empty")
+    parser.add_argument("--requeue-stale", action="store_true",
+                        help="Move jobs claimed by workers whose lease has expired back onto the queue first")
+    args = parser.parse_args()
+
+    if not kv:
+        print("❌ KV_URL is not configured. Workers need Redis.")
+        return
+
+    if args.requeue_stale:
+        print(f"♻️  Requeued {requeue_stale_jobs()} stale jobs")
+
+    try:
+        run_worker(burst=args.burst)
+    except KeyboardInterrupt:
+        print("\n👋 Worker stopped")
+
+if __name__ == "__main__":
+    main()